@@ -4,10 +4,10 @@ import pandas as pd
 import pypeliner
 import remixt.seqdataio
 import remixt.segalg
-import remixt.analysis.haplotype
 import shutil
 
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+from biowrappers.components.copy_number_calling.common.utils import calculate_allele_counts, intersect_allele_counts
 
 
 def read_chromosome_lengths(chrom_info_filename):
@@ -52,25 +52,6 @@ def create_segment_counts(seqdata_filename, chromosome_lengths, segment_length=1
     return segment_counts
 
 
-def calculate_allele_counts(seqdata_filename):
-
-    allele_counts = list()
-
-    chromosomes = remixt.seqdataio.read_chromosomes(seqdata_filename)
-
-    for chrom in chromosomes:
-
-        chrom_allele_counts = remixt.analysis.haplotype.read_snp_counts(seqdata_filename, chrom)
-
-        chrom_allele_counts['chromosome'] = chrom
-
-        allele_counts.append(chrom_allele_counts)
-
-    allele_counts = pd.concat(allele_counts, ignore_index=True)
-
-    return allele_counts
-
-
 def prepare_normal_data(normal_filename, normal_logr_filename, normal_baf_filename, config):
     """ Prepare normal count and allele data
     """
@@ -95,5 +76,8 @@ def prepare_tumour_data(tumour_filename, normal_logr_filename, normal_baf_filena
 
     het_positions = pd.read_csv(het_positions_filename, sep='\t', converters={'chromosome': str})
 
-    tumour_allele_count = calculate_allele_counts(tumour_filename).merge(het_positions)
+    tumour_allele_count = calculate_allele_counts(
+        tumour_filename, cache_dir=config.get('seqdata_cache_dir'), num_processes=config.get('num_processes', 1))
+
+    tumour_allele_count, _ = intersect_allele_counts(tumour_allele_count, het_positions)
     write_titan_format_alleles(tumour_allele_filename, tumour_allele_count)
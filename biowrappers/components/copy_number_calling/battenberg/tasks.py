@@ -1,8 +1,13 @@
+from collections import OrderedDict
+
+import hashlib
+import io
+import multiprocessing
 import os
-import itertools
 import shutil
 import tarfile
-import vcf
+import tempfile
+import time
 import gzip
 import numpy as np
 import pandas as pd
@@ -11,68 +16,217 @@ import pypeliner
 
 import remixt.seqdataio
 import remixt.segalg
-import remixt.analysis.haplotype
 import remixt.analysis.experiment
 import remixt.cn_model
 
 from biowrappers.components.utils import make_directory
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+import biowrappers.components.copy_number_calling.common.seqdata as seqdata
+from biowrappers.components.io.vcf._parse import read_sample_columns
+
+
+_alleles = list('ACGT')
 
+_loci_dtype = np.dtype([('position', np.int64), ('ref', np.int8), ('alt', np.int8)])
 
-def prepare_battenberg_allele_counts(
-    seqdata_filename,
-    thousand_genomes_snps,
+
+def cache_thousand_genomes_loci(
+    thousand_genomes_snps_filename,
     thousand_genomes_alleles_template,
-    alleles_template,
     chromosomes,
-    chromosome_ids):
-    """ Prepare a matrix of allele counts in battenberg format.
+    chromosome_ids,
+    cache_dir):
+    """ Cache the 1000 Genomes loci of each chromosome along with their SNP alleles.
+
+    :param thousand_genomes_snps_filename: TSV of chromosome, position, ref and alt of 1000 Genomes SNPs.
+    :param thousand_genomes_alleles_template: Battenberg 1000 Genomes alleles file per chromosome id.
+    :param chromosomes: Chromosomes to cache.
+    :param chromosome_ids: Battenberg id of each chromosome.
+    :param cache_dir: Directory in which to store the loci.
+
+    Returns a dict of filename by chromosome.  Each file holds an array of the positions listed in the alleles file of
+    the chromosome, in order, with the index in ACGT of the ref and alt allele of the SNP at the position, or -1 if
+    there is no 1000 Genomes SNP.  The SNP table is only read if a chromosome is not already cached.
+
     """
+    snps_key = _get_file_key(thousand_genomes_snps_filename)
 
-    alleles_filenames = []
+    loci_filenames = OrderedDict()
 
     for chromosome, chromosome_id in zip(chromosomes, chromosome_ids):
-        allele_counts = remixt.analysis.haplotype.read_snp_counts(seqdata_filename, chromosome)
-        allele_counts['chromosome'] = chromosome
+        alleles_filename = thousand_genomes_alleles_template.format(chromosome_id)
+
+        key = hashlib.md5(repr((snps_key, _get_file_key(alleles_filename))).encode()).hexdigest()
+
+        loci_filenames[chromosome] = os.path.join(cache_dir, 'thousand_genomes_loci_{0}_{1}.npy'.format(chromosome, key))
+
+    missing = [chromosome for chromosome, loci_filename in loci_filenames.items() if not os.path.exists(loci_filename)]
+
+    if len(missing) == 0:
+        return loci_filenames
 
-        allele_counts = allele_counts.merge(thousand_genomes_snps)
-        allele_counts['ref_count'] = allele_counts['ref_count'].fillna(0).astype(int)
-        allele_counts['alt_count'] = allele_counts['alt_count'].fillna(0).astype(int)
+    thousand_genomes_snps = pd.read_csv(
+        thousand_genomes_snps_filename, sep='\t',
+        header=None, names=['chromosome', 'position', 'ref', 'alt'],
+        converters={'chromosome': str})
+
+    thousand_genomes_snps['ref'] = pd.Categorical(thousand_genomes_snps['ref'], categories=_alleles).codes
+    thousand_genomes_snps['alt'] = pd.Categorical(thousand_genomes_snps['alt'], categories=_alleles).codes
+
+    # Ensure only SNPs are used
+    thousand_genomes_snps = thousand_genomes_snps[(thousand_genomes_snps['ref'] >= 0) & (thousand_genomes_snps['alt'] >= 0)]
+
+    make_directory(cache_dir)
+
+    for chromosome, chromosome_id in zip(chromosomes, chromosome_ids):
+        if chromosome not in missing:
+            continue
 
         positions = pd.read_csv(
             thousand_genomes_alleles_template.format(chromosome_id),
             sep='\t', usecols=['position'])['position'].values
 
-        ref_counts = allele_counts.set_index(['position', 'ref'])['ref_count'].unstack(fill_value=0).reindex(index=positions, fill_value=0)
-        alt_counts = allele_counts.set_index(['position', 'alt'])['alt_count'].unstack(fill_value=0).reindex(index=positions, fill_value=0)
+        snps = (
+            thousand_genomes_snps[thousand_genomes_snps['chromosome'] == chromosome]
+            .sort_values('position', kind='mergesort')
+            .drop_duplicates('position'))
+
+        loci = np.zeros(len(positions), dtype=_loci_dtype)
+        loci['position'] = positions
+        loci['ref'] = -1
+        loci['alt'] = -1
+
+        if len(snps) > 0:
+            snp_positions = snps['position'].values
+
+            idx = np.minimum(np.searchsorted(snp_positions, positions), len(snp_positions) - 1)
+            is_snp = snp_positions[idx] == positions
+
+            loci['ref'][is_snp] = snps['ref'].values[idx[is_snp]]
+            loci['alt'][is_snp] = snps['alt'].values[idx[is_snp]]
+
+        _save_array(loci_filenames[chromosome], loci)
+
+    return loci_filenames
+
+
+def calculate_allele_matrix(loci, snp_positions, ref_counts, alt_counts):
+    """ Calculate the read count of each allele at a set of loci.
+
+    :param loci: Array of 1000 Genomes loci as cached by `cache_thousand_genomes_loci`.
+    :param snp_positions: Sorted positions of SNPs with read counts.
+    :param ref_counts: Reference allele count at each SNP.
+    :param alt_counts: Alternate allele count at each SNP.
+
+    Returns an array with a row per locus and a column of counts per allele in ACGT.
+
+    """
+    snp_positions = np.asarray(snp_positions)
+
+    allele_matrix = np.zeros((len(loci), len(_alleles)), dtype=np.int64)
+
+    if len(snp_positions) == 0:
+        return allele_matrix
+
+    positions = np.asarray(loci['position'])
+
+    idx = np.minimum(np.searchsorted(snp_positions, positions), len(snp_positions) - 1)
+
+    rows = np.flatnonzero((snp_positions[idx] == positions) & (np.asarray(loci['ref']) >= 0))
+    idx = idx[rows]
+
+    # Scatter the counts of each SNP into the columns of its alleles
+    allele_matrix[rows, loci['ref'][rows]] += np.asarray(ref_counts)[idx]
+    allele_matrix[rows, loci['alt'][rows]] += np.asarray(alt_counts)[idx]
+
+    return allele_matrix
+
+
+def prepare_battenberg_allele_counts(seqdata_filename, loci, chromosome, cache_dir=None):
+    """ Prepare a matrix of allele counts in battenberg format.
+
+    :param seqdata_filename: Path of seqdata file.
+    :param loci: Array of 1000 Genomes loci of the chromosome as cached by `cache_thousand_genomes_loci`.
+    :param chromosome: Chromosome in the seqdata file.
+    :param cache_dir: Directory used to cache seqdata columns.
+
+    """
+    snp_counts = seqdata.read_snp_count_columns(seqdata_filename, chromosome, cache_dir=cache_dir)
+
+    allele_matrix = calculate_allele_matrix(
+        loci, snp_counts['position'], snp_counts['ref_count'], snp_counts['alt_count'])
 
-        allele_matrix = (ref_counts + alt_counts)
-        allele_matrix['Good_depth'] = allele_matrix.sum(axis=1)
-        allele_matrix.reset_index(inplace=True)
-        allele_matrix['chromosome'] = chromosome
+    allele_matrix = pd.DataFrame(OrderedDict([
+        ('#CHR', chromosome),
+        ('POS', loci['position']),
+        ('Count_A', allele_matrix[:, 0]),
+        ('Count_C', allele_matrix[:, 1]),
+        ('Count_G', allele_matrix[:, 2]),
+        ('Count_T', allele_matrix[:, 3]),
+        ('Good_depth', allele_matrix.sum(axis=1)),
+    ]))
 
-        allele_matrix.rename(
-            columns={
-                'chromosome': '#CHR',
-                'position': 'POS',
-                'A': 'Count_A',
-                'C': 'Count_C',
-                'G': 'Count_G',
-                'T': 'Count_T',
-            },
-            inplace=True,
-        )
+    return allele_matrix
 
-        alleles_filename = alleles_template.format(chromosome_id)
 
-        allele_matrix.to_csv(
-            alleles_filename,
-            sep='\t', index=False,
-            columns=['#CHR', 'POS', 'Count_A', 'Count_C', 'Count_G', 'Count_T', 'Good_depth'])
+def _prepare_battenberg_allele_counts(args):
+    seqdata_filename, loci_filename, chromosome, cache_dir = args
 
-        alleles_filenames.append(alleles_filename)
+    loci = _load_array(loci_filename)
 
-    return alleles_filenames
+    allele_matrix = prepare_battenberg_allele_counts(seqdata_filename, loci, chromosome, cache_dir=cache_dir)
+
+    return _format_allele_matrix(allele_matrix, chromosome).encode()
+
+
+def _format_allele_matrix(allele_matrix, chromosome, chunk_size=int(1e5)):
+    '''
+    Format an allele matrix as TSV, formatting rows in chunks with a single string operation rather than to_csv.
+    '''
+    values = allele_matrix.drop('#CHR', axis=1).values
+
+    line_format = chromosome.replace('%', '%%') + '\t%d' * values.shape[1] + '\n'
+
+    text = ['\t'.join(allele_matrix.columns) + '\n']
+
+    for idx in range(0, len(values), chunk_size):
+        chunk = values[idx:idx + chunk_size]
+
+        text.append((line_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+    return ''.join(text)
+
+
+def _get_file_key(file_name):
+    stat = os.stat(file_name)
+
+    return (os.path.abspath(file_name), stat.st_mtime, stat.st_size)
+
+
+def _save_array(filename, array):
+    '''
+    Save an array via a temporary file, so that concurrent tasks never load a partially written file.
+    '''
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.npy')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+
+        os.rename(tmp_filename, filename)
+
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def _load_array(filename):
+    try:
+        return np.load(filename, mmap_mode='r')
+
+    # Empty arrays cannot be memory mapped
+    except ValueError:
+        return np.load(filename)
 
 
 def prepare_data(
@@ -89,39 +243,80 @@ def prepare_data(
 
     chromosomes = config['chromosomes']
     chromosome_ids = config['chromosome_ids']
-    thousand_genomes_snps_filename = config['thousand_genomes_snps']
-    thousand_genomes_alleles_template = config['thousand_genomes_alleles_template']
-
-    thousand_genomes_snps = pd.read_csv(
-        thousand_genomes_snps_filename, sep='\t',
-        header=None, names=['chromosome', 'position', 'ref', 'alt'],
-        converters={'chromosome': str})
 
-    # Ensure only SNPs are used
-    thousand_genomes_snps = thousand_genomes_snps.merge(pd.DataFrame({'ref': list('ACGT')}))
-    thousand_genomes_snps = thousand_genomes_snps.merge(pd.DataFrame({'alt': list('ACGT')}))
-
-    normal_alleles_template = os.path.join(temp_directory, normal_id + '_alleleFrequencies_chr{}.txt')
-    normal_alleles_filenames = prepare_battenberg_allele_counts(
-        normal_filename,
-        thousand_genomes_snps,
-        thousand_genomes_alleles_template,
-        normal_alleles_template,
-        chromosomes,
-        chromosome_ids)
-
-    tumour_alleles_template = os.path.join(temp_directory, tumour_id + '_alleleFrequencies_chr{}.txt')
-    tumour_alleles_filenames = prepare_battenberg_allele_counts(
-        tumour_filename,
-        thousand_genomes_snps,
-        thousand_genomes_alleles_template,
-        tumour_alleles_template,
+    loci_filenames = cache_thousand_genomes_loci(
+        config['thousand_genomes_snps'],
+        config['thousand_genomes_alleles_template'],
         chromosomes,
-        chromosome_ids)
+        chromosome_ids,
+        config.get('thousand_genomes_cache_dir', temp_directory))
+
+    arcnames = []
+    args = []
+
+    for sample_filename, sample_id in ((normal_filename, normal_id), (tumour_filename, tumour_id)):
+        for chromosome, chromosome_id in zip(chromosomes, chromosome_ids):
+            arcnames.append('{0}_alleleFrequencies_chr{1}.txt'.format(sample_id, chromosome_id))
+            args.append((sample_filename, loci_filenames[chromosome], chromosome, config.get('seqdata_cache_dir')))
+
+    num_processes = config.get('num_processes', 1)
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+
+        imap_func = pool.imap
+
+    else:
+        pool = None
+
+        imap_func = map
+
+    try:
+        # Temporary archive read once by battenberg, favour speed over size
+        with tarfile.open(allele_counts_filename, 'w:gz', compresslevel=1) as tar:
+
+            # Chromosomes are computed concurrently but added in order as each becomes available
+            for idx, data in enumerate(imap_func(_prepare_battenberg_allele_counts, args)):
+                tarinfo = tarfile.TarInfo(arcnames[idx])
+                tarinfo.size = len(data)
+                tarinfo.mtime = time.time()
+
+                tar.addfile(tarinfo, io.BytesIO(data))
 
-    with tarfile.open(allele_counts_filename, "w:gz") as tar:
-        for filename in itertools.chain(normal_alleles_filenames, tumour_alleles_filenames):
-            tar.add(filename, arcname=os.path.basename(filename))
+    finally:
+        if pool is not None:
+            pool.close()
+
+            pool.join()
+
+
+def read_battenberg_cn_vcf(cn_vcf_filename, sample='TUMOUR'):
+    """ Read the clonal and subclonal copy number segments from a battenberg CN VCF.
+
+    :param cn_vcf_filename: Path of battenberg CN VCF file.
+    :param sample: Name of the sample column with the copy number calls.
+
+    Subclonal columns are NaN for segments without a subclonal state.
+
+    """
+    fields = read_sample_columns(
+        cn_vcf_filename, sample,
+        ['TCN', 'MCN', 'FCF', 'TCS', 'MCS', 'FCS'],
+        info_keys=['END'])
+
+    cn_data = pd.DataFrame(OrderedDict([
+        ('chromosome', fields['chrom']),
+        ('start', fields['pos']),
+        ('end', fields['END'].astype(int)),
+        ('major_1', fields['TCN'].astype(int)),
+        ('minor_1', fields['MCN'].astype(int)),
+        ('fraction_1', fields['FCF']),
+        ('major_2', fields['TCS']),
+        ('minor_2', fields['MCS']),
+        ('fraction_2', fields['FCS']),
+    ]))
+
+    return cn_data
 
 
 def run_battenberg(
@@ -168,28 +363,7 @@ def run_battenberg(
     tumour_content = cellularity_ploidy['cellularity'].iloc[0]
 
     cn_vcf_filename = os.path.join(temp_directory, '{}_battenberg_cn.vcf.gz'.format(tumour_id))
-    cn_data = []
-    vcf_reader = vcf.Reader(filename=cn_vcf_filename)
-    for vcf_record in vcf_reader:
-        segment_info = {}
-
-        segment_info['chromosome'] = vcf_record.CHROM
-        segment_info['start'] = vcf_record.POS
-        segment_info['end'] = vcf_record.INFO['END']
-
-        for sample in vcf_record.samples:
-            if sample.sample == 'TUMOUR':
-                segment_info['major_1'] = sample.data.TCN
-                segment_info['minor_1'] = sample.data.MCN
-                segment_info['fraction_1'] = sample.data.FCF
-
-                segment_info['major_2'] = sample.data.TCS
-                segment_info['minor_2'] = sample.data.MCS
-                segment_info['fraction_2'] = sample.data.FCS
-
-        cn_data.append(segment_info)
-
-    cn_data = pd.DataFrame(cn_data)
+    cn_data = read_battenberg_cn_vcf(cn_vcf_filename)
 
     cn_data['fraction_2'] = cn_data['fraction_2'].fillna(0.0)
     cn_data.loc[cn_data['major_2'].isnull(), 'major_2'] = cn_data.loc[cn_data['major_2'].isnull(), 'major_1']
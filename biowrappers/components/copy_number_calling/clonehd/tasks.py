@@ -1,11 +1,13 @@
+import io
+import itertools
 import os
+import multiprocessing
 import shutil
 import numpy as np
 import pandas as pd
 
 import pypeliner
 
-import remixt.seqdataio
 import remixt.segalg
 import remixt.analysis.haplotype
 import remixt.analysis.experiment
@@ -13,6 +15,8 @@ import remixt.cn_model
 
 from biowrappers.components.utils import make_directory
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+from biowrappers.components.copy_number_calling.common.utils import find_common_keys, iter_bin_counts
+import biowrappers.components.copy_number_calling.common.seqdata as seqdata
 
 
 def read_chromosome_lengths(chrom_info_filename):
@@ -24,111 +28,140 @@ def read_chromosome_lengths(chrom_info_filename):
     return chrom_info.set_index('chrom')['length']
 
 
-def create_segments(chrom_length, segment_length=1000):
+def write_cna(cna_filename, seqdata_filename, chromosome_lengths, segment_length=1000, cache_dir=None,
+              chunk_size=int(1e5)):
 
-    seg_start = np.arange(0, chrom_length, segment_length)
-    seg_end = seg_start + segment_length
+    with open(cna_filename, 'w') as cna:
 
-    segments = pd.DataFrame({'start': seg_start, 'end': seg_end})
+        for chrom, seg_count in iter_bin_counts(seqdata_filename, chromosome_lengths, segment_length, cache_dir=cache_dir):
 
-    return segments
+            for beg in range(0, len(seg_count), chunk_size):
+                lines = []
 
+                for idx, count in enumerate(seg_count[beg:beg + chunk_size].tolist(), beg + 1):
+                    lines.append('{0}\t{1}\t{2}\t1\n'.format(chrom, idx * segment_length, count))
 
-def write_cna(cna_filename, seqdata_filename, chromosome_lengths, segment_length=1000):
+                cna.write(''.join(lines))
 
-    with open(cna_filename, 'w') as cna:
 
-        chromosomes = remixt.seqdataio.read_chromosomes(seqdata_filename)
+def write_tumour_baf(baf_filename, normal_filename, tumour_filename, cache_dir=None, num_processes=1, pool=None):
 
-        for chrom in chromosomes:
+    chromosomes = seqdata.read_chromosomes(normal_filename)
 
-            reads = remixt.seqdataio.read_fragment_data(seqdata_filename, chromosome=chrom)
+    args = [(normal_filename, tumour_filename, chrom, cache_dir) for chrom in chromosomes]
 
-            reads.sort_values('start', inplace=True)
+    # Chromosomes are computed in the given pool if any, otherwise in a pool of `num_processes` started here
+    if pool is not None:
+        own_pool = None
 
-            segments = create_segments(chromosome_lengths[chrom], segment_length)
+        imap_func = pool.imap
 
-            segments['count'] = remixt.segalg.contained_counts(
-                segments[['start', 'end']].values,
-                reads[['start', 'end']].values,
-            )
+    elif num_processes > 1:
+        own_pool = multiprocessing.Pool(num_processes)
 
-            segments['chromosome'] = chrom
-            segments['num_obs'] = 1
+        imap_func = own_pool.imap
 
-            segments.to_csv(cna, sep='\t', index=False, header=False,
-                            columns=['chromosome', 'end', 'count', 'num_obs'])
+    else:
+        own_pool = None
 
+        imap_func = map
 
-def write_tumour_baf(baf_filename, normal_filename, tumour_filename):
+    try:
+        with open(baf_filename, 'w') as baf_file:
 
-    with open(baf_filename, 'w') as baf_file:
+            # Chromosomes are computed concurrently but written in order as each becomes available
+            for chrom_baf in imap_func(_get_chromosome_tumour_baf, args):
+                baf_file.write(chrom_baf)
 
-        chromosomes = remixt.seqdataio.read_chromosomes(normal_filename)
+    finally:
+        if own_pool is not None:
+            own_pool.close()
 
-        for chrom in chromosomes:
+            own_pool.join()
 
-            normal_allele_count = remixt.analysis.haplotype.read_snp_counts(normal_filename, chrom)
 
-            remixt.analysis.haplotype.infer_snp_genotype(normal_allele_count)
+def _get_chromosome_tumour_baf(args):
+    normal_filename, tumour_filename, chrom, cache_dir = args
 
-            het_positions = normal_allele_count.loc[normal_allele_count['AB'] == 1, ['position']]
+    normal_allele_count = seqdata.read_snp_counts(normal_filename, chrom, cache_dir=cache_dir)
 
-            tumour_allele_count = remixt.analysis.haplotype.read_snp_counts(tumour_filename, chrom)
-            tumour_allele_count = tumour_allele_count.merge(het_positions)
+    remixt.analysis.haplotype.infer_snp_genotype(normal_allele_count)
 
-            tumour_allele_count['ref_count'] = tumour_allele_count['ref_count'].astype(int)
-            tumour_allele_count['alt_count'] = tumour_allele_count['alt_count'].astype(int)
+    het_positions = normal_allele_count.loc[normal_allele_count['AB'] == 1, 'position'].values
 
-            tumour_allele_count['minor_count'] = np.minimum(
-                tumour_allele_count['ref_count'],
-                tumour_allele_count['alt_count'],
-            )
+    tumour_allele_count = seqdata.read_snp_count_columns(tumour_filename, chrom, cache_dir=cache_dir)
 
-            tumour_allele_count['total_count'] = (
-                tumour_allele_count['ref_count'] +
-                tumour_allele_count['alt_count']
-            )
+    position = np.asarray(tumour_allele_count['position'])
 
-            tumour_allele_count['chromosome'] = chrom
+    # Inner join of tumour counts with het positions, as a merge on position would do. Tumour rows are kept in order,
+    # including rows with duplicate positions, and repeated for duplicate het positions, so neither needs to be sorted
+    # or unique
+    het_positions = np.sort(het_positions)
 
-            tumour_allele_count.to_csv(baf_file, sep='\t', index=False, header=False,
-                                       columns=['chromosome', 'position', 'minor_count', 'total_count'])
+    num_matches = (
+        np.searchsorted(het_positions, position, side='right') -
+        np.searchsorted(het_positions, position, side='left'))
 
+    idx = np.repeat(np.arange(len(position)), num_matches)
 
-def _get_segments(filename):
-    segments = set()
-    with open(filename) as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            fields = line.rstrip().split()
-            segments.add((fields[0], fields[1]))
-    return segments
+    ref_count = np.asarray(tumour_allele_count['ref_count'])[idx].astype(int)
 
+    alt_count = np.asarray(tumour_allele_count['alt_count'])[idx].astype(int)
 
-def _filter_segments(filename, out_filename, segments):
-    with open(filename) as f_in, open(out_filename, 'w') as f_out:
-        for line in f_in:
-            if line.startswith('#'):
-                f_out.write(line)
-                continue
-            fields = line.rstrip().split()
-            if (fields[0], fields[1]) not in segments:
-                continue
-            f_out.write(line)
+    minor_count = np.minimum(ref_count, alt_count)
+
+    total_count = ref_count + alt_count
+
+    lines = []
+
+    for pos, minor, total in zip(position[idx].tolist(), minor_count.tolist(), total_count.tolist()):
+        lines.append('{0}\t{1}\t{2}\t{3}\n'.format(chrom, pos, minor, total))
+
+    return ''.join(lines)
+
+
+def _read_segments(filename, chrom_ids):
+    '''
+    Read the lines of a cloneHD data file, and a key for each data line encoding the chromosome and position.
+
+    Chromosomes are numbered through the shared `chrom_ids` dict so keys are comparable across files.
+    '''
+    with open(filename, 'rb') as f:
+        text = f.read()
+
+    lines = text.splitlines(True)
+
+    chars = np.frombuffer(text, dtype=np.uint8)
+    line_starts = np.concatenate([[0], np.flatnonzero(chars == ord('\n')) + 1])[:len(lines)]
+    is_comment = chars[line_starts] == ord('#')
+
+    if is_comment.all():
+        return lines, is_comment, np.array([], dtype=np.int64)
+
+    data = pd.read_csv(
+        io.BytesIO(text), sep=r'\s+', header=None, comment='#',
+        usecols=[0, 1], names=['chrom', 'pos'],
+        dtype={'chrom': str, 'pos': np.int64})
+
+    codes, chroms = pd.factorize(data['chrom'])
+
+    chrom_idx = np.array([chrom_ids.setdefault(chrom, len(chrom_ids)) for chrom in chroms], dtype=np.int64)
+
+    return lines, is_comment, (chrom_idx[codes] << 32) + data['pos'].values
 
 
 def _intersect_filtered(in_filenames, out_filenames):
-    segments = None
-    for in_filename in in_filenames:
-        if segments is None:
-            segments = _get_segments(in_filename)
-        else:
-            segments = segments.intersection(_get_segments(in_filename))
+    chrom_ids = {}
 
-    for in_filename, out_filename in zip(in_filenames, out_filenames):
-        _filter_segments(in_filename, out_filename, segments)
+    file_segments = [_read_segments(in_filename, chrom_ids) for in_filename in in_filenames]
+
+    is_common = find_common_keys([keys for lines, is_comment, keys in file_segments])
+
+    for out_filename, (lines, is_comment, keys), is_segment in zip(out_filenames, file_segments, is_common):
+        keep = is_comment.copy()
+        keep[~is_comment] = is_segment
+        with open(out_filename, 'wb') as f_out:
+            f_out.writelines(itertools.compress(lines, keep.tolist()))
 
 
 def prepare_data(
@@ -144,10 +177,41 @@ def prepare_data(
 
     chromosome_lengths = read_chromosome_lengths(config['chrom_info_filename'])
 
-    write_cna(normal_cna_filename, normal_filename, chromosome_lengths)
-    write_cna(tumour_cna_filename, tumour_filename, chromosome_lengths)
+    cache_dir = config.get('seqdata_cache_dir')
+
+    cna_args = [
+        ((cna_filename, seqdata_filename, chromosome_lengths), {'cache_dir': cache_dir})
+        for cna_filename, seqdata_filename in (
+            (normal_cna_filename, normal_filename),
+            (tumour_cna_filename, tumour_filename),
+        )
+    ]
+
+    num_processes = config.get('num_processes', 1)
+
+    if num_processes <= 1:
+        for args, kwargs in cna_args:
+            write_cna(*args, **kwargs)
+
+        write_tumour_baf(tumour_baf_filename, normal_filename, tumour_filename, cache_dir=cache_dir)
+
+        return
+
+    # Normal and tumour counts and the BAF chromosomes share one pool of `num_processes` workers
+    pool = multiprocessing.Pool(num_processes)
+
+    try:
+        results = [pool.apply_async(write_cna, args, kwargs) for args, kwargs in cna_args]
+
+        write_tumour_baf(tumour_baf_filename, normal_filename, tumour_filename, cache_dir=cache_dir, pool=pool)
+
+        for result in results:
+            result.get()
+
+    finally:
+        pool.close()
 
-    write_tumour_baf(tumour_baf_filename, normal_filename, tumour_filename)
+        pool.join()
 
 
 def run_clonehd(
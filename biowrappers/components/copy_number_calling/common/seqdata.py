@@ -0,0 +1,286 @@
+'''
+Shared access to remixt seqdata files for the copy number callers.
+
+Per chromosome fragment and SNP count tables are written to a cache directory as one numpy array per column, and
+memory mapped when read back. Each seqdata file is then decoded from HDF5 once, however many tasks or callers use it.
+Cache entries are keyed by the path, modification time and size of the seqdata file so a rewritten file is reread.
+Without a cache directory tables are read directly from the seqdata file and nothing is written. Each process keeps
+the most recently read cached tables mapped, up to `_max_tables`.
+
+The cached columns take about 2.4 times the size of the seqdata files. Entries for seqdata files that have since been
+removed or rewritten are deleted the first time a process adds to the cache directory, and `remove_cache` deletes a
+whole cache directory.
+'''
+from collections import OrderedDict
+
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+
+import remixt.seqdataio
+import remixt.analysis.haplotype
+
+_chromosomes = {}
+
+# Most recently used tables last, at most `_max_tables` are kept
+_tables = OrderedDict()
+
+_max_tables = 128
+
+_cleaned_cache_dirs = set()
+
+_source_filename = 'source.txt'
+
+
+def read_chromosomes(seqdata_filename):
+    """ Read the chromosomes present in a seqdata file.
+
+    :param seqdata_filename: Path of seqdata file.
+
+    """
+    key = _get_file_key(seqdata_filename)
+
+    if key not in _chromosomes:
+        _chromosomes[key] = remixt.seqdataio.read_chromosomes(seqdata_filename)
+
+    return _chromosomes[key]
+
+
+def read_fragment_data(seqdata_filename, chromosome, cache_dir=None):
+    """ Read the fragments of a chromosome from a seqdata file.
+
+    :param seqdata_filename: Path of seqdata file.
+    :param chromosome: Chromosome to read.
+    :param cache_dir: Directory used to cache the columns. If None the seqdata file is read directly.
+
+    Returns a data frame as from `remixt.seqdataio.read_fragment_data`.
+
+    """
+    return pd.DataFrame(read_fragment_columns(seqdata_filename, chromosome, cache_dir=cache_dir))
+
+
+def read_fragment_columns(seqdata_filename, chromosome, cache_dir=None):
+    """ Read the fragments of a chromosome from a seqdata file as a dict of read only column arrays.
+
+    Unlike `read_fragment_data` the arrays are not copied, and are memory mapped if a `cache_dir` is given.
+
+    """
+    return _read_cached_table(
+        seqdata_filename,
+        'fragments',
+        chromosome,
+        lambda: remixt.seqdataio.read_fragment_data(seqdata_filename, chromosome=chromosome),
+        cache_dir=cache_dir)
+
+
+def read_snp_counts(seqdata_filename, chromosome, cache_dir=None):
+    """ Read the ref and alt counts of the SNPs of a chromosome from a seqdata file.
+
+    :param seqdata_filename: Path of seqdata file.
+    :param chromosome: Chromosome to read.
+    :param cache_dir: Directory used to cache the columns. If None the seqdata file is read directly.
+
+    Returns a data frame as from `remixt.analysis.haplotype.read_snp_counts`.
+
+    """
+    return pd.DataFrame(read_snp_count_columns(seqdata_filename, chromosome, cache_dir=cache_dir))
+
+
+def read_snp_count_columns(seqdata_filename, chromosome, cache_dir=None):
+    """ Read the SNP counts of a chromosome from a seqdata file as a dict of read only column arrays.
+
+    Unlike `read_snp_counts` the arrays are not copied, and are memory mapped if a `cache_dir` is given.
+
+    """
+    return _read_cached_table(
+        seqdata_filename,
+        'snp_counts',
+        chromosome,
+        lambda: remixt.analysis.haplotype.read_snp_counts(seqdata_filename, chromosome),
+        cache_dir=cache_dir)
+
+
+def _get_file_key(file_name):
+    file_name = os.path.abspath(file_name)
+
+    stat = os.stat(file_name)
+
+    return (file_name, stat.st_mtime, stat.st_size)
+
+
+def _read_cached_table(seqdata_filename, record_type, chromosome, read_func, cache_dir=None):
+    if cache_dir is None:
+        df = read_func()
+
+        return OrderedDict((col, df[col].values) for col in df.columns)
+
+    file_key = _get_file_key(seqdata_filename)
+
+    key = (file_key, record_type, chromosome, os.path.abspath(cache_dir))
+
+    if key not in _tables:
+        file_dir = os.path.join(cache_dir, hashlib.md5(repr(file_key).encode()).hexdigest())
+
+        table_dir = os.path.join(file_dir, '{0}_{1}'.format(record_type, chromosome))
+
+        if not os.path.exists(table_dir):
+            if os.path.abspath(cache_dir) not in _cleaned_cache_dirs:
+                remove_stale_entries(cache_dir)
+
+                _cleaned_cache_dirs.add(os.path.abspath(cache_dir))
+
+            _write_cached_table(table_dir, read_func())
+
+            _write_source(file_dir, file_key)
+
+        table = _load_cached_table(table_dir)
+
+    else:
+        table = _tables.pop(key)
+
+    _tables[key] = table
+
+    while len(_tables) > _max_tables:
+        _tables.popitem(last=False)
+
+    return table
+
+
+def remove_stale_entries(cache_dir):
+    """ Remove the cache entries of seqdata files that no longer exist or have been rewritten.
+
+    :param cache_dir: Directory used to cache the columns.
+
+    Entries still being written, which have no source recorded yet, are left in place.
+
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    for entry in os.listdir(cache_dir):
+        file_dir = os.path.join(cache_dir, entry)
+
+        source_key = _read_source(file_dir)
+
+        if source_key is None:
+            continue
+
+        try:
+            is_stale = _get_file_key(source_key[0]) != source_key
+
+        except OSError:
+            is_stale = True
+
+        if is_stale:
+            shutil.rmtree(file_dir, ignore_errors=True)
+
+
+def remove_cache(cache_dir):
+    """ Remove a cache directory and all its entries.
+
+    :param cache_dir: Directory used to cache the columns.
+
+    """
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    _cleaned_cache_dirs.discard(os.path.abspath(cache_dir))
+
+    for key in list(_tables.keys()):
+        if key[3] == os.path.abspath(cache_dir):
+            del _tables[key]
+
+
+def _write_source(file_dir, file_key):
+    '''
+    Record the path, modification time and size of the seqdata file of a cache entry, written to a temporary file which
+    is then renamed.
+    '''
+    source_filename = os.path.join(file_dir, _source_filename)
+
+    if os.path.exists(source_filename):
+        return
+
+    fd, tmp_filename = tempfile.mkstemp(dir=file_dir)
+
+    with os.fdopen(fd, 'w') as fh:
+        fh.write('{0}\t{1!r}\t{2}\n'.format(*file_key))
+
+    os.rename(tmp_filename, source_filename)
+
+
+def _read_source(file_dir):
+    try:
+        with open(os.path.join(file_dir, _source_filename)) as fh:
+            file_name, mtime, size = fh.read().rstrip('\n').split('\t')
+
+    except (IOError, OSError, ValueError):
+        return None
+
+    return (file_name, float(mtime), int(size))
+
+
+def _write_cached_table(table_dir, df):
+    '''
+    Write the columns of a data frame as numpy arrays in `table_dir`.
+
+    The arrays are written to a temporary directory which is then renamed, so concurrent tasks never see a partially
+    written table.
+    '''
+    parent_dir = os.path.dirname(table_dir)
+
+    if not os.path.exists(parent_dir):
+        try:
+            os.makedirs(parent_dir)
+
+        except OSError:
+            if not os.path.isdir(parent_dir):
+                raise
+
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir)
+
+    try:
+        for col in df.columns:
+            values = df[col].values
+
+            # Empty tables are created without a dtype
+            if values.dtype == object and len(df) == 0:
+                values = values.astype(np.int64)
+
+            np.save(os.path.join(tmp_dir, '{0}.npy'.format(col)), np.ascontiguousarray(values))
+
+        with open(os.path.join(tmp_dir, 'columns.txt'), 'w') as fh:
+            fh.write('\n'.join(df.columns))
+
+        try:
+            os.rename(tmp_dir, table_dir)
+
+        # Another task cached the same table first
+        except OSError:
+            if not os.path.exists(table_dir):
+                raise
+
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def _load_cached_table(table_dir):
+    with open(os.path.join(table_dir, 'columns.txt')) as fh:
+        columns = [x for x in fh.read().split('\n') if x != '']
+
+    table = OrderedDict()
+
+    for col in columns:
+        file_name = os.path.join(table_dir, '{0}.npy'.format(col))
+
+        try:
+            table[col] = np.load(file_name, mmap_mode='r')
+
+        # Empty arrays cannot be memory mapped
+        except ValueError:
+            table[col] = np.load(file_name)
+
+    return table
@@ -1,10 +1,142 @@
-import itertools
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
-import remixt.analysis.experiment
-import remixt.analysis.pipeline
-import remixt.cn_model
+from biowrappers.components.copy_number_calling.common.utils import SegmentEndIndex
+
+_breakpoint_columns = ['prediction_id', 'chromosome_1', 'strand_1', 'position_1', 'chromosome_2', 'strand_2', 'position_2']
+
+
+def read_breakpoints(breakpoints_filename):
+    """ Read the breakend columns of a table of breakpoints.
+
+    Args:
+        breakpoints_filename (str): filename table of breakpoints in tsv format
+
+    """
+
+    return pd.read_csv(
+        breakpoints_filename, sep='\t', usecols=_breakpoint_columns,
+        converters={'chromosome_1': str, 'chromosome_2': str})
+
+
+def get_allele_copy_number(cn_table):
+    """ Allele copy number of each segment of a copy number table, for a normal clone and each tumour clone.
+
+    Args:
+        cn_table (pandas.DataFrame): table of segment copy number
+
+    Returns:
+        numpy.array: segments by clones by alleles, the first clone being normal
+
+    Clones are read from 'major_*' and 'minor_*' columns if present, giving two alleles with normal copy number 1, otherwise
+    from 'total_*' columns, giving one allele with normal copy number 2.
+
+    """
+
+    if 'major_1' in cn_table:
+        column_templates = ['major_{}', 'minor_{}']
+
+    else:
+        column_templates = ['total_{}']
+
+    N = len(cn_table.index)
+    L = len(column_templates)
+
+    cn = [np.ones((N, L), dtype=int) * (2 // L)]
+
+    while all(template.format(len(cn)) in cn_table for template in column_templates):
+        cn.append(np.array([cn_table[template.format(len(cn))].values for template in column_templates]).T)
+
+    return np.array(cn).swapaxes(0, 1)
+
+
+def create_breakpoint_segment_table(segment_index, breakpoint_data, is_adjacent, max_brk_dist=2000):
+    """ Create a table mapping breakpoints to pairs of segment extremeties.
+
+    Args:
+        segment_index (SegmentEndIndex): index of segment ends
+        breakpoint_data (pandas.DataFrame): genomic breakpoints
+        is_adjacent (numpy.array): segments adjacent in the reference genome to the next segment
+
+    KwArgs:
+        max_brk_dist (int): max total distance from breakends to segment extremeties
+
+    Returns:
+        pandas.DataFrame: table with columns 'prediction_id', 'n_1', 'side_1', 'n_2', 'side_2'
+
+    Breakpoints that look like wild type adjacencies or loop back inversions are removed.
+
+    """
+
+    breakpoint_data = breakpoint_data.sort_values('prediction_id', kind='mergesort')
+
+    n_1, side_1, dist_1 = segment_index.find_closest(
+        breakpoint_data['chromosome_1'].values, breakpoint_data['strand_1'].values, breakpoint_data['position_1'].values)
+
+    n_2, side_2, dist_2 = segment_index.find_closest(
+        breakpoint_data['chromosome_2'].values, breakpoint_data['strand_2'].values, breakpoint_data['position_2'].values)
+
+    is_valid = (n_1 >= 0) & (n_2 >= 0) & (dist_1 + dist_2 <= max_brk_dist)
+
+    prediction_id = breakpoint_data['prediction_id'].values[is_valid]
+    n_1, side_1, n_2, side_2 = n_1[is_valid], side_1[is_valid], n_2[is_valid], side_2[is_valid]
+
+    is_valid = np.ones(len(prediction_id), dtype=bool)
+
+    # Remove small events that look like wild type adjacencies
+    is_valid &= ~((n_2 == n_1 + 1) & (side_1 == 1) & (side_2 == 0) & is_adjacent[n_1])
+    is_valid &= ~((n_1 == n_2 + 1) & (side_2 == 1) & (side_1 == 0) & is_adjacent[n_2])
+
+    # No support for loop back inversions
+    is_valid &= ~((n_1 == n_2) & (side_1 == side_2))
+
+    breakpoint_segment = pd.DataFrame(OrderedDict([
+        ('prediction_id', prediction_id[is_valid]),
+        ('n_1', n_1[is_valid]),
+        ('side_1', side_1[is_valid]),
+        ('n_2', n_2[is_valid]),
+        ('side_2', side_2[is_valid]),
+    ]))
+
+    return breakpoint_segment
+
+
+def decode_breakpoint_copy_number(cn, is_adjacent, breakpoint_segment_data):
+    """ Naive decoding of breakpoint copy number from allele copy number transitions.
+
+    Args:
+        cn (numpy.array): copy number of each segment, clone and allele
+        is_adjacent (numpy.array): segments adjacent in the reference genome to the next segment
+        breakpoint_segment_data (pandas.DataFrame): breakpoint segment mapping
+
+    Returns:
+        numpy.array: copy number of each breakpoint and tumour clone
+
+    The copy number 'flow' at each breakend is taken for each allele, the breakpoint takes the minimum of the flows of
+    its two breakends, and allele flows are summed. The normal clone is dropped.
+
+    """
+
+    breakend_cn = []
+
+    for n, side in (('n_1', 'side_1'), ('n_2', 'side_2')):
+        n = breakpoint_segment_data[n].values
+        side = breakpoint_segment_data[side].values
+
+        # Segment adjacent to the breakend side in the reference genome, if any
+        n_adj = np.where(side == 1, n + 1, n - 1)
+        has_adj = np.where(side == 1, is_adjacent[n], is_adjacent[np.maximum(n - 1, 0)] & (n > 0))
+
+        cn_adj = np.where(has_adj[:, np.newaxis, np.newaxis], cn[np.where(has_adj, n_adj, n)], 0)
+
+        # Copy number 'flow' at the breakend
+        breakend_cn.append(np.maximum(cn[n] - cn_adj, 0))
+
+    brk_cn = np.minimum(breakend_cn[0], breakend_cn[1]).sum(axis=-1)
+
+    return brk_cn[:, 1:]
 
 
 def calculate_breakpoint_copy_number(breakpoints_filename, cn_table, max_brk_dist=2000, max_seg_gap=int(3e6)):
@@ -20,33 +152,23 @@ def calculate_breakpoint_copy_number(breakpoints_filename, cn_table, max_brk_dis
 
     """
 
-    N = len(cn_table.index)
+    cn = get_allele_copy_number(cn_table)
 
-    if 'major_1' in cn_table:
-        cn = [np.ones((N, 2), dtype=int)]
-        for m in itertools.count(1):
-            try:
-                cn.append(cn_table[['major_{}'.format(m), 'minor_{}'.format(m)]].values)
-            except KeyError:
-                break
-        cn = np.array(cn).swapaxes(0, 1)
+    brk_cn_columns = ['cn_{}'.format(m) for m in range(1, cn.shape[1])]
 
-    else:
-        cn = [np.ones((N, 1), dtype=int) * 2]
-        for m in itertools.count(1):
-            try:
-                cn.append(cn_table[['total_{}'.format(m)]].values)
-            except KeyError:
-                break
-        cn = np.array(cn).swapaxes(0, 1)
-
-    adjacencies = remixt.analysis.experiment.get_wild_type_adjacencies(cn_table, max_seg_gap)
-    breakpoint_data = pd.read_csv(breakpoints_filename, sep='\t', converters={'chromosome_1': str, 'chromosome_2': str})
-    breakpoint_segment_data = remixt.analysis.experiment.create_breakpoint_segment_table(
-        cn_table, breakpoint_data, adjacencies, max_brk_dist=max_brk_dist)
-    breakpoints = remixt.analysis.experiment.convert_breakpoints_to_dict(breakpoint_segment_data)
-
-    brk_cn = remixt.cn_model.decode_breakpoints_naive(cn, adjacencies, breakpoints)
-    brk_cn_table = remixt.analysis.experiment.create_brk_cn_table(brk_cn, breakpoint_segment_data)
+    segment_index = SegmentEndIndex(cn_table)
+    is_adjacent = segment_index.get_adjacent_next(max_seg_gap)
+
+    breakpoint_data = read_breakpoints(breakpoints_filename)
+    breakpoint_segment_data = create_breakpoint_segment_table(
+        segment_index, breakpoint_data, is_adjacent, max_brk_dist=max_brk_dist)
+
+    if len(breakpoint_segment_data.index) == 0:
+        return pd.DataFrame(columns=['prediction_id'] + brk_cn_columns)
+
+    brk_cn = decode_breakpoint_copy_number(cn, is_adjacent, breakpoint_segment_data)
+
+    brk_cn_table = pd.DataFrame(brk_cn, columns=brk_cn_columns)
+    brk_cn_table.insert(0, 'prediction_id', breakpoint_segment_data['prediction_id'].values)
 
     return brk_cn_table
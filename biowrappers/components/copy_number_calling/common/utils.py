@@ -1,29 +1,254 @@
+from collections import OrderedDict
+
+import multiprocessing
+import numpy as np
 import pandas as pd
-import remixt.seqdataio
-import remixt.analysis.haplotype
+
+import biowrappers.components.copy_number_calling.common.seqdata as seqdata
 
 
-def calculate_allele_counts(seqdata_filename):
+def calculate_allele_counts(seqdata_filename, chromosomes=None, cache_dir=None, num_processes=1):
     """ Calculate allele counts from seqdata.
+
+    :param seqdata_filename: Path of seqdata file.
+    :param chromosomes: Chromosomes to read, all chromosomes in the file if None.
+    :param cache_dir: Directory used to cache seqdata columns.
+    :param num_processes: Number of processes reading chromosomes in parallel.
+
+    Returns a table with columns 'position', 'ref_count', 'alt_count' and a categorical 'chromosome', with categories in
+    chromosome order.
+
     """
-    allele_counts = [pd.DataFrame(columns = ["position", "ref_count", "alt_count", "chromosome"])]
+    if chromosomes is None:
+        chromosomes = seqdata.read_chromosomes(seqdata_filename)
+
+    chromosomes = list(chromosomes)
 
-    chromosomes = remixt.seqdataio.read_chromosomes(seqdata_filename)
+    args = [(seqdata_filename, chrom, cache_dir) for chrom in chromosomes]
 
-    for chrom in chromosomes:
-        chrom_allele_counts = remixt.analysis.haplotype.read_snp_counts(seqdata_filename, chrom)
-        chrom_allele_counts['chromosome'] = chrom
-        allele_counts.append(chrom_allele_counts)
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+
+        map_func = pool.map
 
-    if len(allele_counts) > 0:
-        allele_counts = pd.concat(allele_counts, ignore_index=True)
     else:
-        allele_counts = pd.DataFrame()
+        pool = None
+
+        map_func = map
+
+    try:
+        chrom_counts = list(map_func(_read_chromosome_allele_counts, args))
+
+    finally:
+        if pool is not None:
+            pool.close()
+
+            pool.join()
 
-    allele_counts['ref_count'] = allele_counts['ref_count'].astype(int)
-    allele_counts['alt_count'] = allele_counts['alt_count'].astype(int)
-    allele_counts['position'] = allele_counts['position'].astype(int)
+    num_rows = sum(len(counts['position']) for counts in chrom_counts)
+
+    position = np.empty(num_rows, dtype=np.int64)
+    ref_count = np.empty(num_rows, dtype=np.int64)
+    alt_count = np.empty(num_rows, dtype=np.int64)
+    chromosome_code = np.empty(num_rows, dtype=np.int32)
+
+    offset = 0
+
+    for code, counts in enumerate(chrom_counts):
+        end = offset + len(counts['position'])
+
+        position[offset:end] = counts['position']
+        ref_count[offset:end] = counts['ref_count']
+        alt_count[offset:end] = counts['alt_count']
+        chromosome_code[offset:end] = code
+
+        offset = end
+
+    allele_counts = pd.DataFrame(OrderedDict([
+        ('position', position),
+        ('ref_count', ref_count),
+        ('alt_count', alt_count),
+        ('chromosome', pd.Categorical.from_codes(chromosome_code, categories=chromosomes)),
+    ]))
 
     return allele_counts
 
 
+def _read_chromosome_allele_counts(args):
+    seqdata_filename, chrom, cache_dir = args
+
+    counts = seqdata.read_snp_count_columns(seqdata_filename, chrom, cache_dir=cache_dir)
+
+    # Memory mapped columns are copied when returned from a worker process
+    return OrderedDict((col, counts[col]) for col in ('position', 'ref_count', 'alt_count'))
+
+
+def intersect_allele_counts(*allele_counts):
+    """ Restrict allele count tables to the positions present in all of them.
+
+    :param allele_counts: Tables with 'chromosome' and 'position' columns.
+
+    Returns a list of the tables each filtered to the common positions, rows keep their order.
+
+    """
+    chrom_ids = {}
+
+    keys = [_get_position_keys(data, chrom_ids) for data in allele_counts]
+
+    return [data[is_common].reset_index(drop=True) for data, is_common in zip(allele_counts, find_common_keys(keys))]
+
+
+def find_common_keys(keys):
+    """ Find the keys present in every one of a list of integer key arrays.
+
+    :param keys: List of arrays of integer keys.
+
+    Returns a boolean array for each key array, true for keys present in all arrays. Keys are intersected as sorted
+    arrays rather than sets.
+
+    """
+    common_keys = None
+
+    for values in keys:
+        values = _sorted_unique(values)
+
+        if common_keys is None:
+            common_keys = values
+
+        else:
+            common_keys = np.intersect1d(common_keys, values, assume_unique=True)
+
+    is_common = []
+
+    for values in keys:
+        if len(common_keys) == 0:
+            is_common.append(np.zeros(len(values), dtype=bool))
+
+        else:
+            idx = np.minimum(np.searchsorted(common_keys, values), len(common_keys) - 1)
+
+            is_common.append(common_keys[idx] == values)
+
+    return is_common
+
+
+def _sorted_unique(values):
+    values = np.sort(values)
+
+    is_first = np.ones(len(values), dtype=bool)
+    is_first[1:] = values[1:] != values[:-1]
+
+    return values[is_first]
+
+
+def _get_position_keys(data, chrom_ids):
+    '''
+    Encode chromosome and position as a single integer, with chromosomes numbered through the shared `chrom_ids` dict.
+    '''
+    codes, chroms = pd.factorize(data['chromosome'])
+
+    chrom_idx = np.array([chrom_ids.setdefault(str(chrom), len(chrom_ids)) for chrom in chroms], dtype=np.int64)
+
+    return (chrom_idx[codes] << 32) + data['position'].values.astype(np.int64)
+
+
+def calculate_bin_counts(start, end, chrom_length, bin_size=1000):
+    """ Count the fragments contained in each fixed width bin of a chromosome.
+
+    Bin i covers [i * bin_size, (i + 1) * bin_size] inclusive, matching `remixt.segalg.contained_counts` on segments
+    tiling the chromosome. Fragments are assigned to bins arithmetically so they do not need to be sorted.
+    """
+    start = np.asarray(start, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+
+    num_bins = -(-chrom_length // bin_size)
+
+    # Index of the first bin whose end is at or after the position
+    start_bin = np.maximum((start + bin_size - 1) // bin_size - 1, 0)
+    end_bin = np.maximum((end + bin_size - 1) // bin_size - 1, 0)
+
+    contained = (start_bin == end_bin) & (end_bin < num_bins)
+
+    return np.bincount(start_bin[contained], minlength=num_bins)
+
+
+def iter_bin_counts(seqdata_filename, chromosome_lengths, bin_size=1000, cache_dir=None):
+    """ Iterate over (chromosome, bin counts) for the chromosomes of a seqdata file.
+    """
+    for chrom in seqdata.read_chromosomes(seqdata_filename):
+        fragments = seqdata.read_fragment_columns(seqdata_filename, chrom, cache_dir=cache_dir)
+
+        yield chrom, calculate_bin_counts(fragments['start'], fragments['end'], chromosome_lengths[chrom], bin_size)
+
+
+class SegmentEndIndex(object):
+    '''
+    Index of the segment ends of a copy number table, for finding the segment end closest to each of a batch of
+    breakends.
+
+    Segments are referred to by their position in the table. Starts of segments are matched to breakends on the - strand
+    and ends of segments to breakends on the + strand, with sorted arrays of positions per chromosome and strand.
+    '''
+
+    def __init__(self, segment_data):
+        self.chromosome = segment_data['chromosome'].astype(str).values
+        self.start = segment_data['start'].values
+        self.end = segment_data['end'].values
+
+        self._segment_ends = {}
+
+        for chromosome in np.unique(self.chromosome):
+            segment_idx = np.flatnonzero(self.chromosome == chromosome)
+
+            for strand, side, positions in (('-', 0, self.start), ('+', 1, self.end)):
+                order = np.argsort(positions[segment_idx], kind='mergesort')
+
+                self._segment_ends[(chromosome, strand)] = (positions[segment_idx][order], segment_idx[order], side)
+
+    def __len__(self):
+        return len(self.chromosome)
+
+    def get_adjacent_next(self, max_seg_gap):
+        '''
+        Get a boolean array, true for segments adjacent in the reference genome to the following segment.
+        '''
+        is_adjacent = np.zeros(len(self), dtype=bool)
+
+        is_adjacent[:-1] = (
+            (self.chromosome[:-1] == self.chromosome[1:]) &
+            (self.start[1:] - self.end[:-1] <= max_seg_gap))
+
+        return is_adjacent
+
+    def find_closest(self, chromosomes, strands, positions):
+        '''
+        Find the segment end closest to each breakend.
+
+        Returns arrays of segment index, segment side (0 for start, 1 for end) and distance. The segment index is -1 for
+        breakends on chromosomes or strands without segments.
+        '''
+        chromosomes = np.asarray(chromosomes).astype(str)
+        strands = np.asarray(strands)
+        positions = np.asarray(positions)
+
+        segment_idx = np.full(len(positions), -1, dtype=np.int64)
+        segment_side = np.zeros(len(positions), dtype=np.int64)
+        dist = np.zeros(len(positions), dtype=np.int64)
+
+        for (chromosome, strand), (end_positions, end_segment_idx, side) in self._segment_ends.items():
+            query = np.flatnonzero((chromosomes == chromosome) & (strands == strand))
+
+            if len(query) == 0:
+                continue
+
+            right_idx = np.minimum(np.searchsorted(end_positions, positions[query]), len(end_positions) - 1)
+            left_idx = np.maximum(right_idx - 1, 0)
+
+            left_dist = np.abs(positions[query] - end_positions[left_idx])
+            right_dist = np.abs(end_positions[right_idx] - positions[query])
+
+            segment_idx[query] = end_segment_idx[np.where(left_dist < right_dist, left_idx, right_idx)]
+            segment_side[query] = side
+            dist[query] = np.minimum(left_dist, right_dist)
+
+        return segment_idx, segment_side, dist
@@ -4,29 +4,13 @@ import pandas as pd
 import subprocess32
 
 import pypeliner.commandline
-import remixt.seqdataio
-import remixt.analysis.haplotype
 
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+from biowrappers.components.copy_number_calling.common.utils import calculate_allele_counts, intersect_allele_counts
+import biowrappers.components.copy_number_calling.common.seqdata as seqdata
 import biowrappers.components.utils as utils
 
 
-def calculate_allele_counts(seqdata_filename, chromosomes=None):
-    allele_counts = list()
-
-    if chromosomes is None:
-        chromosomes = remixt.seqdataio.read_chromosomes(seqdata_filename)
-
-    for chrom in chromosomes:
-        chrom_allele_counts = remixt.analysis.haplotype.read_snp_counts(seqdata_filename, chrom)
-        chrom_allele_counts['chromosome'] = chrom
-        allele_counts.append(chrom_allele_counts)
-
-    allele_counts = pd.concat(allele_counts, ignore_index=True)
-
-    return allele_counts
-
-
 def write_theta_format_alleles(allele_filename, allele_count):
     allele_count = allele_count[[
         'chromosome',
@@ -51,7 +35,7 @@ def run_bicseq2_norm(prefix, seqdata_filename, config, tmp_directory):
     fragment_means = []
     counts = []
     for chromosome in config['chromosomes']:
-        chrom_reads = remixt.seqdataio.read_fragment_data(seqdata_filename, chromosome=chromosome)
+        chrom_reads = seqdata.read_fragment_data(seqdata_filename, chromosome, cache_dir=config.get('seqdata_cache_dir'))
 
         fragment_means.append((chrom_reads['end'] - chrom_reads['start']).mean())
         counts.append(len(chrom_reads.index))
@@ -172,16 +156,16 @@ def run_theta(output_filename, normal_filename, tumour_filename, bicseq2_seg_fil
     normal_allele_filename = os.path.join(tmp_directory, 'normal_alleles.tsv')
     tumour_allele_filename = os.path.join(tmp_directory, 'tumour_alleles.tsv')
 
-    normal_allele_count = calculate_allele_counts(normal_filename, chromosomes=config['chromosomes'])
-    tumour_allele_count = calculate_allele_counts(tumour_filename, chromosomes=config['chromosomes'])
+    cache_dir = config.get('seqdata_cache_dir')
+
+    num_processes = config.get('num_processes', 1)
 
-    positions = pd.merge(
-        normal_allele_count[['chromosome', 'position']].drop_duplicates(),
-        tumour_allele_count[['chromosome', 'position']].drop_duplicates(),
-        how='inner')
+    normal_allele_count = calculate_allele_counts(
+        normal_filename, chromosomes=config['chromosomes'], cache_dir=cache_dir, num_processes=num_processes)
+    tumour_allele_count = calculate_allele_counts(
+        tumour_filename, chromosomes=config['chromosomes'], cache_dir=cache_dir, num_processes=num_processes)
 
-    normal_allele_count = normal_allele_count.merge(positions, how='inner')
-    tumour_allele_count = tumour_allele_count.merge(positions, how='inner')
+    normal_allele_count, tumour_allele_count = intersect_allele_counts(normal_allele_count, tumour_allele_count)
 
     write_theta_format_alleles(normal_allele_filename, normal_allele_count)
     write_theta_format_alleles(tumour_allele_filename, tumour_allele_count)
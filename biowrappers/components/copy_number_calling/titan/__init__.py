@@ -73,20 +73,25 @@ def create_titan_workflow(
         args=(config,),
     )
 
+    # If `sweep_cache_dir` is set sweep results are cached there and kept after the workflow finishes so reruns skip
+    # finished runs. Remove the directory with `tasks.remove_sweep_cache` once the results are no longer needed.
     workflow.transform(
-        name='run_titan',
-        axes=('sample_id', 'init_param_id'),
-        ctx={'mem': 16, 'num_retry': 3, 'mem_retry_increment': 4},
-        func=tasks.run_titan,
+        name='run_titan_sweep',
+        axes=('sample_id',),
+        ctx={'mem': 16 * config.get('num_processes', 1), 'num_retry': 3, 'mem_retry_increment': 4},
+        func=tasks.run_titan_sweep,
         args=(
             pypeliner.managed.TempInputObj('init_params', 'sample_id', 'init_param_id'),
             pypeliner.managed.TempInputFile('normal.wig'),
             pypeliner.managed.TempInputFile('tumour.wig', 'sample_id'),
             pypeliner.managed.TempInputFile('tumour_alleles.tsv', 'sample_id'),
-            pypeliner.managed.TempOutputFile('cn.tsv', 'sample_id', 'init_param_id'),
-            pypeliner.managed.TempOutputFile('params.tsv', 'sample_id', 'init_param_id'),
+            pypeliner.managed.TempOutputFile('cn.tsv', 'sample_id', 'titan_run_id'),
+            pypeliner.managed.TempOutputFile('params.tsv', 'sample_id', 'titan_run_id', axes_origin=[]),
             config,
         ),
+        kwargs={
+            'cache_dir': config.get('sweep_cache_dir'),
+        },
     )
 
     if somatic_breakpoint_file is not None:
@@ -99,8 +104,8 @@ def create_titan_workflow(
         func=tasks.select_solution,
         args=(
             pypeliner.managed.TempInputObj('init_params', 'sample_id', 'init_param_id'),
-            pypeliner.managed.TempInputFile('cn.tsv', 'sample_id', 'init_param_id'),
-            pypeliner.managed.TempInputFile('params.tsv', 'sample_id', 'init_param_id'),
+            pypeliner.managed.TempInputFile('cn.tsv', 'sample_id', 'titan_run_id'),
+            pypeliner.managed.TempInputFile('params.tsv', 'sample_id', 'titan_run_id'),
             pypeliner.managed.OutputFile('results', 'sample_id', template=results_files),
             pypeliner.managed.OutputFile(os.path.join(raw_data_dir, 'output', '{sample_id}_cn_loci.tsv'), 'sample_id'),
             pypeliner.managed.OutputFile(
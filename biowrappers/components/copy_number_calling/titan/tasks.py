@@ -1,14 +1,19 @@
+from collections import OrderedDict
+
+import hashlib
 import itertools
+import multiprocessing
 import numpy as np
+import os
 import pandas as pd
 import pypeliner
-import remixt.seqdataio
-import remixt.segalg
 import remixt.analysis.haplotype
 import shutil
+import tempfile
 
+import biowrappers.components.copy_number_calling.common.seqdata as seqdata
 from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
-from biowrappers.components.copy_number_calling.common.utils import calculate_allele_counts
+from biowrappers.components.copy_number_calling.common.utils import calculate_allele_counts, intersect_allele_counts, iter_bin_counts
 
 
 def read_chromosome_lengths(chrom_info_filename):
@@ -20,44 +25,22 @@ def read_chromosome_lengths(chrom_info_filename):
     return chrom_info.set_index('chrom')['length']
 
 
-def create_segments(chrom_length, segment_length=1000):
-
-    seg_start = np.arange(0, chrom_length, segment_length)
-    seg_end = seg_start + segment_length
-
-    segments = np.array([seg_start, seg_end]).T
-
-    return segments
-
-
-def write_segment_count_wig(wig_filename, seqdata_filename, chromosome_lengths, segment_length=1000):
+def write_segment_count_wig(wig_filename, seqdata_filename, chromosome_lengths, segment_length=1000, cache_dir=None,
+                            chunk_size=int(1e5)):
 
     with open(wig_filename, 'w') as wig:
 
-        chromosomes = remixt.seqdataio.read_chromosomes(seqdata_filename)
-
-        for chrom in chromosomes:
+        for chrom, seg_count in iter_bin_counts(seqdata_filename, chromosome_lengths, segment_length, cache_dir=cache_dir):
 
             wig.write('fixedStep chrom={0} start=1 step={1} span={1}\n'.format(chrom, segment_length))
 
-            chrom_reads = remixt.seqdataio.read_fragment_data(seqdata_filename, chromosome=chrom)
-
-            chrom_reads.sort_values('start', inplace=True)
-
-            chrom_segments = create_segments(chromosome_lengths[chrom], segment_length)
-
-            seg_count = remixt.segalg.contained_counts(
-                chrom_segments,
-                chrom_reads[['start', 'end']].values,
-            )
-
-            wig.write('\n'.join([str(c) for c in seg_count]))
-            wig.write('\n')
+            for beg in range(0, len(seg_count), chunk_size):
+                wig.write(''.join(['{0}\n'.format(c) for c in seg_count[beg:beg + chunk_size].tolist()]))
 
 
-def infer_het_positions(seqdata_filename):
+def infer_het_positions(seqdata_filename, cache_dir=None, num_processes=1):
 
-    allele_count = calculate_allele_counts(seqdata_filename)
+    allele_count = calculate_allele_counts(seqdata_filename, cache_dir=cache_dir, num_processes=num_processes)
 
     if not allele_count.empty:
         remixt.analysis.haplotype.infer_snp_genotype(allele_count)
@@ -100,24 +83,127 @@ def read_titan_params(params_filename):
 
     params = dict()
 
+    for key, value in _read_titan_params_fields(params_filename).items():
+        params[key] = np.array(value.split()).astype(float)
+
+    return params
+
+
+def read_titan_params_table(params_filenames, num_clusters):
+    """ Read the model selection statistics of a set of TITAN runs into one table
+
+    :param params_filenames: dict of TITAN params filenames keyed by run
+    :param num_clusters: dict of the number of clonal clusters of each run keyed by run
+
+    Returns a table indexed by run with columns `model_selection_index`, `norm_contam_est` and
+    `cell_prev_est_{i}` for each cluster, with NaN for clusters beyond the number in a run.
+
+    """
+
+    index = sorted(params_filenames)
+
+    model_selection_index = np.zeros(len(index))
+
+    norm_contam_est = np.zeros(len(index))
+
+    cell_prev_est = np.full((len(index), max(int(num_clusters[x]) for x in index)), np.nan)
+
+    for i, idx in enumerate(index):
+        params = _read_titan_params_fields(params_filenames[idx])
+
+        model_selection_index[i] = float(params['S_Dbw validity index (Both)'].split()[0])
+
+        norm_contam_est[i] = float(params['Normal contamination estimate'].split()[0])
+
+        cell_prev = params['Clonal cluster cellular prevalence Z={0}'.format(int(num_clusters[idx]))].split()
+
+        cell_prev_est[i, :len(cell_prev)] = [float(x) for x in cell_prev]
+
+    table = pd.DataFrame(
+        {'model_selection_index': model_selection_index, 'norm_contam_est': norm_contam_est},
+        index=index,
+        columns=['model_selection_index', 'norm_contam_est'])
+
+    for j in range(cell_prev_est.shape[1]):
+        table['cell_prev_est_{0}'.format(j + 1)] = cell_prev_est[:, j]
+
+    return table
+
+
+def _read_titan_params_fields(params_filename):
+    '''
+    Read the unparsed value of each field of a TITAN params file.
+    '''
+    params = dict()
+
     with open(params_filename, 'r') as params_file:
-        for line in params_file:
-            key, value = line.split(':')
-            params[key] = np.array(value.split()).astype(float)
+        for line in params_file.read().splitlines():
+            if line.strip() == '':
+                continue
+
+            key, value = line.split(':', 1)
+
+            params[key] = value
 
     return params
 
 
+def calculate_mixtures(params_table, convert_output=False):
+    """ Calculate the mixture of each TITAN run in a params table
+
+    :param params_table: table with `num_clusters`, `norm_contam_est` and `cell_prev_est_{i}` columns
+    :param convert_output: convert cellular prevalences of nested clones to clone fractions, only valid for up to 2
+        clonal clusters
+
+    Returns an array with a row for each run, the normal fraction followed by a fraction for each cluster, padded
+    with NaN.
+
+    """
+
+    n = params_table['norm_contam_est'].values
+
+    num_clusters = params_table['num_clusters'].values.astype(int)
+
+    prev_cols = [x for x in params_table.columns if x.startswith('cell_prev_est_')]
+
+    prev_cols = sorted(prev_cols, key=lambda x: int(x[len('cell_prev_est_'):]))
+
+    cell_prev = params_table[prev_cols].values
+
+    if not convert_output:
+        return np.column_stack([n, cell_prev])
+
+    mix = np.full((len(n), 3), np.nan)
+
+    mix[:, 0] = n
+
+    one = (num_clusters == 1)
+
+    mix[one, 1] = (1 - n[one]) * cell_prev[one, 0]
+
+    two = (num_clusters == 2)
+
+    if two.any():
+        mix[two, 1] = (1 - n[two]) * cell_prev[two, 1]
+
+        mix[two, 2] = (1 - n[two]) * np.abs(cell_prev[two, 0] - cell_prev[two, 1])
+
+    return mix
+
+
 def prepare_normal_data(normal_filename, normal_wig_filename, het_positions_filename, config):
     """ Prepare normal count data and infer het positions
     """
 
     chromosome_lengths = read_chromosome_lengths(config['chrom_info_filename'])
 
+    cache_dir = config.get('seqdata_cache_dir')
+
     write_segment_count_wig(
-        normal_wig_filename, normal_filename, chromosome_lengths, segment_length=config['window_size'])
+        normal_wig_filename, normal_filename, chromosome_lengths, segment_length=config['window_size'],
+        cache_dir=cache_dir)
 
-    het_positions = infer_het_positions(normal_filename)
+    het_positions = infer_het_positions(normal_filename, cache_dir=cache_dir, num_processes=config.get('num_processes', 1))
     het_positions.to_csv(het_positions_filename, sep='\t', index=False)
 
 
@@ -127,12 +213,19 @@ def prepare_tumour_data(tumour_filename, het_positions_filename, tumour_wig_file
 
     chromosome_lengths = read_chromosome_lengths(config['chrom_info_filename'])
 
+    cache_dir = config.get('seqdata_cache_dir')
+
     write_segment_count_wig(
-        tumour_wig_filename, tumour_filename, chromosome_lengths, segment_length=config['window_size'])
+        tumour_wig_filename, tumour_filename, chromosome_lengths, segment_length=config['window_size'],
+        cache_dir=cache_dir)
 
     het_positions = pd.read_csv(het_positions_filename, sep='\t', converters={'chromosome': str, 'alt_count': int, 'ref_count': int})
 
-    tumour_allele_count = calculate_allele_counts(tumour_filename).merge(het_positions)
+    tumour_allele_count = calculate_allele_counts(
+        tumour_filename, cache_dir=cache_dir, num_processes=config.get('num_processes', 1))
+
+    tumour_allele_count, _ = intersect_allele_counts(tumour_allele_count, het_positions)
+
     write_titan_format_alleles(tumour_allele_filename, tumour_allele_count)
 
 
@@ -172,17 +265,17 @@ def run_titan(init_params, normal_wig_filename, tumour_wig_filename,
     """
 
     titan_cmd = [
-        'run_titan.R',
+        _titan_script,
         tumour_allele_filename,
         normal_wig_filename,
         tumour_wig_filename,
         cn_filename,
         params_filename,
-        '--estimate_clonal_prevalence',
-        '--estimate_normal_contamination',
-        '--estimate_ploidy',
-        '--max_copy_number', str(config.get('max_copy_number', 5)),
-        '--max_depth', str(config.get('max_depth', int(1e4))),
+    ]
+
+    titan_cmd += _get_titan_options(config)
+
+    titan_cmd += [
         '--normal_contamination', str(init_params['normal_contamination']),
         '--num_clusters', str(init_params['num_clusters']),
         '--ploidy', str(init_params['ploidy']),
@@ -193,6 +286,282 @@ def run_titan(init_params, normal_wig_filename, tumour_wig_filename,
     pypeliner.commandline.execute(*titan_cmd)
 
 
+_titan_script = 'run_titan.R'
+
+# Change when the TITAN script or the way it is run changes, so cached sweep results are not reused
+_titan_cache_version = '1'
+
+_sweep_source_filename = 'source.txt'
+
+
+def _get_titan_options(config):
+    '''
+    Options passed to TITAN that are the same for every run of a sweep, other than input files.
+    '''
+    return [
+        '--estimate_clonal_prevalence',
+        '--estimate_normal_contamination',
+        '--estimate_ploidy',
+        '--max_copy_number', str(config.get('max_copy_number', 5)),
+        '--max_depth', str(config.get('max_depth', int(1e4))),
+    ]
+
+
+def run_titan_sweep(init_params, normal_wig_filename, tumour_wig_filename, tumour_allele_filename,
+                    cn_filenames, params_filenames, config, cache_dir=None):
+    """ Run the parameter sweep for a sample through a local process pool
+
+    :param init_params: dict of initialization parameters, keyed by sweep index
+    :param cn_filenames: output copy number filenames, keyed by sweep index
+    :param params_filenames: output parameter filenames, keyed by sweep index
+    :param cache_dir: optional directory where each run's results are cached, keyed by a hash of the inputs and the
+        initialization parameters, so reruns and overlapping sweeps skip finished runs. No caching if None.
+
+    Each cached run holds the TITAN copy number and parameter files, so a cached sweep takes about as much disk space
+    as its outputs. Outputs are hard linked to the cached files where the file system allows and copied otherwise.
+    Cached sweeps of earlier inputs of the same sample are removed when a sweep of new inputs starts, and
+    `remove_sweep_cache` deletes a whole cache directory.
+
+    The number of concurrent runs is set by `num_processes` in `config`. If `sweep_keep_top` is set the sweep is
+    adaptive: one run per (num_clusters, ploidy) setting is done first, and only the settings with the `sweep_keep_top`
+    lowest S_Dbw validity indices are run with the remaining normal contamination values.
+
+    Outputs are only written for the runs that were done.
+
+    """
+
+    input_key = None
+
+    if cache_dir is not None:
+        input_key = _get_titan_input_key(
+            [normal_wig_filename, tumour_wig_filename, tumour_allele_filename],
+            [config['gc_wig'], config['mappability_wig']],
+            config)
+
+        _add_sweep_cache_entry(cache_dir, input_key, tumour_allele_filename)
+
+    def get_run_args(idx):
+        return (
+            init_params[idx],
+            normal_wig_filename,
+            tumour_wig_filename,
+            tumour_allele_filename,
+            cn_filenames[idx],
+            params_filenames[idx],
+            config,
+            input_key,
+            cache_dir,
+        )
+
+    num_processes = config.get('num_processes', 1)
+
+    keep_top = config.get('sweep_keep_top', None)
+
+    # Restarts of each setting differ only in normal contamination
+    settings = OrderedDict()
+
+    for idx in sorted(init_params):
+        key = (init_params[idx]['num_clusters'], init_params[idx]['ploidy'])
+
+        settings.setdefault(key, []).append(idx)
+
+    if keep_top is None:
+        run_ids = sorted(init_params)
+
+    else:
+        run_ids = [x[0] for x in settings.values()]
+
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+
+        map_func = pool.map
+
+    else:
+        pool = None
+
+        map_func = map
+
+    try:
+        scores = dict(zip(run_ids, map_func(_run_titan_cached, [get_run_args(idx) for idx in run_ids])))
+
+        if keep_top is not None:
+            # Settings whose first run has no S_Dbw index are ranked last
+            ranked = sorted(settings, key=lambda x: _get_score_rank_key(scores[settings[x][0]]))
+
+            run_ids = [idx for key in ranked[:keep_top] for idx in settings[key][1:]]
+
+            list(map_func(_run_titan_cached, [get_run_args(idx) for idx in run_ids]))
+
+    finally:
+        if pool is not None:
+            pool.close()
+
+            pool.join()
+
+
+def _get_score_rank_key(score):
+    is_missing = score is None or np.isnan(score)
+
+    return (is_missing, 0. if is_missing else score)
+
+
+def _run_titan_cached(args):
+    '''
+    Run TITAN for one set of initialization parameters, reusing cached results if present, and return the S_Dbw
+    validity index of the solution.
+    '''
+    (init_params, normal_wig_filename, tumour_wig_filename, tumour_allele_filename,
+     cn_filename, params_filename, config, input_key, cache_dir) = args
+
+    if cache_dir is None:
+        run_titan(init_params, normal_wig_filename, tumour_wig_filename, tumour_allele_filename,
+                  cn_filename, params_filename, config)
+
+    else:
+        params_key = ','.join('{0}={1}'.format(x, init_params[x]) for x in sorted(init_params))
+
+        run_dir = os.path.join(cache_dir, input_key, hashlib.md5(params_key.encode()).hexdigest())
+
+        if not os.path.exists(run_dir):
+            _run_titan_into_cache(
+                run_dir, init_params, normal_wig_filename, tumour_wig_filename, tumour_allele_filename, config)
+
+        _link_or_copy(os.path.join(run_dir, 'cn.tsv'), cn_filename)
+
+        _link_or_copy(os.path.join(run_dir, 'params.tsv'), params_filename)
+
+    return read_titan_params(params_filename)['S_Dbw validity index (Both)'][0]
+
+
+def _link_or_copy(src_filename, dst_filename):
+    '''
+    Hard link a cached file to an output, or copy it if the two are on different file systems.
+    '''
+    if os.path.lexists(dst_filename):
+        os.remove(dst_filename)
+
+    try:
+        os.link(src_filename, dst_filename)
+
+    except OSError:
+        shutil.copyfile(src_filename, dst_filename)
+
+
+def _add_sweep_cache_entry(cache_dir, input_key, source_filename):
+    '''
+    Create the cache directory of the sweeps of an input, recording the tumour allele file it was created for. Entries
+    of earlier inputs recorded with the same tumour allele file are removed first.
+    '''
+    input_dir = os.path.join(cache_dir, input_key)
+
+    if os.path.exists(os.path.join(input_dir, _sweep_source_filename)):
+        return
+
+    source_filename = os.path.abspath(source_filename)
+
+    remove_stale_sweep_entries(cache_dir, source_filename)
+
+    try:
+        os.makedirs(input_dir)
+
+    except OSError:
+        if not os.path.isdir(input_dir):
+            raise
+
+    fd, tmp_filename = tempfile.mkstemp(dir=input_dir)
+
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(source_filename + '\n')
+
+    os.rename(tmp_filename, os.path.join(input_dir, _sweep_source_filename))
+
+
+def remove_stale_sweep_entries(cache_dir, source_filename):
+    """ Remove the cached sweeps of a sample's earlier inputs.
+
+    :param cache_dir: directory used to cache the sweep results
+    :param source_filename: tumour allele file of the sample
+
+    Entries with no tumour allele file recorded yet are left in place.
+
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    for entry in os.listdir(cache_dir):
+        entry_source_filename = os.path.join(cache_dir, entry, _sweep_source_filename)
+
+        if not os.path.exists(entry_source_filename):
+            continue
+
+        with open(entry_source_filename, 'r') as fh:
+            if fh.read().rstrip('\n') != source_filename:
+                continue
+
+        shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+
+def remove_sweep_cache(cache_dir):
+    """ Remove a sweep cache directory and all its entries.
+
+    :param cache_dir: directory used to cache the sweep results
+
+    """
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _run_titan_into_cache(run_dir, init_params, normal_wig_filename, tumour_wig_filename, tumour_allele_filename,
+                          config):
+    parent_dir = os.path.dirname(run_dir)
+
+    if not os.path.exists(parent_dir):
+        try:
+            os.makedirs(parent_dir)
+
+        except OSError:
+            if not os.path.isdir(parent_dir):
+                raise
+
+    # Results are moved into place once complete so a failed run is never cached
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir)
+
+    try:
+        run_titan(init_params, normal_wig_filename, tumour_wig_filename, tumour_allele_filename,
+                  os.path.join(tmp_dir, 'cn.tsv'), os.path.join(tmp_dir, 'params.tsv'), config)
+
+        try:
+            os.rename(tmp_dir, run_dir)
+
+        except OSError:
+            if not os.path.exists(run_dir):
+                raise
+
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+
+def _get_titan_input_key(file_names, ref_file_names, config, block_size=2 ** 20):
+    '''
+    Hash the contents of the per sample input files, the path, modification time and size of the shared reference
+    files, the TITAN script and options as passed by `run_titan` other than the initialization parameters, and the
+    cache version. Reference files such as the GC and mappability WIGs are large, so they are not read.
+    '''
+    md5 = hashlib.md5()
+
+    for file_name in file_names:
+        with open(file_name, 'rb') as fh:
+            for block in iter(lambda: fh.read(block_size), b''):
+                md5.update(block)
+
+    for file_name in ref_file_names:
+        md5.update('\t'.join(str(x) for x in seqdata._get_file_key(file_name)).encode())
+
+    md5.update('\t'.join([_titan_cache_version, _titan_script] + _get_titan_options(config)).encode())
+
+    return md5.hexdigest()
+
+
 def select_solution(
     init_params,
     cn_filename,
@@ -212,41 +581,27 @@ def select_solution(
 
     init_params = pd.DataFrame.from_dict(init_params, orient='index')
 
-    for init_param_idx, row in init_params.iterrows():
-        titan_params_filename = params_filename[init_param_idx]
-
-        titan_params = read_titan_params(titan_params_filename)
+    # Runs pruned from an adaptive sweep have no output
+    init_params = init_params.loc[sorted(x for x in init_params.index if x in params_filename)]
 
-        init_params.loc[init_param_idx, 'model_selection_index'] = titan_params['S_Dbw validity index (Both)'][0]
-        init_params.loc[init_param_idx, 'norm_contam_est'] = titan_params['Normal contamination estimate'][0]
+    params_table = read_titan_params_table(params_filename, init_params['num_clusters'].to_dict())
 
-        cell_prev_field = 'Clonal cluster cellular prevalence Z={0}'.format(int(row['num_clusters']))
-        for idx, cell_prev in enumerate(titan_params[cell_prev_field]):
-            init_params.loc[init_param_idx, 'cell_prev_est_{0}'.format(idx + 1)] = cell_prev
+    init_params = pd.concat([init_params, params_table], axis=1)
 
-    best_idx = init_params['model_selection_index'].argmin()
+    convert_output = config.get('convert_output', False)
 
-    if config.get('convert_output', False):
-        n = init_params.loc[best_idx, 'norm_contam_est']
+    mixtures = calculate_mixtures(init_params, convert_output=convert_output)
 
-        if init_params.loc[best_idx, 'num_clusters'] == 1:
-            t_1 = init_params.loc[best_idx, 'cell_prev_est_1']
+    best_pos = np.nanargmin(init_params['model_selection_index'].values)
 
-            mix = [n, (1 - n) * t_1]
+    best_idx = init_params.index[best_pos]
 
-        elif init_params.loc[best_idx, 'num_clusters'] == 2:
-            t_1 = init_params.loc[best_idx, 'cell_prev_est_1']
-            t_2 = init_params.loc[best_idx, 'cell_prev_est_2']
+    num_clusters = int(init_params['num_clusters'].iloc[best_pos])
 
-            mix = [n, (1 - n) * t_2, (1 - n) * abs(t_1 - t_2)]
+    if convert_output and num_clusters > 2:
+        raise ValueError('Unable to convert output for more than 2 clonal clusters')
 
-        elif init_params.loc[best_idx, 'num_clusters'] > 2:
-            raise ValueError('Unable to convert output for more than 2 clonal clusters')
-
-    else:
-        mix = [init_params.loc[best_idx, 'norm_contam_est'], ]
-        for i in range(int(init_params.loc[best_idx, 'num_clusters'])):
-            mix.append(init_params.loc[best_idx, 'cell_prev_est_{0}'.format(i + 1)])
+    mix = list(mixtures[best_pos, :num_clusters + 1])
 
     shutil.copyfile(params_filename[best_idx], output_params_filename)
 
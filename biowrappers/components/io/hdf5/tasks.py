@@ -3,11 +3,20 @@ Created on Nov 4, 2015
 
 @author: Andrew Roth
 '''
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import gzip
+import logging
+import multiprocessing
+import multiprocessing.queues
+import numpy as np
+import os
 import pandas as pd
 import re
+import shutil
+import tempfile
+import time
+import traceback
 
 from biowrappers.components.utils import flatten_input
 from pandas.api.types import CategoricalDtype
@@ -17,12 +26,20 @@ def concatenate_tables(
     out_file,
     drop_duplicates=False,
     in_memory=True,
-    non_numeric_as_category=True
+    non_numeric_as_category=True,
+    chunksize=int(1e5),
+    num_partitions=64
 ):
+    '''
+    Concatenate the tables of a list of HDFStores.
+
+    If `in_memory` is false tables are streamed in chunks of `chunksize` rows. Duplicates are then dropped out of core
+    by hash partitioning rows into `num_partitions` temporary partitions, so memory is bounded by the partition size.
+    Rows keep their input order, as in the in memory case.
+    '''
     in_files = flatten_input(in_files)
 
-    # Only support drop duplicatess in memory
-    if drop_duplicates or in_memory:
+    if in_memory:
         _concatenate_tables_in_memory(
             in_files,
             out_file,
@@ -34,7 +51,10 @@ def concatenate_tables(
         _concatenate_tables_on_disk(
             in_files,
             out_file,
-            non_numeric_as_category=non_numeric_as_category
+            drop_duplicates=drop_duplicates,
+            non_numeric_as_category=non_numeric_as_category,
+            chunksize=chunksize,
+            num_partitions=num_partitions
         )
 
 
@@ -89,115 +109,340 @@ def _concatenate_tables_in_memory(
     out_store.close()
 
 
-def _concatenate_tables_on_disk(in_files, out_file, non_numeric_as_category=True):
+def _concatenate_tables_on_disk(
+    in_files,
+    out_file,
+    drop_duplicates=False,
+    non_numeric_as_category=True,
+    chunksize=int(1e5),
+    num_partitions=64
+):
+    '''
+    Concatenate tables by streaming chunks of rows, so memory use is bounded by `chunksize` rather than the number of
+    inputs.
+
+    Chunks are buffered until `chunksize` rows are available before being appended. The table index is created with the
+    first append and updated by each later one, as building it once all rows are written needs memory in proportion to
+    the output table. If `drop_duplicates` is set rows are first appended, with their ordinal in the input, to hash
+    partitions in a temporary store. Duplicate rows land in the same partition, so each partition is deduplicated
+    independently into a mask of kept ordinals, one byte per row. The partitions are then merged on the ordinal to write
+    the kept rows in input order.
+    '''
+    column_values, table_layouts = _get_column_values(in_files, chunksize=chunksize)
+
     if non_numeric_as_category:
-        col_categories = _get_column_categories(in_files)
+        col_categories = _get_column_categories(column_values)
 
     else:
-        min_itemsize = _get_min_itemsize(in_files)
+        min_itemsize = _get_min_itemsize(column_values)
 
     out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
 
-    table_columns = defaultdict(set)
+    tmp_dir = None
 
-    for file_name in in_files:
-        in_store = pd.HDFStore(file_name, 'r')
+    partition_store = None
 
-        for table_name in _iter_table_names(in_store):
-            df = in_store[table_name]
+    table_columns = {}
 
-            table_columns[table_name].update(df.columns)
+    buffers = defaultdict(list)
 
-            if df.empty:
-                continue
+    num_rows = defaultdict(int)
 
-            non_numeric_cols = _get_non_numeric_columns(df)
+    def append(store, key, table_name, df, index=False):
+        if non_numeric_as_category:
+            store.append(key, df, format='table', index=index)
 
-            if non_numeric_as_category:
-                for col in non_numeric_cols:
-                    if df[col].dtype.name == 'category':
-                        df[col] = df[col].cat.set_categories(col_categories[table_name][col])
+        else:
+            store.append(key, df, min_itemsize=min_itemsize[table_name], format='table', index=index)
 
-                    else:
-                        df[col] = df[col].astype(CategoricalDtype(categories=col_categories[table_name][col]))
+    def flush(table_name):
+        if len(buffers[table_name]) == 0:
+            return
 
-                out_store.append(table_name, df, format='table')
+        df = pd.concat(buffers[table_name])
 
-            else:
-                for col in non_numeric_cols:
-                    df[col] = df[col].astype(str)
+        del buffers[table_name][:]
 
-                out_store.append(table_name, df, min_itemsize=min_itemsize[table_name], format='table')
+        if drop_duplicates:
+            partitions = pd.util.hash_pandas_object(df, index=False).values % num_partitions
+
+            df[_row_ordinal_col] = np.arange(num_rows[table_name], num_rows[table_name] + len(df))
+
+            num_rows[table_name] += len(df)
+
+            for idx, partition_df in df.groupby(partitions):
+                append(partition_store, _get_partition_key(table_name, idx), table_name, partition_df)
+
+        else:
+            append(out_store, table_name, table_name, df, index=True)
+
+    try:
+        if drop_duplicates:
+            tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_file)))
+
+            partition_store = pd.HDFStore(os.path.join(tmp_dir, 'partitions.h5'), 'w')
+
+        for file_name in in_files:
+            in_store = pd.HDFStore(file_name, 'r')
+
+            try:
+                for table_name, is_table, table_rows in table_layouts[file_name]:
+                    for df in _iter_table_chunks(in_store, table_name, is_table, table_rows, chunksize):
+                        if table_name not in table_columns:
+                            table_columns[table_name] = df.columns
+
+                        if df.empty:
+                            continue
+
+                        non_numeric_cols = _get_non_numeric_columns(df)
+
+                        if non_numeric_as_category:
+                            for col in non_numeric_cols:
+                                if df[col].dtype.name == 'category':
+                                    df[col] = df[col].cat.set_categories(col_categories[table_name][col])
+
+                                else:
+                                    categories = col_categories[table_name][col]
+
+                                    df[col] = df[col].astype(CategoricalDtype(categories=categories))
+
+                        else:
+                            for col in non_numeric_cols:
+                                df[col] = df[col].astype(str)
+
+                        buffers[table_name].append(df)
+
+                        if sum([x.shape[0] for x in buffers[table_name]]) >= chunksize:
+                            flush(table_name)
+
+            finally:
+                in_store.close()
 
         for table_name, columns in table_columns.items():
-            out_store.append(table_name, pd.DataFrame(columns=columns), format='table')
+            flush(table_name)
 
-        in_store.close()
+            if drop_duplicates:
+                keys = [_get_partition_key(table_name, idx) for idx in range(num_partitions)]
 
-    out_store.close()
+                keys = [key for key in keys if key in partition_store]
+
+                is_kept = np.zeros(num_rows[table_name], dtype=bool)
+
+                # Partition rows are in input order, so the first of each set of duplicates is kept
+                for key in keys:
+                    df = partition_store[key]
+
+                    is_kept[df[_row_ordinal_col].values[~df.duplicated(subset=list(columns)).values]] = True
+
+                read_size = max(chunksize // max(len(keys), 1), 1)
+
+                for df in _merge_partitions(partition_store, keys, is_kept, read_size, chunksize):
+                    append(out_store, table_name, table_name, df, index=True)
+
+            # Tables with no rows in any input are written empty, as in the in memory case
+            if table_name not in out_store:
+                out_store.put(table_name, pd.DataFrame(columns=columns))
 
+    finally:
+        out_store.close()
 
-def _get_min_itemsize(file_list):
+        if partition_store is not None:
+            partition_store.close()
+
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+_row_ordinal_col = '_concatenate_row_ordinal'
+
+
+def _merge_partitions(store, keys, is_kept, read_size, chunksize):
     '''
-    Get the minimum string size for all columns in a list of tables from a list of HDFStores.
+    Merge partitions of a table, each sorted by row ordinal, into chunks of at least `chunksize` rows in ordinal order.
+    Only rows whose ordinal is set in `is_kept` are returned, and the ordinal column is removed.
+
+    Partitions are read `read_size` rows at a time. Rows up to the smallest last ordinal of the chunks currently read
+    are taken, as no unread row can precede them.
     '''
+    iters = [_iter_table_slices(store, key, read_size) for key in keys]
 
-    min_sizes = {}
+    chunks = [next(x, None) for x in iters]
 
-    for file_name in file_list:
-        hdf_store = pd.HDFStore(file_name, 'r')
+    merged = []
 
-        for table_name in _iter_table_names(hdf_store):
-            if table_name not in min_sizes:
-                min_sizes[table_name] = {}
+    while True:
+        active = [idx for idx, chunk in enumerate(chunks) if chunk is not None]
 
-            df = hdf_store[table_name]
+        if len(active) == 0:
+            break
 
-            if df.empty:
-                continue
+        bound = min([chunks[idx][_row_ordinal_col].values[-1] for idx in active])
 
-            for col in _get_non_numeric_columns(df):
-                df[col] = df[col].astype(str)
+        ready = []
 
-                size = max(8, df[col].str.len().max())
+        for idx in active:
+            ordinals = chunks[idx][_row_ordinal_col].values
 
-                if (col not in min_sizes[table_name]) or (size > min_sizes[table_name][col]):
-                    min_sizes[table_name][col] = size
+            is_ready = ordinals <= bound
 
-        hdf_store.close()
+            is_written = is_ready & is_kept[ordinals]
 
-    return min_sizes
+            if is_written.any():
+                ready.append(chunks[idx][is_written])
+
+            chunks[idx] = chunks[idx][~is_ready]
 
+            if chunks[idx].empty:
+                chunks[idx] = next(iters[idx], None)
 
-def _get_column_categories(file_list):
+        # Many small frames are combined as they are taken to limit the per frame overhead
+        if len(ready) > 0:
+            merged.append(pd.concat(ready))
+
+        if sum([x.shape[0] for x in merged]) >= chunksize:
+            yield _sort_merged(merged)
+
+            merged = []
+
+    if sum([x.shape[0] for x in merged]) > 0:
+        yield _sort_merged(merged)
+
+
+def _iter_table_slices(store, key, read_size):
     '''
-    Find the union set of categories for each column across tables.
+    Iterate over a table in slices of rows, read by row range rather than through a chunked select, which first reads
+    the coordinates of every row.
     '''
+    num_rows = store.get_storer(key).nrows
 
-    categories = {}
+    for start in range(0, num_rows, read_size):
+        yield store.select(key, start=start, stop=start + read_size)
+
+
+def _sort_merged(merged):
+    df = pd.concat(merged).sort_values(_row_ordinal_col, kind='mergesort')
+
+    return df.drop(_row_ordinal_col, axis=1)
+
+
+def _get_partition_key(table_name, partition):
+    return '/partition_{0}/{1}'.format(partition, table_name.lstrip('/'))
+
+
+def _iter_table_chunks(store, table_name, is_table, num_rows, chunksize):
+    '''
+    Iterate over a table in chunks of rows. Tables in fixed format cannot be read partially and are read whole.
+    '''
+
+    if is_table and num_rows > 0:
+        for df in store.select(table_name, chunksize=chunksize):
+            yield df
+
+    else:
+        yield store[table_name]
+
+
+def _get_column_values(file_list, chunksize=int(1e5)):
+    '''
+    Find the union set of values of the non-numeric columns of each table in a list of HDFStores.
+
+    For tables in table format the categories of categorical columns are taken from the table meta data, and only the
+    other non-numeric columns are read from disk.
+
+    Also returns the (table name, is table format, number of rows) of the tables of each file, so later passes over
+    the files do not need to read the table meta data again.
+    '''
+
+    values = {}
+
+    table_layouts = OrderedDict()
 
     for file_name in file_list:
         hdf_store = pd.HDFStore(file_name, 'r')
 
-        for table_name in _iter_table_names(hdf_store):
-            if table_name not in categories:
-                categories[table_name] = {}
+        catalogue = TableCatalogue(hdf_store)
 
-            df = hdf_store[table_name]
+        table_layouts[file_name] = []
 
-            if df.empty:
-                continue
+        for table_name in catalogue.table_names:
+            if table_name not in values:
+                values[table_name] = {}
 
-            for col in _get_non_numeric_columns(df):
-                df[col] = df[col].astype('category')
+            table_info = catalogue.get_table_info(hdf_store, table_name)
 
-                if col not in categories[table_name]:
-                    categories[table_name][col] = set()
+            table_layouts[file_name].append((table_name, table_info.is_table, table_info.num_rows))
 
-                categories[table_name][col].update(set(df[col].cat.categories))
+            if table_info.is_table:
+                if table_info.num_rows == 0:
+                    continue
+
+                df = table_info.empty_df
+
+                _update_column_values(values[table_name], df)
+
+                string_cols = [x for x in _get_non_numeric_columns(df) if df[x].dtype.name != 'category']
+
+                if len(string_cols) > 0:
+                    chunks = hdf_store.select(table_name, columns=string_cols, chunksize=chunksize)
+
+                else:
+                    chunks = []
+
+            else:
+                chunks = [hdf_store[table_name], ]
+
+            for df in chunks:
+                if df.empty:
+                    continue
+
+                _update_column_values(values[table_name], df)
 
         hdf_store.close()
 
+    return values, table_layouts
+
+
+def _update_column_values(values, df):
+    for col in _get_non_numeric_columns(df):
+        if col not in values:
+            values[col] = set()
+
+        if df[col].dtype.name == 'category':
+            values[col].update(df[col].cat.categories)
+
+        else:
+            values[col].update(df[col].dropna().unique())
+
+
+def _get_min_itemsize(column_values):
+    '''
+    Get the minimum string size for all non-numeric columns from the output of `_get_column_values`.
+    '''
+
+    min_sizes = {}
+
+    for table_name in column_values:
+        min_sizes[table_name] = {}
+
+        for col, values in column_values[table_name].items():
+            min_sizes[table_name][col] = max([8, ] + [len(str(x)) for x in values])
+
+    return min_sizes
+
+
+def _get_column_categories(column_values):
+    '''
+    Get the sorted union set of categories for each non-numeric column from the output of `_get_column_values`.
+    '''
+
+    categories = {}
+
+    for table_name in column_values:
+        categories[table_name] = {}
+
+        for col, values in column_values[table_name].items():
+            categories[table_name][col] = sorted(values, key=str)
+
     return categories
 
 
@@ -206,7 +451,7 @@ def _get_non_numeric_columns(df):
     Find the set of non-numeric (int, float, complex) columns in a table.
     '''
 
-    return df.select_dtypes(exclude=[pd.np.number, ]).columns
+    return df.select_dtypes(exclude=[np.number, ]).columns
 
 
 def _iter_table_names(store):
@@ -214,28 +459,105 @@ def _iter_table_names(store):
     Returns an iterator over all non-metadata tables in Pandas HDFStore.
     '''
 
-    meta_data_tables = _get_meta_data_tables(store)
+    return iter(get_table_catalogue(store).table_names)
 
-    for table_name in store.keys():
-        if table_name in meta_data_tables:
-            continue
 
-        yield table_name
+_meta_data_table_re = re.compile('.*/meta/.*/meta$')
+
+
+_table_catalogues = OrderedDict()
+
+_max_table_catalogues = 256
+
+
+def get_table_catalogue(store):
+    '''
+    Get the `TableCatalogue` of an HDFStore opened for reading, cached by file path, modification time and size.
+
+    Only the most recently used `_max_table_catalogues` catalogues are kept, so the cache does not grow with the number
+    of files read by a process.
+    '''
+
+    file_name = os.path.abspath(store.filename)
+
+    stat = os.stat(file_name)
+
+    key = (file_name, stat.st_mtime, stat.st_size)
+
+    if key in _table_catalogues:
+        catalogue = _table_catalogues.pop(key)
+
+    else:
+        catalogue = TableCatalogue(store)
+
+    _table_catalogues[key] = catalogue
+
+    while len(_table_catalogues) > _max_table_catalogues:
+        _table_catalogues.popitem(last=False)
+
+    return catalogue
+
+
+class TableCatalogue(object):
+    '''
+    Catalogue of the non-metadata tables in a pandas HDFStore.
 
+    Table names are found in a single pass over the store keys. Row counts and column dtypes are read from the table
+    meta data the first time they are requested, without reading the table data.
+    '''
+
+    def __init__(self, store):
+        self.table_names = [x for x in store.keys() if _meta_data_table_re.search(x) is None]
+
+        self._table_info = {}
+
+    def get_table_info(self, store, table_name):
+        if table_name not in self._table_info:
+            self._table_info[table_name] = TableInfo(store, table_name)
 
-def _get_meta_data_tables(store):
+        return self._table_info[table_name]
+
+
+class TableInfo(object):
     '''
-    Find all tables in and HDFStore which are pandas meta-data tables.
+    Format, row count and column dtypes of a table in an HDFStore.
     '''
 
-    meta_tables = set()
+    def __init__(self, store, table_name):
+        storer = store.get_storer(table_name)
 
-    for table_name in store.keys():
-        for meta_table_name in store.keys():
-            if (re.search('.*/meta/.*/meta$', meta_table_name) is not None) and meta_table_name.startswith(table_name):
-                meta_tables.add(meta_table_name)
+        self.name = table_name
 
-    return meta_tables
+        self.is_table = storer.is_table
+
+        if storer.is_table:
+            self.num_rows = storer.nrows
+
+        else:
+            # Fixed format frames store the index as axis1, empty arrays only have their shape stored as an attribute
+            node = storer.group.axis1 if 'axis1' in storer.group else storer.group.index
+
+            self.num_rows = int(getattr(node._v_attrs, 'shape', node.shape)[0])
+
+        self.empty_df = store.select(table_name, start=0, stop=0)
+
+    @property
+    def dtypes(self):
+        return self.empty_df.dtypes
+
+    @property
+    def categories(self):
+        '''
+        Dictionary of categories of the categorical columns.
+        '''
+
+        categories = {}
+
+        for col, dtype in self.dtypes.items():
+            if dtype.name == 'category':
+                categories[col] = list(dtype.categories)
+
+        return categories
 
 
 def convert_hdf5_to_tsv(in_file, key, out_file, compress=False, index=False):
@@ -255,26 +577,145 @@ def convert_hdf5_to_tsv(in_file, key, out_file, compress=False, index=False):
         df.to_csv(fh, index=index, sep='\t')
 
 
-def merge_hdf5(in_files, out_file, table_names='{}'):
+def merge_hdf5(in_files, out_file, table_names='{}', num_processes=1, max_queued_tables=8):
     '''
     Merge pandas HDF5 tables
+
+    :param in_files: dict of HDF5 files, keys are used to format `table_names`.
+    :param out_file: path of merged HDF5 file.
+    :param table_names: template for the group of the tables of each input file.
+    :param num_processes: number of worker processes reading input files. If greater than one tables are read
+        concurrently and sent to a single writer over a queue holding at most `max_queued_tables` tables.
     '''
 
-    out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+    if num_processes > 1:
+        tables = _iter_merge_tables_parallel(in_files, table_names, num_processes, max_queued_tables)
 
-    for file_key, file_name in in_files.items():
-        in_store = pd.HDFStore(file_name, 'r')
+    else:
+        tables = _iter_merge_tables(in_files, table_names)
 
-        # Compatability with dictionary keyed by single or multiple values
-        if not isinstance(file_key, tuple):
-            file_key = (file_key,)
+    out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
 
-        for table_name in _iter_table_names(in_store):
-            df = in_store[table_name]
+    try:
+        for out_table_name, df, read_time in tables:
+            start = time.time()
 
             # Workaround: currently cannot store empty dataframe in table format
             format = 'table'
             if len(df.index) == 0:
                 format = None
 
-            out_store.put(table_names.format(*file_key) + '/' + table_name, df, format=format)
+            out_store.put(out_table_name, df, format=format)
+
+            logging.getLogger(__name__).info('merged table {0} with {1} rows, read {2:.2f}s, write {3:.2f}s'.format(
+                out_table_name, len(df.index), read_time, time.time() - start))
+
+    finally:
+        out_store.close()
+
+
+def _read_merge_tables(file_key, file_name, table_names):
+    '''
+    Iterate over (output table name, table, read time) for the tables in an input of `merge_hdf5`.
+    '''
+
+    # Compatability with dictionary keyed by single or multiple values
+    if not isinstance(file_key, tuple):
+        file_key = (file_key,)
+
+    in_store = pd.HDFStore(file_name, 'r')
+
+    try:
+        for table_name in _iter_table_names(in_store):
+            start = time.time()
+
+            df = in_store[table_name]
+
+            yield table_names.format(*file_key) + '/' + table_name, df, time.time() - start
+
+    finally:
+        in_store.close()
+
+
+def _iter_merge_tables(in_files, table_names):
+    for file_key, file_name in in_files.items():
+        for table in _read_merge_tables(file_key, file_name, table_names):
+            yield table
+
+
+def _iter_merge_tables_parallel(in_files, table_names, num_processes, max_queued_tables, poll_interval=10):
+    '''
+    Iterate over the tables of `merge_hdf5` read by `num_processes` worker processes.
+
+    Workers send None once they have no more inputs. The result queue is polled every `poll_interval` seconds, and
+    an error is raised if a worker exited without sending None, for instance because it was killed.
+    '''
+
+    task_queue = multiprocessing.Queue()
+
+    for file_key, file_name in in_files.items():
+        task_queue.put((file_key, file_name))
+
+    for _ in range(num_processes):
+        task_queue.put(None)
+
+    result_queue = multiprocessing.Queue(max_queued_tables)
+
+    workers = []
+
+    for _ in range(num_processes):
+        worker = multiprocessing.Process(target=_merge_hdf5_worker, args=(task_queue, result_queue, table_names))
+
+        worker.daemon = True
+
+        worker.start()
+
+        workers.append(worker)
+
+    try:
+        num_running = num_processes
+
+        while num_running > 0:
+            # Workers that have already exited have flushed everything they sent to the queue
+            num_exited = sum(not worker.is_alive() for worker in workers)
+
+            try:
+                result = result_queue.get(timeout=poll_interval)
+
+            except multiprocessing.queues.Empty:
+                if num_exited > num_processes - num_running:
+                    raise RuntimeError('merge worker exited without finishing, exit codes {0}'.format(
+                        [worker.exitcode for worker in workers]))
+
+                continue
+
+            if result is None:
+                num_running -= 1
+
+            elif isinstance(result, Exception):
+                raise result
+
+            else:
+                yield result
+
+        for worker in workers:
+            worker.join()
+
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+                worker.join()
+
+
+def _merge_hdf5_worker(task_queue, result_queue, table_names):
+    try:
+        for file_key, file_name in iter(task_queue.get, None):
+            for table in _read_merge_tables(file_key, file_name, table_names):
+                result_queue.put(table)
+
+    except Exception:
+        result_queue.put(RuntimeError(traceback.format_exc()))
+
+    result_queue.put(None)
@@ -5,36 +5,87 @@ Created on Nov 20, 2015
 '''
 from collections import namedtuple
 
-import csv
+import heapq
+import itertools
+import multiprocessing
+import os
 import pysam
+import shutil
+import tempfile
 
 from biowrappers.components.utils import flatten_input
 
 chrom_map = {'X': 23, 'Y': 24, 'M': 25, 'MT': 25}
 
 
-def merge_vcfs(in_files, out_file):
-    in_files = flatten_input(in_files)
+def merge_vcfs(in_files, out_file, num_processes=1):
+    '''
+    Merge the positions of multiple VCF files into a sites only VCF, removing duplicate records.
 
-    with open(out_file, 'w') as out_fh:
-        write_header(out_fh)
+    :param in_files: VCF files to merge, should be bgzip compressed and tabix indexed.
+    :param out_file: Path where merged VCF will be written.
+    :param num_processes: Number of worker processes. If greater than one each chromosome is merged in a separate
+        process and the per chromosome outputs are concatenated in chromosome order.
+    '''
+    in_files = flatten_input(in_files)
 
-        writer = csv.DictWriter(out_fh, ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO'], delimiter='\t')
+    reader = MultiVcfReader(in_files)
 
-        reader = MultiVcfReader(in_files)
+    if num_processes <= 1:
+        with open(out_file, 'w') as out_fh:
+            write_header(out_fh)
 
-        for row in reader:
-            writer.writerow({'CHROM': row.chrom,
-                             'POS': row.coord,
-                             'ID': '.',
-                             'REF': row.ref,
-                             'ALT': row.alt,
-                             'QUAL': '.',
-                             'FILTER': '.',
-                             'INFO': '.'})
+            write_records(out_fh, reader)
 
         reader.close()
 
+        return
+
+    chroms = reader.chroms
+
+    reader.close()
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_file)))
+
+    try:
+        tmp_files = [os.path.join(tmp_dir, '{0}.txt'.format(i)) for i in range(len(chroms))]
+
+        pool = multiprocessing.Pool(num_processes)
+
+        try:
+            pool.map(_merge_chrom, [(in_files, chrom, f) for chrom, f in zip(chroms, tmp_files)])
+
+        finally:
+            pool.close()
+
+            pool.join()
+
+        with open(out_file, 'w') as out_fh:
+            write_header(out_fh)
+
+            for file_name in tmp_files:
+                with open(file_name) as in_fh:
+                    shutil.copyfileobj(in_fh, out_fh)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _merge_chrom(args):
+    in_files, chrom, out_file = args
+
+    reader = MultiVcfReader(in_files)
+
+    with open(out_file, 'w') as out_fh:
+        write_records(out_fh, reader.fetch(chrom))
+
+    reader.close()
+
+
+def write_records(fh, records):
+    for record in records:
+        fh.write('{0}\t{1}\t.\t{2}\t{3}\t.\t.\t.\n'.format(record.chrom, record.coord, record.ref, record.alt))
+
 
 def get_chrom_order(chrom):
     '''
@@ -57,6 +108,30 @@ def get_chrom_order(chrom):
     return chrom
 
 
+_chrom_sort_keys = {}
+
+
+def get_chrom_sort_key(chrom):
+    '''
+    Cached sort key for a chromosome name, ordering numeric chromosomes before named ones.
+    '''
+    try:
+        return _chrom_sort_keys[chrom]
+
+    except KeyError:
+        order = get_chrom_order(chrom)
+
+        if isinstance(order, int):
+            key = (0, order, '')
+
+        else:
+            key = (1, 0, order)
+
+        _chrom_sort_keys[chrom] = key
+
+        return key
+
+
 def write_header(fh):
     fh.write('##fileformat=VCFv4.1\n')
 
@@ -83,32 +158,23 @@ class MultiVcfReader(object):
 
     def __iter__(self):
         for chrom in self.chroms:
-            active_iters = self._load_iters(chrom)
-
-            while len(active_iters) > 0:
-                pos_buffer = set()
-
-                min_coord = min([x.record.coord for x in active_iters])
+            for record in self.fetch(chrom):
+                yield record
 
-                new_active_iters = []
-
-                for chrom_iter in active_iters:
-                    while chrom_iter.coord == min_coord:
-                        record = chrom_iter.record
-
-                        # Handles multiple alt alleles.
-                        for alt in record.alt.split(','):
-                            pos_buffer.add(LightVCFRecord(record.chrom, record.coord, record.ref, alt))
-
-                        chrom_iter.buffer_next_record()
+    def fetch(self, chrom):
+        '''
+        Iterate over the unique records of a chromosome in (coord, ref, alt) order.
 
-                    if chrom_iter.active:
-                        new_active_iters.append(chrom_iter)
+        Each input is a sorted stream so the streams are merged with a heap, and duplicates are adjacent in the merged
+        stream so they can be dropped as they are seen.
+        '''
+        prev_key = None
 
-                for record in sorted(pos_buffer, key=lambda x: (get_chrom_order(x.chrom), x.coord, x.ref, x.alt)):
-                    yield record
+        for key in heapq.merge(*self._load_iters(chrom)):
+            if key != prev_key:
+                yield LightVCFRecord(chrom, *key)
 
-                active_iters = new_active_iters
+                prev_key = key
 
     def close(self):
         for reader in self._readers:
@@ -124,7 +190,7 @@ class MultiVcfReader(object):
         for reader in self._readers:
             chroms.update(set(reader.contigs))
 
-        return sorted(chroms, key=lambda x: get_chrom_order(x))
+        return sorted(chroms, key=get_chrom_sort_key)
 
     def _load_iters(self, chrom):
         iters = []
@@ -136,31 +202,23 @@ class MultiVcfReader(object):
             except (KeyError, ValueError):
                 continue
 
-            iters.append(BufferedChromIter(chrom_iter))
+            iters.append(_iter_sorted_alleles(chrom_iter))
 
         return iters
 
 
-class BufferedChromIter(object):
-
-    def __init__(self, chrom_iter):
-        self._iter = chrom_iter
-
-        self.active = True
-
-        self.buffer_next_record()
-
-    def buffer_next_record(self):
-        try:
-            record = self._iter.next()
-
-            self.record = LightVCFRecord(record.contig, record.pos + 1, record.ref, record.alt)
-
-            self.coord = self.record.coord
+def _iter_sorted_alleles(chrom_iter):
+    '''
+    Iterate over (coord, ref, alt) tuples of a position sorted VCF iterator, with multiple alt alleles split out.
 
-        except StopIteration:
-            self.active = False
+    Records sharing a position are sorted so the stream is fully ordered and can be merged with a heap.
+    '''
+    for pos, records in itertools.groupby(chrom_iter, key=lambda x: x.pos):
+        alleles = set()
 
-            self.record = None
+        for record in records:
+            for alt in record.alt.split(','):
+                alleles.add((record.ref, alt))
 
-            self.coord = None
+        for ref, alt in sorted(alleles):
+            yield (pos + 1, ref, alt)
@@ -0,0 +1,182 @@
+'''
+Lightweight parsing of raw VCF text.
+
+These helpers work directly on the tab delimited lines of a VCF file and avoid building PyVCF record objects, which
+dominates the cost of reading large files.
+'''
+from collections import OrderedDict
+
+import gzip
+import itertools
+
+import numpy as np
+
+
+def open_vcf(file_name):
+    '''
+    Open a plain or gzip/bgzip compressed VCF file for reading as text.
+    '''
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rt')
+
+    return open(file_name)
+
+
+def read_header(file_name):
+    '''
+    Get the column names from the `#CHROM` header line of a VCF file.
+    '''
+    with open_vcf(file_name) as fh:
+        for line in fh:
+            if line.startswith('#CHROM'):
+                return line[1:].rstrip('\n').split('\t')
+
+            if not line.startswith('#'):
+                break
+
+    raise ValueError('No #CHROM header line found in {0}'.format(file_name))
+
+
+def read_record_batches(file_name, batch_size=100000, num_fields=None):
+    '''
+    Iterate over the data lines of a VCF file in batches.
+
+    :param file_name: Path of VCF file, optionally gzip compressed.
+    :param batch_size: Maximum number of records per batch.
+    :param num_fields: Only split out the first `num_fields` columns. The remainder of the line is left unsplit in the
+        final element, which avoids splitting sample columns that are not needed.
+
+    Yields lists of records, each record being the list of tab separated fields.
+    '''
+    max_split = -1 if num_fields is None else num_fields
+
+    with open_vcf(file_name) as fh:
+        lines = (line for line in fh if not line.startswith('#'))
+
+        while True:
+            batch = [line.rstrip('\n').split('\t', max_split) for line in itertools.islice(lines, batch_size)]
+
+            if len(batch) == 0:
+                break
+
+            yield batch
+
+
+def get_info_value(info, key, default=None):
+    '''
+    Get the raw string value of a key in the INFO column of a VCF record.
+
+    Flags are returned as an empty string and missing keys as `default`.
+    '''
+    prefix = key + '='
+
+    for entry in info.split(';'):
+        if entry.startswith(prefix):
+            return entry[len(prefix):]
+
+        elif entry == key:
+            return ''
+
+    return default
+
+
+def read_sample_columns(file_name, sample, format_keys, info_keys=(), dtype=np.float64, batch_size=100000):
+    '''
+    Read the INFO values and the FORMAT values of one sample from a VCF file as columns.
+
+    :param file_name: Path of VCF file, optionally gzip compressed.
+    :param sample: Name of the sample column, located once from the header.
+    :param format_keys: FORMAT keys to read for the sample.
+    :param info_keys: INFO keys to read.
+    :param dtype: Type of the value arrays, missing or '.' values are NaN. If None the raw strings are returned in
+        lists, with missing values as None.
+    :param batch_size: Number of records parsed at a time.
+
+    Returns an OrderedDict with `chrom` and `pos` columns followed by a column for each INFO and FORMAT key. Only the
+    columns up to the sample are split, and each distinct FORMAT string is only indexed once.
+    '''
+    header = read_header(file_name)
+
+    if sample not in header:
+        raise ValueError('Sample {0} not found in {1}'.format(sample, file_name))
+
+    format_idx = header.index('FORMAT')
+    sample_idx = header.index(sample)
+
+    chroms = []
+    positions = []
+    values = OrderedDict((key, []) for key in itertools.chain(info_keys, format_keys))
+
+    format_key_indices = {}
+
+    for batch in read_record_batches(file_name, batch_size=batch_size, num_fields=sample_idx + 1):
+        chroms.extend([record[0] for record in batch])
+        positions.extend([record[1] for record in batch])
+
+        for key in info_keys:
+            values[key].extend([get_info_value(record[7], key) for record in batch])
+
+        sample_values = get_sample_values(batch, format_idx, sample_idx, format_keys, format_key_indices)
+
+        for key in format_keys:
+            values[key].extend(sample_values[key])
+
+    columns = OrderedDict([
+        ('chrom', chroms),
+        ('pos', np.array(positions, dtype=np.int64)),
+    ])
+
+    for key in values:
+        if dtype is None:
+            columns[key] = values[key]
+
+        else:
+            columns[key] = values_to_array(values[key], dtype=dtype)
+
+    return columns
+
+
+def get_sample_values(records, format_idx, sample_idx, keys, format_key_indices=None):
+    '''
+    Get the raw values of FORMAT keys for one sample of a list of split VCF records.
+
+    :param records: Records as lists of tab separated fields, split at least up to the sample column.
+    :param format_idx: Index of the FORMAT column.
+    :param sample_idx: Index of the sample column.
+    :param keys: FORMAT keys to get.
+    :param format_key_indices: Optional dict caching the position of the keys in each distinct FORMAT string, which can
+        be shared across calls for the same keys.
+
+    Returns an OrderedDict with a list of values per key, None where the key is missing from a record.
+    '''
+    if format_key_indices is None:
+        format_key_indices = {}
+
+    values = OrderedDict((key, []) for key in keys)
+
+    for record in records:
+        format_string = record[format_idx]
+
+        if format_string not in format_key_indices:
+            record_keys = format_string.split(':')
+
+            format_key_indices[format_string] = [
+                record_keys.index(key) if key in record_keys else None for key in keys]
+
+        sample_values = record[sample_idx].split(':')
+
+        for key, idx in zip(keys, format_key_indices[format_string]):
+            if idx is None or idx >= len(sample_values):
+                values[key].append(None)
+
+            else:
+                values[key].append(sample_values[idx])
+
+    return values
+
+
+def values_to_array(values, dtype=np.float64):
+    '''
+    Convert raw VCF values to an array, with missing or '.' values as NaN.
+    '''
+    return np.array([np.nan if x in (None, '', '.') else x for x in values], dtype=dtype)
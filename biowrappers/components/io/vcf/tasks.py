@@ -7,13 +7,14 @@ Created on Oct 31, 2015
 import itertools
 import os
 
+import numpy as np
 import pandas as pd
 import pypeliner
 import vcf
 from biowrappers.components.utils import flatten_input
-from pandas.api.types import CategoricalDtype
 
 from ._merge import merge_vcfs
+from ._parse import get_info_value, read_record_batches
 
 
 def compress_vcf(in_file, out_file):
@@ -183,116 +184,141 @@ def split_vcf(in_file, out_files, lines_per_file):
             writer.close()
 
 
-def _convert_vcf_to_df(in_file, score_callback=None):
-    def line_group(line, line_idx=itertools.count()):
-        return int(next(line_idx) / chunk_size)
+def _read_vcf_rows(in_file, score_callback=None, score_info_key=None, batch_size=100000):
+    """ Read batches of (chrom, coord, ref, alt, score) rows from a VCF, with one row per alt allele.
 
-    chunk_size = 1000
+    Without a `score_callback` the raw VCF text is parsed directly and the score is taken from the `score_info_key` INFO
+    value if given, otherwise from the QUAL column. A `score_callback` needs PyVCF records so it can be applied.
 
-    # ===================================================================================================================
-    # find all entries in categories
-    # ===================================================================================================================
-    reader = vcf.Reader(filename=in_file)
+    A missing ALT ('.') is written as 'None', as PyVCF would convert it.
+
+    """
+    if score_callback is None:
+        score_idx = 5 if score_info_key is None else 7
+
+        for batch in read_record_batches(in_file, batch_size=batch_size, num_fields=score_idx + 1):
+            rows = []
+
+            for fields in batch:
+                if score_info_key is None:
+                    score = fields[5]
+
+                else:
+                    score = get_info_value(fields[7], score_info_key)
+
+                score = np.nan if score in (None, '', '.') else float(score)
+
+                for alt in fields[4].split(','):
+                    if alt == '.':
+                        alt = 'None'
+
+                    rows.append((fields[0], int(fields[1]), fields[3], alt, score))
+
+            yield rows
+
+    else:
+        def line_group(line, line_idx=itertools.count()):
+            return int(next(line_idx) / batch_size)
 
-    chrom_categories = set()
+        reader = vcf.Reader(filename=in_file)
 
-    ref_categories = set()
+        for _, records in itertools.groupby(reader, key=line_group):
+            rows = []
 
-    alt_categories = set()
+            for record in records:
+                score = score_callback(record)
 
-    for record in reader:
+                for alt in record.ALT:
+                    rows.append((str(record.CHROM), record.POS, str(record.REF), str(alt), score))
 
-        chrom_categories.add(str(record.CHROM))
+            yield rows
 
-        ref_categories.add(str(record.REF))
 
-        for alt in record.ALT:
-            alt_categories.add(str(alt))
+def _read_vcf_categories(in_file, score_callback=None, batch_size=100000):
+    """ Find the sorted chrom, ref and alt values of a VCF, as they are written by `_read_vcf_rows`.
 
-    chrom_categories = sorted(chrom_categories)
+    """
+    categories = dict((x, set()) for x in ('chrom', 'ref', 'alt'))
 
-    ref_categories = sorted(ref_categories)
+    if score_callback is None:
+        for batch in read_record_batches(in_file, batch_size=batch_size, num_fields=5):
+            categories['chrom'].update([fields[0] for fields in batch])
 
-    alt_categories = sorted(alt_categories)
+            categories['ref'].update([fields[3] for fields in batch])
 
-    if len(chrom_categories) > 0:
-        min_itemsize = {
-            'chrom': max([len(x) for x in chrom_categories]),
-            'ref': max([len(x) for x in ref_categories]),
-            'alt': max([len(x) for x in alt_categories])
-        }
+            for fields in batch:
+                categories['alt'].update(['None' if x == '.' else x for x in fields[4].split(',')])
 
     else:
-        min_itemsize = {}
+        for record in vcf.Reader(filename=in_file):
+            categories['chrom'].add(str(record.CHROM))
 
-    # ===================================================================================================================
-    # convert
-    # ===================================================================================================================
+            categories['ref'].add(str(record.REF))
 
-    # reopen reader to restart iter
-    reader = vcf.Reader(filename=in_file)
+            categories['alt'].update([str(x) for x in record.ALT])
 
-    no_data = True
+    return dict((x, sorted(y)) for x, y in categories.items())
 
-    for file_idx, records in itertools.groupby(reader, key=line_group):
 
-        df = []
+def _convert_vcf_to_df(in_file, score_callback=None, score_info_key=None, chunk_size=100000):
+    columns = ['chrom', 'coord', 'ref', 'alt', 'score']
 
-        for record in records:
-            if score_callback is not None:
-                score = score_callback(record)
+    # Categories are found in a first pass so every chunk shares them, memory is bounded by the chunk size
+    categories = _read_vcf_categories(in_file, score_callback=score_callback, batch_size=chunk_size)
 
-            else:
-                score = record.QUAL
+    if len(categories['chrom']) == 0:
+        yield pd.DataFrame(columns=columns), None
+
+        return
 
-            for alt in record.ALT:
-                row = {
-                    'chrom': record.CHROM,
-                    'coord': record.POS,
-                    'ref': str(record.REF),
-                    'alt': str(alt),
-                    'score': score
-                }
+    min_itemsize = dict((col, max([len(x) for x in values])) for col, values in categories.items())
 
-                df.append(row)
+    codes = dict((col, dict((x, idx) for idx, x in enumerate(values))) for col, values in categories.items())
 
-        beg = file_idx * chunk_size
+    beg = 0
 
-        end = beg + len(df)
+    rows_iter = _read_vcf_rows(
+        in_file, score_callback=score_callback, score_info_key=score_info_key, batch_size=chunk_size)
 
-        df = pd.DataFrame(df, index=range(beg, end))
+    for rows in rows_iter:
+        if len(rows) == 0:
+            continue
 
-        chrom_cat_type = CategoricalDtype(categories=chrom_categories)
-        df['chrom'] = df['chrom'].astype(chrom_cat_type)
+        data = dict(zip(columns, zip(*rows)))
 
-        alt_cat_type = CategoricalDtype(categories=alt_categories)
-        df['alt'] = df['alt'].astype(alt_cat_type)
+        end = beg + len(rows)
 
-        ref_cat_type = CategoricalDtype(categories=ref_categories)
-        df['ref'] = df['ref'].astype(ref_cat_type)
+        df = {}
 
-        df = df[['chrom', 'coord', 'ref', 'alt', 'score']]
+        for col in columns:
+            if col in categories:
+                col_codes = np.fromiter((codes[col][x] for x in data[col]), dtype=np.int32, count=len(rows))
 
-        yield df, min_itemsize
+                df[col] = pd.Categorical.from_codes(col_codes, categories=categories[col])
+
+            elif col == 'coord':
+                df[col] = np.array(data[col], dtype=np.int64)
+
+            else:
+                df[col] = np.array(data[col], dtype=float)
 
-        no_data = False
+        yield pd.DataFrame(df, index=range(beg, end), columns=columns), min_itemsize
 
-    if no_data:
-        yield pd.DataFrame(columns=['chrom', 'coord', 'ref', 'alt', 'score']), None
+        beg = end
 
 
-def convert_vcf_to_hdf5(in_file, out_file, table_name, score_callback=None):
+def convert_vcf_to_hdf5(in_file, out_file, table_name, score_callback=None, score_info_key=None):
     hdf_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
 
-    for (df, min_itemsize) in _convert_vcf_to_df(in_file, score_callback=score_callback):
+    for (df, min_itemsize) in _convert_vcf_to_df(in_file, score_callback=score_callback, score_info_key=score_info_key):
         hdf_store.append(table_name, df, min_itemsize=min_itemsize)
 
     hdf_store.close()
 
 
-def convert_vcf_to_csv(in_file, out_file, score_callback=None):
+def convert_vcf_to_csv(in_file, out_file, score_callback=None, score_info_key=None):
     header = False
-    for (df, _) in _convert_vcf_to_df(in_file, score_callback=score_callback):
+    for (df, _) in _convert_vcf_to_df(in_file, score_callback=score_callback, score_info_key=score_info_key):
         if not header:
             df.to_csv(out_file, mode='w', header=True, index=False)
             header = True
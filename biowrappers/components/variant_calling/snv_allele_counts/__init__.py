@@ -102,6 +102,7 @@ def create_snv_allele_counts_workflow(
         count_duplicates=False,
         min_bqual=0,
         min_mqual=0,
+        min_variant_depth=0,
         report_non_variant_positions=True,
         report_zero_count_positions=False,
         split_size=int(1e7)):
@@ -128,6 +129,7 @@ def create_snv_allele_counts_workflow(
             'count_duplicates': count_duplicates,
             'min_bqual': min_bqual,
             'min_mqual': min_mqual,
+            'min_variant_depth': min_variant_depth,
             'report_non_variant_positions': report_non_variant_positions,
             'report_zero_count_positions': report_zero_count_positions
         }
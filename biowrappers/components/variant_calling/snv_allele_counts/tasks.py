@@ -3,6 +3,8 @@ Created on Oct 31, 2015
 
 @author: Andrew Roth
 '''
+import logging
+
 import numpy as np
 import pandas as pd
 import pysam
@@ -14,6 +16,13 @@ from single_cell.utils import csvutils
 
 nucleotides = ('A', 'C', 'G', 'T')
 
+# SAM flag bits
+BAM_FUNMAP = 0x4
+BAM_FREVERSE = 0x10
+BAM_FSECONDARY = 0x100
+BAM_FQCFAIL = 0x200
+BAM_FDUP = 0x400
+
 #=======================================================================================================================
 # Allele counting
 #=======================================================================================================================
@@ -30,7 +39,16 @@ def get_snv_allele_counts_for_vcf_targets(
         vcf_to_bam_chrom_map=None,
         report_zero_count_positions=False,
         dtypes=None,
+        max_window_gap=1000,
+        max_window_size=int(1e6),
+        log_read_stats=False,
         **extra_columns):
+    """ Get ref and alt counts for the SNVs in a VCF file.
+
+    Target positions closer than `max_window_gap` are clustered into windows of at most `max_window_size` bases. Each
+    window is counted with a single pileup pass and the counts of its targets are gathered from the window.
+
+    """
 
     bam = pysam.AlignmentFile(bam_file, 'rb')
 
@@ -45,59 +63,79 @@ def get_snv_allele_counts_for_vcf_targets(
         except ValueError:
             vcf_reader = ()
 
-    data = []
+    targets = []
 
     for record in vcf_reader:
+        ref_base = record.REF
+
+        # Skip record with reference base == N
+        if ref_base not in nucleotides:
+            continue
+
+        alt_bases = []
+
+        for alt_base in record.ALT:
+            alt_base = str(alt_base)
+
+            # Skip record with alt base == N
+            if alt_base not in nucleotides:
+                continue
+
+            alt_bases.append(alt_base)
+
+        if len(alt_bases) == 0:
+            continue
+
         if vcf_to_bam_chrom_map is not None:
             bam_chrom = vcf_to_bam_chrom_map[record.CHROM]
 
         else:
             bam_chrom = record.CHROM
 
-        df = _get_counts_df(
+        targets.append((bam_chrom, record.CHROM, record.POS, ref_base, alt_bases))
+
+    read_filter = ReadFilter(count_duplicates=count_duplicates, min_mqual=min_mqual, track_stats=log_read_stats)
+
+    target_counts = {}
+
+    for bam_chrom in set([x[0] for x in targets]):
+        coords = np.unique([x[2] for x in targets if x[0] == bam_chrom])
+
+        counts = _get_target_counts(
             bam,
             bam_chrom,
-            record.POS,
-            record.POS + 1,
-            count_duplicates=count_duplicates,
+            coords,
+            read_filter,
             min_bqual=min_bqual,
-            min_mqual=min_mqual,
-            strand='both',
-            report_zero_count_positions=report_zero_count_positions,
+            max_window_gap=max_window_gap,
+            max_window_size=max_window_size,
         )
 
-        if df is None:
-            continue
-
-        counts = df.iloc[0]
+        target_counts[bam_chrom] = (coords, counts)
 
-        ref_base = record.REF
+    data = []
 
-        # Skip record with reference base == N
-        if ref_base not in nucleotides:
-            continue
+    for bam_chrom, chrom, coord, ref_base, alt_bases in targets:
+        coords, counts = target_counts[bam_chrom]
 
-        for alt_base in record.ALT:
-            alt_base = str(alt_base)
+        counts = counts[np.searchsorted(coords, coord)]
 
-            if (len(ref_base) != 1) or (len(alt_base) != 1):
-                continue
+        ref_counts = counts[nucleotides.index(ref_base)]
 
-            # Skip record with alt base == N
-            if alt_base not in nucleotides:
-                continue
+        for alt_base in alt_bases:
+            alt_counts = counts[nucleotides.index(alt_base)]
 
-            if not report_zero_count_positions and counts[ref_base] == 0 and counts[alt_base] == 0:
+            if not report_zero_count_positions and ref_counts == 0 and alt_counts == 0:
                 continue
 
             # Format output record
             out_row = {
-                'chrom': record.CHROM,
-                'coord': record.POS,
+                'chrom': chrom,
+                'coord': coord,
                 'ref': ref_base,
                 'alt': alt_base,
-                'ref_counts': counts[ref_base],
-                'alt_counts': counts[alt_base]
+                'ref_counts': ref_counts,
+                'alt_counts': alt_counts
             }
 
             data.append(out_row)
@@ -107,6 +145,9 @@ def get_snv_allele_counts_for_vcf_targets(
     for col, value in extra_columns.items():
         data[col] = value
 
+    if log_read_stats:
+        read_filter.log_stats(bam_file)
+
     csvutils.write_dataframe_to_csv_and_yaml(
         data, out_file, dtypes
     )
@@ -120,44 +161,27 @@ def get_snv_allele_counts_for_region(
         count_duplicates=False,
         min_bqual=0,
         min_mqual=0,
+        min_variant_depth=0,
         report_non_variant_positions=True,
-        report_zero_count_positions=False):
+        report_zero_count_positions=False,
+        log_read_stats=False):
 
     bam = pysam.AlignmentFile(bam_file, 'rb')
 
     chrom, beg, end = _parse_region(region)
 
-    forward_df = _get_counts_df(
-        bam,
-        chrom,
-        beg,
-        end,
-        count_duplicates=count_duplicates,
-        min_bqual=min_bqual,
-        min_mqual=min_mqual,
-        strand='forward'
-    )
-
-    reverse_df = _get_counts_df(
-        bam,
-        chrom,
-        beg,
-        end,
-        count_duplicates=count_duplicates,
-        min_bqual=min_bqual,
-        min_mqual=min_mqual,
-        strand='reverse'
-    )
+    read_filter = ReadFilter(count_duplicates=count_duplicates, min_mqual=min_mqual, track_stats=log_read_stats)
 
-    reverse_df = reverse_df.rename(columns=lambda x: x.lower())
+    df = _get_strand_counts_df(bam, chrom, beg, end, read_filter, min_bqual=min_bqual)
 
-    df = pd.concat([forward_df, reverse_df], axis=1)
+    if log_read_stats:
+        read_filter.log_stats(region)
 
     if not report_zero_count_positions:
         df = df[df.sum(axis=1) > 0]
 
     if (not report_non_variant_positions) and (df.shape[0] > 0):
-        df = df[df.apply(_get_variant_positions_strand, axis=1)]
+        df = df[_get_variant_positions(df.values, min_variant_depth)]
 
     df.reset_index(inplace=True)
 
@@ -180,11 +204,13 @@ def get_variant_position_counts(
         min_normal_depth=0,
         min_tumour_depth=0,
         min_variant_depth=0,
-        report_strand_counts=True):
+        report_strand_counts=True,
+        log_read_stats=False):
     """ Get counts for positions with at least two alleles in one or more tumour samples.
 
     This function filters for all positions which exceed the minimum depth in the normal sample and at least one tumour
-    sample. It further filters for positions which have at least two alleles present in one or more tumour samples.
+    sample. It further filters for positions where the second most common allele has more than `min_variant_depth`
+    reads in one or more tumour samples, summing over strands if strand counts are reported.
 
     """
 
@@ -200,44 +226,16 @@ def get_variant_position_counts(
     counts = {}
 
     for sample in bams:
+        read_filter = ReadFilter(count_duplicates=count_duplicates, min_mqual=min_mqual, track_stats=log_read_stats)
+
         if report_strand_counts:
-            forward_df = _get_counts_df(
-                bams[sample],
-                chrom,
-                beg,
-                end,
-                count_duplicates=count_duplicates,
-                min_bqual=min_bqual,
-                min_mqual=min_mqual,
-                strand='forward'
-            )
-
-            reverse_df = _get_counts_df(
-                bams[sample],
-                chrom,
-                beg,
-                end,
-                count_duplicates=count_duplicates,
-                min_bqual=min_bqual,
-                min_mqual=min_mqual,
-                strand='reverse'
-            )
-
-            reverse_df.rename(columns=lambda x: x.lower(), inplace=True)
-
-            counts[sample] = pd.concat([forward_df, reverse_df], axis=1)
+            counts[sample] = _get_strand_counts_df(bams[sample], chrom, beg, end, read_filter, min_bqual=min_bqual)
 
         else:
-            counts[sample] = _get_counts_df(
-                bams[sample],
-                chrom,
-                beg,
-                end,
-                count_duplicates=count_duplicates,
-                min_bqual=min_bqual,
-                min_mqual=min_mqual,
-                strand='both'
-            )
+            counts[sample] = _get_counts_df(bams[sample], chrom, beg, end, read_filter, min_bqual=min_bqual)
+
+        if log_read_stats:
+            read_filter.log_stats('{0} {1}'.format(sample, region))
 
     # Depth filtering
     valid_positions = np.zeros(counts['normal'].shape[0], dtype=bool)
@@ -256,13 +254,8 @@ def get_variant_position_counts(
         variant_positions = np.zeros(counts['normal'].shape[0], dtype=bool)
 
         for sample in tumour_samples:
-            if report_strand_counts:
-                variant_positions = np.logical_or(
-                    variant_positions, counts[sample].apply(_get_variant_positions_strand, axis=1))
-
-            else:
-                variant_positions = np.logical_or(
-                    variant_positions, counts[sample].apply(lambda x: _get_variant_positions(x, min_variant_depth), axis=1))
+            variant_positions = np.logical_or(
+                variant_positions, _get_variant_positions(counts[sample].values, min_variant_depth))
 
         for sample in counts:
             counts[sample] = counts[sample][variant_positions]
@@ -286,32 +279,54 @@ def _get_counts_df(bam_file,
                    chrom,
                    beg,
                    end,
-                   count_duplicates=False,
+                   read_filter,
                    min_bqual=30,
-                   min_mqual=30,
-                   strand='both',
                    report_zero_count_positions=True):
     '''
     Get counts 1 based indexing.
     '''
 
+    x = _get_counts_array(bam_file, chrom, beg, end, read_filter, min_bqual=min_bqual)
+
+    if not report_zero_count_positions:
+        if x.sum() == 0:
+            return None
+
+    df = pd.DataFrame(x, columns=['A', 'C', 'G', 'T'])
+
+    df.insert(0, 'chrom', chrom)
+
+    df.insert(1, 'coord', np.arange(beg, end))
+
+    df = df.set_index(['chrom', 'coord'])
+
+    return df
+
+
+def _get_counts_array(bam_file, chrom, beg, end, read_filter, min_bqual=30):
+    '''
+    Get a positions by nucleotide array of counts for the 1 based interval [beg, end).
+    '''
+
     x = bam_file.count_coverage(
         chrom,
         beg - 1,
         end - 1,
         quality_threshold=min_bqual,
-        read_callback=lambda x: _check_read(
-            x,
-            count_duplicates=count_duplicates,
-            min_mqual=min_mqual,
-            strand=strand)
+        read_callback=read_filter.read_callback
     )
 
-    if not report_zero_count_positions:
-        if np.array(x).sum() == 0:
-            return None
+    return np.array(x).T
+
+
+def _get_strand_counts_df(bam_file, chrom, beg, end, read_filter, min_bqual=30):
+    '''
+    Get forward (upper case) and reverse (lower case) strand counts 1 based indexing.
+    '''
 
-    df = pd.DataFrame(pd.np.array(x).T, columns=['A', 'C', 'G', 'T'])
+    x = _get_strand_counts_array(bam_file, chrom, beg, end, read_filter, min_bqual=min_bqual)
+
+    df = pd.DataFrame(x, columns=list(nucleotides) + [n.lower() for n in nucleotides])
 
     df.insert(0, 'chrom', chrom)
 
@@ -322,55 +337,304 @@ def _get_counts_df(bam_file,
     return df
 
 
-def _check_read(read, count_duplicates=False, min_mqual=30, strand='both'):
-    valid = True
+def _get_strand_counts_array(bam_file, chrom, beg, end, read_filter, min_bqual=30, reads_per_chunk=100000):
+    '''
+    Get a positions by 8 array of counts for the 1 based interval [beg, end).
 
-    if read.mapping_quality < min_mqual:
-        valid = False
+    The first four columns are forward strand counts of A, C, G, T and the last four are reverse strand counts. Reads
+    are walked once and the aligned bases of a chunk of reads are added to the counts in bulk. Counts are the same as
+    those of `count_coverage` on each strand with the same quality threshold.
+    '''
+    counts = np.zeros((end - beg) * 8, dtype=np.int64)
 
-    elif read.is_duplicate and (not count_duplicates):
-        valid = False
+    chunk = _AlignedBases()
 
-    elif read.is_unmapped:
-        valid = False
+    for read in bam_file.fetch(chrom, beg - 1, end - 1):
+        if not read_filter(read):
+            continue
 
-    elif read.is_qcfail:
-        valid = False
+        chunk.add_read(read)
 
-    elif read.is_secondary:
-        valid = False
+        if chunk.num_reads >= reads_per_chunk:
+            chunk.add_counts(counts, beg - 1, min_bqual)
 
-    elif (strand == 'reverse') and (not read.is_reverse):
-        valid = False
+            chunk = _AlignedBases()
 
-    elif (strand == 'forward') and (read.is_reverse):
-        valid = False
+    chunk.add_counts(counts, beg - 1, min_bqual)
 
-    return valid
+    return counts.reshape((end - beg, 8))
 
 
-def _get_variant_positions(row, min_variant_depth):
-    counts = sorted(row, reverse=True)
+_base_codes = np.full(256, -1, dtype=np.int64)
 
-    if counts[1] > min_variant_depth:
-        return True
+_base_codes[[ord(x) for x in nucleotides]] = np.arange(len(nucleotides))
 
-    else:
-        return False
 
+class _AlignedBases(object):
+    '''
+    Buffer of the aligned bases of a set of reads, stored as blocks of consecutive matching bases.
+    '''
+
+    def __init__(self):
+        self.num_reads = 0
+
+        self._num_bases = 0
+
+        self._blocks = []
+
+        self._quals = []
+
+        self._seqs = []
+
+    def add_read(self, read):
+        seq = read.query_sequence
+
+        if seq is None:
+            return
+
+        quals = read.query_qualities
+
+        if quals is None:
+            # As in count_coverage, bases of reads without qualities only pass a quality threshold of 0
+            quals = np.zeros(len(seq), dtype=np.uint8)
 
-def _get_variant_positions_strand(row):
-    counts = [row[x.lower()] + row[x.upper()] for x in nucleotides]
+        strand = 4 if read.is_reverse else 0
 
-    counts = sorted(counts, reverse=True)
+        q_pos = self._num_bases
 
-    if counts[1] > 0:
-        return True
+        r_pos = read.reference_start
+
+        for op, length in read.cigartuples:
+            # Match, sequence match and mismatch
+            if op in (0, 7, 8):
+                self._blocks.append((q_pos, r_pos, length, strand))
+
+                q_pos += length
+
+                r_pos += length
+
+            # Insertion and soft clip
+            elif op in (1, 4):
+                q_pos += length
+
+            # Deletion and reference skip
+            elif op in (2, 3):
+                r_pos += length
+
+        self._seqs.append(seq)
+
+        self._quals.append(np.asarray(quals, dtype=np.uint8))
+
+        self._num_bases += len(seq)
+
+        self.num_reads += 1
+
+    def add_counts(self, counts, offset, min_bqual):
+        '''
+        Add the base counts to a flattened positions by 8 counts array starting at 0 based position `offset`.
+        '''
+        if len(self._blocks) == 0:
+            return
+
+        seqs = np.frombuffer(''.join(self._seqs).encode('ascii'), dtype=np.uint8)
+
+        quals = np.concatenate(self._quals)
+
+        q_beg, r_beg, length, strand = np.array(self._blocks, dtype=np.int64).T
+
+        block_idx = np.repeat(np.arange(len(length)), length)
+
+        block_offset = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+
+        q_pos = q_beg[block_idx] + block_offset
+
+        r_pos = r_beg[block_idx] + block_offset - offset
+
+        codes = _base_codes[seqs[q_pos]]
+
+        keep = (r_pos >= 0) & (r_pos < (len(counts) // 8)) & (codes >= 0) & (quals[q_pos] >= min_bqual)
+
+        idx = r_pos[keep] * 8 + strand[block_idx[keep]] + codes[keep]
+
+        if len(idx) == 0:
+            return
+
+        idx_min = idx.min()
+
+        bin_counts = np.bincount(idx - idx_min)
+
+        counts[idx_min:idx_min + len(bin_counts)] += bin_counts
+
+
+def _get_target_counts(bam_file,
+                       chrom,
+                       coords,
+                       read_filter,
+                       min_bqual=30,
+                       max_window_gap=1000,
+                       max_window_size=int(1e6)):
+    '''
+    Get a targets by nucleotide array of counts for sorted, unique, 1 based target coordinates.
+    '''
+    counts = np.zeros((len(coords), len(nucleotides)), dtype=np.int64)
+
+    for beg, end in _get_target_windows(coords, max_window_gap, max_window_size):
+        idx_beg, idx_end = np.searchsorted(coords, [beg, end])
+
+        window_counts = _get_counts_array(bam_file, chrom, beg, end, read_filter, min_bqual=min_bqual)
+
+        counts[idx_beg:idx_end] = window_counts[coords[idx_beg:idx_end] - beg]
+
+    return counts
+
+
+def _get_target_windows(coords, max_window_gap, max_window_size):
+    '''
+    Cluster sorted 1 based coordinates into half open windows.
+
+    >>> _get_target_windows([1, 5, 2000, 2001], 1000, 100)
+    [(1, 6), (2000, 2002)]
+    '''
+    windows = []
+
+    beg = prev = None
+
+    for coord in coords:
+        if beg is None:
+            beg = coord
+
+        elif (coord - prev > max_window_gap) or (coord - beg >= max_window_size):
+            windows.append((beg, prev + 1))
+
+            beg = coord
+
+        prev = coord
+
+    if beg is not None:
+        windows.append((beg, prev + 1))
+
+    return windows
+
+
+class ReadFilter(object):
+    '''
+    Read filter compiled to a SAM flag mask and mapping quality threshold.
+
+    A read passes if `read.flag & flag_mask == flag_value` and its mapping quality is at least `min_mqual`, so each read
+    is checked with two integer tests. If `track_stats` is set the number of reads examined and rejected for each reason
+    are counted, see `stats`.
+    '''
+
+    reasons = ('mapping_quality', 'duplicate', 'unmapped', 'qcfail', 'secondary', 'strand')
+
+    def __init__(self, count_duplicates=False, min_mqual=30, strand='both', track_stats=False):
+        if strand not in ('both', 'forward', 'reverse'):
+            raise ValueError('Invalid strand {0}'.format(strand))
+
+        self.count_duplicates = count_duplicates
+
+        self.min_mqual = min_mqual
+
+        self.strand = strand
+
+        self.flag_mask = BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL
+
+        if not count_duplicates:
+            self.flag_mask |= BAM_FDUP
+
+        if strand != 'both':
+            self.flag_mask |= BAM_FREVERSE
+
+        self.flag_value = BAM_FREVERSE if strand == 'reverse' else 0
+
+        self.track_stats = track_stats
+
+        self.num_examined = 0
+
+        self.num_rejected = dict((x, 0) for x in self.reasons)
+
+    def __call__(self, read):
+        if self.track_stats:
+            return self._check_read_and_track(read)
+
+        return ((read.flag & self.flag_mask) == self.flag_value) and (read.mapping_quality >= self.min_mqual)
+
+    @property
+    def read_callback(self):
+        '''
+        Callback for `pysam.AlignmentFile.count_coverage`.
+
+        If the filter is equivalent to the pysam `all` filter it is used so reads are filtered in the C layer.
+        '''
+        c_layer_mask = BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP
+
+        if (not self.track_stats) and (self.flag_mask == c_layer_mask) and (self.min_mqual <= 0):
+            return 'all'
+
+        return self
+
+    @property
+    def stats(self):
+        '''
+        Dictionary with the number of reads examined and the number rejected for each reason.
+        '''
+        stats = {'examined': self.num_examined}
+
+        for reason in self.reasons:
+            stats['rejected_' + reason] = self.num_rejected[reason]
+
+        return stats
+
+    def log_stats(self, description):
+        stats = ', '.join('{0}={1}'.format(x, y) for x, y in sorted(self.stats.items()))
+
+        logging.getLogger(__name__).info('read filter stats for {0}: {1}'.format(description, stats))
+
+    def _check_read_and_track(self, read):
+        self.num_examined += 1
+
+        if ((read.flag & self.flag_mask) == self.flag_value) and (read.mapping_quality >= self.min_mqual):
+            return True
+
+        # Reads failing several checks are attributed to the first failing check
+        if read.mapping_quality < self.min_mqual:
+            reason = 'mapping_quality'
+
+        elif (read.flag & BAM_FDUP) and (not self.count_duplicates):
+            reason = 'duplicate'
+
+        elif read.flag & BAM_FUNMAP:
+            reason = 'unmapped'
+
+        elif read.flag & BAM_FQCFAIL:
+            reason = 'qcfail'
+
+        elif read.flag & BAM_FSECONDARY:
+            reason = 'secondary'
+
+        else:
+            reason = 'strand'
+
+        self.num_rejected[reason] += 1
 
-    else:
         return False
 
 
+def _get_variant_positions(counts, min_variant_depth=0):
+    '''
+    Find positions where the second most common nucleotide has more than `min_variant_depth` counts.
+
+    :param counts: positions by nucleotide count array. Arrays with 8 columns are treated as forward and reverse strand
+        counts, which are summed before filtering.
+    '''
+    counts = np.asarray(counts)
+
+    if counts.shape[-1] == 8:
+        counts = counts[..., :4] + counts[..., 4:]
+
+    return np.partition(counts, -2, axis=-1)[..., -2] > min_variant_depth
+
+
 def _parse_region(region):
     chrom, coords = region.split(':')
 
@@ -19,6 +19,7 @@ def create_strelka_workflow(
         snv_vcf_file,
         chromosomes=default_chromosomes,
         split_size=int(1e7),
+        balance_read_load=False,
         use_depth_thresholds=True):
 
     workflow = Workflow()
@@ -40,7 +41,11 @@ def create_strelka_workflow(
             pypeliner.managed.InputFile(tumour_bam_file),
             pypeliner.managed.TempInputObj('chrom_dummy', 'chrom'),
             split_size
-        )
+        ),
+        kwargs={
+            'balance_read_load': balance_read_load,
+            'normal_bam_file': pypeliner.managed.InputFile(normal_bam_file),
+        },
     )
 
     workflow.transform(
@@ -84,6 +89,18 @@ def create_strelka_workflow(
         )
     )
 
+    workflow.transform(
+        name='summarize_normal_coverage',
+        axes=('chrom',),
+        ctx={'mem': 2, 'num_retry': 3, 'mem_retry_increment': 2},
+        func=tasks.summarize_normal_coverage,
+        args=(
+            pypeliner.managed.TempInputFile('strelka.stats', 'chrom', 'coord'),
+            pypeliner.managed.TempInputObj('chrom_dummy', 'chrom'),
+            pypeliner.managed.TempOutputFile('normal_coverage.tsv', 'chrom')
+        )
+    )
+
     workflow.transform(
         name='add_indel_filters',
         axes=('chrom',),
@@ -91,7 +108,7 @@ def create_strelka_workflow(
         func=tasks.filter_indel_file_list,
         args=(
             pypeliner.managed.TempInputFile('somatic.indels.unfiltered.vcf', 'chrom', 'coord'),
-            pypeliner.managed.TempInputFile('strelka.stats', 'chrom', 'coord'),
+            pypeliner.managed.TempInputFile('normal_coverage.tsv', 'chrom'),
             pypeliner.managed.TempInputFile('somatic.indels.unfiltered.vcf.window', 'chrom', 'coord'),
             pypeliner.managed.TempOutputFile('somatic.indels.filtered.vcf', 'chrom'),
             pypeliner.managed.TempInputObj('chrom_dummy', 'chrom'),
@@ -107,7 +124,7 @@ def create_strelka_workflow(
         func=tasks.filter_snv_file_list,
         args=(
             pypeliner.managed.TempInputFile('somatic.snvs.unfiltered.vcf', 'chrom', 'coord'),
-            pypeliner.managed.TempInputFile('strelka.stats', 'chrom', 'coord'),
+            pypeliner.managed.TempInputFile('normal_coverage.tsv', 'chrom'),
             pypeliner.managed.TempOutputFile('somatic.snvs.filtered.vcf', 'chrom'),
             pypeliner.managed.TempInputObj('chrom_dummy', 'chrom'),
             pypeliner.managed.TempInputObj('known_sizes', 'chrom')
@@ -195,7 +212,19 @@ def _get_chromosomes(bam_file, chromosomes=None):
     return [str(x) for x in chromosomes]
 
 
-def get_coords(bam_file, chrom, split_size):
+def get_coords(bam_file, chrom, split_size, balance_read_load=False, normal_bam_file=None):
+    """ Split a chromosome into regions for calling.
+
+    :param bam_file: Path of the tumour BAM file.
+    :param chrom: Chromosome to split.
+    :param split_size: Region size, or mean region size if `balance_read_load` is set.
+    :param balance_read_load: Place region boundaries so regions have roughly equal read load, as estimated from the
+        BAM indices. Falls back to fixed size regions if a BAM file has no .bai index, for example if it is CSI
+        indexed.
+    :param normal_bam_file: Path of the normal BAM file. Its read load is added to that of the tumour, as both BAM
+        files are read for each region. If None only the tumour read load is used.
+
+    """
 
     coords = {}
 
@@ -203,13 +232,32 @@ def get_coords(bam_file, chrom, split_size):
 
     chrom_lengths = dict(zip(bam.references, bam.lengths))
 
+    bam.close()
+
     length = chrom_lengths[chrom]
 
-    lside_interval = range(1, length + 1, split_size)
+    read_loads = {}
+
+    if balance_read_load:
+        bam_files = [bam_file]
+
+        if normal_bam_file is not None:
+            bam_files.append(normal_bam_file)
+
+        read_loads = utils.sum_read_loads(
+            [utils.load_bam_index_read_loads(x, chromosomes=[chrom]) for x in bam_files])
+
+    if chrom in read_loads:
+        intervals = utils.split_by_read_load(length, split_size, read_loads[chrom])
+
+    else:
+        lside_interval = range(1, length + 1, split_size)
+
+        rside_interval = range(split_size, length + split_size, split_size)
 
-    rside_interval = range(split_size, length + split_size, split_size)
+        intervals = zip(lside_interval, rside_interval)
 
-    for coord_index, (beg, end) in enumerate(zip(lside_interval, rside_interval)):
+    for coord_index, (beg, end) in enumerate(intervals):
         coords[coord_index] = (beg, end)
 
     return coords
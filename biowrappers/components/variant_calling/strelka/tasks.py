@@ -9,11 +9,15 @@ from collections import OrderedDict
 
 import csv
 import ConfigParser
+import logging
 import math
+import numpy as np
 import pandas as pd
 import pypeliner
 import re
-import vcf
+import time
+
+from biowrappers.components.io.vcf._parse import get_info_value, get_sample_values, open_vcf, read_record_batches, values_to_array
 
 FILTER_ID_BASE = 'BCNoise'
 FILTER_ID_DEPTH = 'DP'
@@ -110,7 +114,7 @@ def call_somatic_variants(
 
 def filter_snv_file_list(
         in_files,
-        stats_files,
+        coverage_file,
         out_file,
         chrom,
         known_chrom_size,
@@ -120,82 +124,77 @@ def filter_snv_file_list(
         quality_lower_bound=15,
         use_depth_filter=True):
 
-    max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files)
+    max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, coverage_file)
 
-    writer = None
+    filter_descs = OrderedDict()
 
-    with open(out_file, 'wb') as out_fh:
-        for key in sorted(in_files):
-            reader = vcf.Reader(filename=in_files[key])
+    if use_depth_filter:
+        filter_descs[FILTER_ID_DEPTH] = 'Greater than {0}x chromosomal mean depth in Normal sample'.format(
+            depth_filter_multiple)
+
+    filter_descs[FILTER_ID_BASE] = 'Fraction of basecalls filtered at this site in either sample is at or above {0}'.format(
+        max_filtered_basecall_frac)
 
-            if writer is None:
-                # Add filters to header
-                if use_depth_filter:
-                    reader.filters[FILTER_ID_DEPTH] = vcf.parser._Filter(
-                        id=FILTER_ID_DEPTH,
-                        desc='Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
-                    )
+    filter_descs[FILTER_ID_SPANNING_DELETION] = 'Fraction of reads crossing site with spanning deletions in either sample exceeeds {0}'.format(
+        max_spanning_deletion_frac)
 
-                reader.filters[FILTER_ID_BASE] = vcf.parser._Filter(
-                    id=FILTER_ID_BASE,
-                    desc='Fraction of basecalls filtered at this site in either sample is at or above {0}'.format(
-                        max_filtered_basecall_frac)
-                )
+    filter_descs[FILTER_ID_QSS] = 'Normal sample is not homozygous ref or ssnv Q-score < {0}, ie calls with NT!=ref or QSS_NT < {0}'.format(
+        quality_lower_bound)
 
-                reader.filters[FILTER_ID_SPANNING_DELETION] = vcf.parser._Filter(
-                    id=FILTER_ID_SPANNING_DELETION,
-                    desc='Fraction of reads crossing site with spanning deletions in either sample exceeeds {0}'.format(
-                        max_spanning_deletion_frac)
-                )
+    with open(out_file, 'w') as out_fh:
+        for file_idx, key in enumerate(sorted(in_files)):
+            header, records = _read_vcf_records(in_files[key])
 
-                reader.filters[FILTER_ID_QSS] = vcf.parser._Filter(
-                    id=FILTER_ID_QSS,
-                    desc='Normal sample is not homozygous ref or ssnv Q-score < {0}, ie calls with NT!=ref or QSS_NT < {0}'.format(
-                        quality_lower_bound)
-                )
+            if file_idx == 0:
+                _write_header(out_fh, header, filter_descs)
 
-                writer = vcf.Writer(out_fh, reader)
+            normal, tumour = _get_normal_tumour_values(header, records, ('DP', 'FDP', 'SDP'))
 
-            for record in reader:
-                normal = record.genotype('NORMAL')
+            filters = OrderedDict()
 
-                tumour = record.genotype('TUMOR')
+            # Normal depth filter
+            if use_depth_filter:
+                filters[FILTER_ID_DEPTH] = normal['DP'] > max_normal_coverage
 
-                # Normal depth filter
-                if use_depth_filter and (normal.data.DP > max_normal_coverage):
-                    record.add_filter(FILTER_ID_DEPTH)
+            # Filtered basecall fraction
+            filters[FILTER_ID_BASE] = (
+                (_get_fraction(normal['FDP'], normal['DP']) >= max_filtered_basecall_frac) |
+                (_get_fraction(tumour['FDP'], tumour['DP']) >= max_filtered_basecall_frac))
 
-                # Filtered basecall fraction
-                normal_filtered_base_call_fraction = _get_filtered_base_call_fraction(normal.data)
+            # Spanning deletion fraction
+            filters[FILTER_ID_SPANNING_DELETION] = (
+                (_get_fraction(normal['SDP'], normal['DP'] + normal['SDP']) > max_spanning_deletion_frac) |
+                (_get_fraction(tumour['SDP'], tumour['DP'] + tumour['SDP']) > max_spanning_deletion_frac))
 
-                tumour_filtered_base_call_fraction = _get_filtered_base_call_fraction(tumour.data)
+            # Q-val filter
+            filters[FILTER_ID_QSS] = _get_qval_filter(records, 'QSS_NT', quality_lower_bound)
 
-                if (normal_filtered_base_call_fraction >= max_filtered_basecall_frac) or \
-                   (tumour_filtered_base_call_fraction >= max_filtered_basecall_frac):
+            _write_records(out_fh, records, filters)
 
-                    record.add_filter(FILTER_ID_BASE)
 
-                # Spanning deletion fraction
-                normal_spanning_deletion_fraction = _get_spanning_deletion_fraction(normal.data)
+def summarize_normal_coverage(stats_files, chrom, out_file):
+    """ Summarize the normal coverage reported in the Strelka stats files of a chromosome.
 
-                tumour_spanning_deletion_fraction = _get_spanning_deletion_fraction(tumour.data)
+    :param stats_files: Dictionary of stats file paths for the regions of the chromosome.
+    :param chrom: Chromosome of the regions.
+    :param out_file: Path where the tab separated table of chromosome and total normal coverage will be written.
 
-                if (normal_spanning_deletion_fraction > max_spanning_deletion_frac) or \
-                   (tumour_spanning_deletion_fraction > max_spanning_deletion_frac):
+    Each stats file is parsed once, and the SNV and indel filters of the chromosome read its coverage from the table.
 
-                    record.add_filter(FILTER_ID_SPANNING_DELETION)
+    """
+    normal_coverage = 0
 
-                # Q-val filter
-                if (record.INFO['NT'] != 'ref') or (record.INFO['QSS_NT'] < quality_lower_bound):
-                    record.add_filter(FILTER_ID_QSS)
+    for region in sorted(stats_files):
+        normal_coverage += _get_normal_coverage(stats_files[region])
 
-                writer.write_record(record)
+    with open(out_file, 'w') as out_fh:
+        out_fh.write('chrom\tnormal_coverage\n')
 
-        writer.close()
+        out_fh.write('{0}\t{1!r}\n'.format(chrom, float(normal_coverage)))
 
 
-def _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files):
-    normal_coverage = _get_normal_coverage(stats_files.values())
+def _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, coverage_file):
+    normal_coverage = _read_normal_coverage(coverage_file)[str(chrom)]
 
     normal_mean_coverage = normal_coverage / known_chrom_size
 
@@ -204,48 +203,164 @@ def _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, sta
     return max_normal_coverage
 
 
-def _get_normal_coverage(stats_files):
-    total_coverage = 0
+def _read_normal_coverage(file_name):
+    normal_coverage = {}
+
+    with open(file_name) as fh:
+        reader = csv.DictReader(fh, delimiter='\t')
+
+        for row in reader:
+            normal_coverage[row['chrom']] = float(row['normal_coverage'])
+
+    return normal_coverage
+
+
+_mean_re = re.compile(r'mean:\s(.*?)\s')
+
+_sample_size_re = re.compile(r'sample_size:\s(.*?)\s')
 
-    for file_name in stats_files:
-        mean_matcher = re.compile('mean:\s(.*?)\s')
 
-        sample_size_matcher = re.compile('sample_size:\s(.*?)\s')
+def _get_normal_coverage(file_name):
+    total_coverage = 0
 
-        with open(file_name) as fh:
-            for line in fh:
-                if line.startswith('NORMAL_NO_REF_N_COVERAGE '):
-                    mean = float(mean_matcher.search(line).group(1))
+    with open(file_name) as fh:
+        for line in fh:
+            if line.startswith('NORMAL_NO_REF_N_COVERAGE '):
+                mean = float(_mean_re.search(line).group(1))
 
-                    sample_size = float(sample_size_matcher.search(line).group(1))
+                sample_size = float(_sample_size_re.search(line).group(1))
 
-                    if math.isnan(mean) or math.isnan(sample_size):
-                        continue
+                if math.isnan(mean) or math.isnan(sample_size):
+                    continue
 
-                    total_coverage += mean * sample_size
+                total_coverage += mean * sample_size
 
     return total_coverage
 
 
-def _get_filtered_base_call_fraction(data):
-    frac = 0
+def _read_vcf_records(file_name):
+    '''
+    Read the header lines and the records, split into fields, of a VCF file.
+    '''
+    header = []
 
-    if data.DP > 0:
-        frac = data.FDP / data.DP
+    records = []
 
-    return frac
+    with open_vcf(file_name) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                header.append(line.rstrip('\n'))
+
+            else:
+                records.append(line.rstrip('\n').split('\t'))
+
+    return header, records
+
+
+def _write_header(out_fh, header, filter_descs, format_descs=None):
+    '''
+    Write VCF header lines with definitions of the given filters and Float FORMAT fields replacing or added to the
+    existing definitions.
+    '''
+    definitions = OrderedDict()
+
+    if format_descs is not None:
+        for format_id, desc in format_descs.items():
+            definitions[('FORMAT', format_id)] = '##FORMAT=<ID={0},Number=1,Type=Float,Description="{1}">'.format(
+                format_id, desc)
+
+    for filter_id, desc in filter_descs.items():
+        definitions[('FILTER', filter_id)] = '##FILTER=<ID={0},Description="{1}">'.format(filter_id, desc)
+
+    lines = []
+
+    for line in header[:-1]:
+        match = _header_id_re.match(line)
+
+        if (match is not None) and (match.groups() in definitions):
+            line = definitions.pop(match.groups())
 
+        lines.append(line)
 
-def _get_spanning_deletion_fraction(data):
-    total = data.DP + data.SDP
+    lines.extend(definitions.values())
 
-    frac = 0
+    lines.append(header[-1])
 
-    if total > 0:
-        frac = data.SDP / total
+    out_fh.write(''.join([line + '\n' for line in lines]))
+
+
+_header_id_re = re.compile(r'##(\w+)=<ID=([^,>]+)')
+
+
+def _get_normal_tumour_values(header, records, keys):
+    '''
+    Get arrays of FORMAT values of the NORMAL and TUMOR samples.
+    '''
+    columns = header[-1].split('\t')
+
+    format_idx = columns.index('FORMAT')
+
+    format_key_indices = {}
+
+    sample_values = []
+
+    for sample in ('NORMAL', 'TUMOR'):
+        values = get_sample_values(records, format_idx, columns.index(sample), keys, format_key_indices)
+
+        sample_values.append(dict((key, values_to_array(values[key])) for key in keys))
+
+    return sample_values
+
+
+def _get_info_array(records, key):
+    return values_to_array([get_info_value(record[7], key) for record in records])
+
+
+def _get_fraction(numerator, denominator):
+    '''
+    Element wise fraction, 0 where the denominator is not positive.
+    '''
+    frac = np.zeros(len(numerator))
+
+    is_positive = denominator > 0
+
+    frac[is_positive] = numerator[is_positive] / denominator[is_positive]
 
     return frac
 
+
+def _get_qval_filter(records, qval_key, quality_lower_bound):
+    '''
+    Mask of records where the normal is not homozygous ref or the somatic Q-score is below the bound.
+    '''
+    normal_genotype = np.array([get_info_value(record[7], 'NT') for record in records], dtype=object)
+
+    return (normal_genotype != 'ref') | (_get_info_array(records, qval_key) < quality_lower_bound)
+
+
+def _write_records(out_fh, records, filters):
+    '''
+    Write split VCF records, adding each filter whose mask is set for a record to its FILTER column.
+    '''
+    filter_ids = list(filters.keys())
+
+    masks = np.array([filters[x] for x in filter_ids], dtype=bool).reshape(len(filter_ids), len(records))
+
+    for idx in np.flatnonzero(masks.any(axis=0)):
+        record = records[idx]
+
+        if record[6] in ('.', 'PASS'):
+            record_filters = []
+
+        else:
+            record_filters = record[6].split(';')
+
+        record_filters.extend([filter_ids[x] for x in np.flatnonzero(masks[:, idx])])
+
+        record[6] = ';'.join(record_filters)
+
+    out_fh.writelines(['\t'.join(record) + '\n' for record in records])
+
 #=======================================================================================================================
 # Indel filtering
 #=======================================================================================================================
@@ -253,7 +368,7 @@ def _get_spanning_deletion_fraction(data):
 
 def filter_indel_file_list(
         vcf_files,
-        stats_files,
+        coverage_file,
         window_files,
         out_file,
         chrom,
@@ -265,175 +380,187 @@ def filter_indel_file_list(
         quality_lower_bound=30,
         use_depth_filter=True):
 
-    window_cols = (
-        'chrom',
-        'coord',
-        'normal_window_used',
-        'normal_window_filtered',
-        'normal_window_submap',
-        'tumour_window_used',
-        'tumour_window_filtered',
-        'tumour_window_submap'
-    )
+    max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, coverage_file)
 
-    max_normal_coverage = _get_max_normal_coverage(chrom, depth_filter_multiple, known_chrom_size, stats_files)
+    format_descs = OrderedDict([
+        ('DP50', 'Average tier1 read depth within 50 bases'),
+        ('FDP50', 'Average tier1 number of basecalls filtered from original read depth within 50 bases'),
+        ('SUBDP50', 'Average number of reads below tier1 mapping quality threshold aligned across sites within 50 bases'),
+    ])
 
-    writer = None
+    filter_descs = OrderedDict()
 
-    with open(out_file, 'wb') as out_fh:
-        for key in sorted(vcf_files):
-            window = pd.read_csv(
-                window_files[key],
-                comment='#',
-                        converters={'chrom': str},
-                header=None,
-                names=window_cols,
-                sep='\t')
+    if use_depth_filter:
+        filter_descs[FILTER_ID_DEPTH] = 'Greater than {0}x chromosomal mean depth in Normal sample'.format(
+            depth_filter_multiple)
 
-            reader = vcf.Reader(filename=vcf_files[key])
+    filter_descs[FILTER_ID_REPEAT] = 'Sequence repeat of more than {0}x in the reference sequence'.format(max_ref_repeat)
 
-            if writer is None:
-                # Add format to header
-                reader.formats['DP50'] = vcf.parser._Format(
-                    id='DP50',
-                    num=1,
-                    type='Float',
-                    desc='Average tier1 read depth within 50 bases'
-                )
+    filter_descs[FILTER_ID_INDEL_HPOL] = 'Indel overlaps an interrupted homopolymer longer than {0}x in the reference sequence'.format(
+        max_int_hpol_length)
 
-                reader.formats['FDP50'] = vcf.parser._Format(
-                    id='FDP50',
-                    num=1,
-                    type='Float',
-                    desc='Average tier1 number of basecalls filtered from original read depth within 50 bases'
-                )
+    filter_descs[FILTER_ID_BASE] = 'Average fraction of filtered basecalls within 50 bases of the indel exceeds {0}'.format(
+        max_window_filtered_basecall_frac)
 
-                reader.formats['SUBDP50'] = vcf.parser._Format(
-                    id='SUBDP50',
-                    num=1,
-                    type='Float',
-                    desc='Average number of reads below tier1 mapping quality threshold aligned across sites within 50 bases'
-                )
+    filter_descs[FILTER_ID_QSI] = 'Normal sample is not homozygous ref or sindel Q-score < {0}, ie calls with NT!=ref or QSI_NT < {0}'.format(
+        quality_lower_bound)
 
-                # Add filters to header
-                if use_depth_filter:
-                    reader.filters[FILTER_ID_DEPTH] = vcf.parser._Filter(
-                        id=FILTER_ID_DEPTH,
-                        desc='Greater than {0}x chromosomal mean depth in Normal sample'.format(depth_filter_multiple)
-                    )
+    with open(out_file, 'w') as out_fh:
+        for file_idx, key in enumerate(sorted(vcf_files)):
+            window_index = _read_window_index(window_files[key])
 
-                reader.filters[FILTER_ID_REPEAT] = vcf.parser._Filter(
-                    id=FILTER_ID_REPEAT,
-                    desc='Sequence repeat of more than {0}x in the reference sequence'.format(max_ref_repeat)
-                )
+            header, records = _read_vcf_records(vcf_files[key])
 
-                reader.filters[FILTER_ID_INDEL_HPOL] = vcf.parser._Filter(
-                    id=FILTER_ID_INDEL_HPOL,
-                    desc='Indel overlaps an interrupted homopolymer longer than {0}x in the reference sequence'.format(
-                        max_int_hpol_length)
-                )
+            if file_idx == 0:
+                _write_header(out_fh, header, filter_descs, format_descs=format_descs)
 
-                reader.filters[FILTER_ID_BASE] = vcf.parser._Filter(
-                    id=FILTER_ID_BASE,
-                    desc='Average fraction of filtered basecalls within 50 bases of the indel exceeds {0}'.format(
-                        max_window_filtered_basecall_frac)
-                )
+            normal, tumour = _get_normal_tumour_values(header, records, ('DP',))
 
-                reader.filters[FILTER_ID_QSI] = vcf.parser._Filter(
-                    id=FILTER_ID_QSI,
-                    desc='Normal sample is not homozygous ref or sindel Q-score < {0}, ie calls with NT!=ref or QSI_NT < {0}'.format(
-                        quality_lower_bound)
-                )
+            window = _get_record_windows(window_index, records, window_files[key])
 
-                writer = vcf.Writer(out_fh, reader)
+            # Add window data to vcf record
+            for sample, data in (('NORMAL', normal), ('TUMOR', tumour)):
+                prefix = 'normal' if sample == 'NORMAL' else 'tumour'
 
-            for record in reader:
-                window_row = window.loc[
-                    (window['chrom'] == str(record.CHROM)) & (window['coord'] == record.POS)].iloc[0]
+                data['DP50'] = window[prefix + '_window_used'] + window[prefix + '_window_filtered']
 
-                normal = record.genotype('NORMAL')
+                data['FDP50'] = window[prefix + '_window_filtered']
 
-                tumour = record.genotype('TUMOR')
+                data['SUBDP50'] = window[prefix + '_window_submap']
 
-                normal_data = normal.data._asdict()
+            _add_format_values(header, records, format_descs.keys(), normal, tumour)
 
-                tumour_data = tumour.data._asdict()
+            filters = OrderedDict()
 
-                # Add window data to vcf record
-                record.add_format('DP50')
+            # Normal depth filter
+            if use_depth_filter:
+                filters[FILTER_ID_DEPTH] = normal['DP'] > max_normal_coverage
 
-                record.add_format('FDP50')
+            # Ref repeat
+            filters[FILTER_ID_REPEAT] = _get_info_array(records, 'RC') > max_ref_repeat
 
-                record.add_format('SUBDP50')
+            # Indel homopolymer
+            filters[FILTER_ID_INDEL_HPOL] = _get_info_array(records, 'IHP') > max_int_hpol_length
 
-                normal_data['DP50'] = window_row['normal_window_used'] + window_row['normal_window_filtered']
+            # Base filter
+            filters[FILTER_ID_BASE] = (
+                (_get_fraction(normal['FDP50'], normal['DP50']) >= max_window_filtered_basecall_frac) |
+                (_get_fraction(tumour['FDP50'], tumour['DP50']) >= max_window_filtered_basecall_frac))
 
-                normal_data['FDP50'] = window_row['normal_window_filtered']
+            # Q-val filter
+            filters[FILTER_ID_QSI] = _get_qval_filter(records, 'QSI_NT', quality_lower_bound)
 
-                normal_data['SUBDP50'] = window_row['normal_window_submap']
+            _write_records(out_fh, records, filters)
 
-                tumour_data['DP50'] = window_row['tumour_window_used'] + window_row['tumour_window_filtered']
 
-                tumour_data['FDP50'] = window_row['tumour_window_filtered']
+_window_cols = (
+    'chrom',
+    'coord',
+    'normal_window_used',
+    'normal_window_filtered',
+    'normal_window_submap',
+    'tumour_window_used',
+    'tumour_window_filtered',
+    'tumour_window_submap'
+)
 
-                tumour_data['SUBDP50'] = window_row['tumour_window_submap']
 
-                normal.data = _convert_dict_to_call(normal_data)
+def _read_window_index(file_name):
+    '''
+    Read a Strelka indel window file into a dict keyed by chromosome of sorted coordinates and the matching window
+    values, keeping the first row for duplicated coordinates.
+    '''
+    dtype = dict((col, np.float64) for col in _window_cols[2:])
 
-                tumour.data = _convert_dict_to_call(tumour_data)
+    dtype['chrom'] = str
 
-                # Add filters
+    dtype['coord'] = np.int64
 
-                # Normal depth filter
-                if use_depth_filter and (normal.data.DP > max_normal_coverage):
-                    record.add_filter(FILTER_ID_DEPTH)
+    window = pd.read_csv(file_name, comment='#', dtype=dtype, header=None, names=_window_cols, sep='\t')
 
-                # Ref repeat
-                if 'RC' in record.INFO:
-                    ref_repeat = record.INFO['RC']
+    window_index = {}
 
-                    if ref_repeat > max_ref_repeat:
-                        record.add_filter(FILTER_ID_REPEAT)
+    for chrom, chrom_window in window.groupby('chrom', sort=False):
+        order = np.argsort(chrom_window['coord'].values, kind='mergesort')
 
-                # Indel homopolymer
-                if 'IHP' in record.INFO:
-                    indel_homopolymer = record.INFO['IHP']
+        coords = chrom_window['coord'].values[order]
 
-                    if indel_homopolymer > max_int_hpol_length:
-                        record.add_filter(FILTER_ID_INDEL_HPOL)
+        is_first = np.ones(len(coords), dtype=bool)
+        is_first[1:] = coords[1:] != coords[:-1]
 
-                # Base filter
-                normal_filtered_base_call_fraction = _get_filtered_base_call_fraction_indel(normal.data)
+        window_index[chrom] = (
+            coords[is_first],
+            dict((col, chrom_window[col].values[order][is_first]) for col in _window_cols[2:]))
 
-                tumour_filtered_base_call_fraction = _get_filtered_base_call_fraction_indel(tumour.data)
+    return window_index
 
-                if (normal_filtered_base_call_fraction >= max_window_filtered_basecall_frac) or \
-                   (tumour_filtered_base_call_fraction >= max_window_filtered_basecall_frac):
 
-                    record.add_filter(FILTER_ID_BASE)
+def _get_record_windows(window_index, records, window_file):
+    '''
+    Get the window values matching the chromosome and coordinate of each record, as a dict of arrays. Raises a
+    ValueError naming the first record with no row in `window_file`.
+    '''
+    chroms = np.array([record[0] for record in records], dtype=object)
 
-                # Q-val filter
-                if (record.INFO['NT'] != 'ref') or (record.INFO['QSI_NT'] < quality_lower_bound):
-                    record.add_filter(FILTER_ID_QSI)
+    coords = np.array([record[1] for record in records], dtype=np.int64)
 
-                writer.write_record(record)
+    window = dict((col, np.full(len(records), np.nan)) for col in _window_cols[2:])
 
-        writer.close()
+    is_missing = np.ones(len(records), dtype=bool)
 
+    for chrom in set(chroms):
+        if chrom not in window_index:
+            continue
 
-def _convert_dict_to_call(data_dict):
-    call_data_class = vcf.model.make_calldata_tuple(data_dict.keys())
+        window_coords, window_values = window_index[chrom]
 
-    return call_data_class(**data_dict)
+        record_idx = np.flatnonzero(chroms == chrom)
 
+        idx = np.minimum(np.searchsorted(window_coords, coords[record_idx]), len(window_coords) - 1)
 
-def _get_filtered_base_call_fraction_indel(data):
-    frac = 0
+        is_found = window_coords[idx] == coords[record_idx]
 
-    if data.DP50 > 0:
-        frac = data.FDP50 / data.DP50
+        record_idx = record_idx[is_found]
 
-    return frac
+        idx = idx[is_found]
+
+        for col, values in window_values.items():
+            window[col][record_idx] = values[idx]
+
+        is_missing[record_idx] = False
+
+    if is_missing.any():
+        idx = np.flatnonzero(is_missing)[0]
+
+        raise ValueError('No window data for {0}:{1} in {2}'.format(records[idx][0], records[idx][1], window_file))
+
+    return window
+
+
+def _add_format_values(header, records, keys, normal, tumour):
+    '''
+    Append FORMAT keys to each record with the values of the NORMAL and TUMOR samples.
+    '''
+    columns = header[-1].split('\t')
+
+    format_idx = columns.index('FORMAT')
+
+    normal_idx = columns.index('NORMAL')
+
+    tumour_idx = columns.index('TUMOR')
+
+    format_suffix = ''.join([':' + key for key in keys])
+
+    normal_values = zip(*[normal[key].tolist() for key in keys])
+
+    tumour_values = zip(*[tumour[key].tolist() for key in keys])
+
+    for record, normal_record_values, tumour_record_values in zip(records, normal_values, tumour_values):
+        record[format_idx] += format_suffix
+
+        record[normal_idx] += ''.join([':' + str(x) for x in normal_record_values])
+
+        record[tumour_idx] += ''.join([':' + str(x) for x in tumour_record_values])
 
 #=======================================================================================================================
 # Write config file for make style strelka
@@ -527,36 +654,94 @@ def configure_run(normal_bam_file,
 #=======================================================================================================================
 
 
-def convert_vcf_to_hdf5(in_file, out_file, data_type='snv', table_name=None):
-    out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+def convert_vcf_to_hdf5(in_file, out_file, data_type='snv', table_name=None, all_alts=False, chunk_size=int(1e5)):
+    """ Convert a Strelka VCF to a table in an HDF5 file.
+
+    :param in_file: Path of Strelka VCF file, optionally gzip compressed.
+    :param out_file: Path where HDF5 file will be written.
+    :param data_type: Type of variants in the file, either `snv` or `indel`.
+    :param table_name: Name of table in `out_file`. Defaults to `strelka_{data_type}`.
+    :param all_alts: Write a row for every ALT allele of a record instead of only the first.
+    :param chunk_size: Number of records parsed and written to the table per append.
+
+    String column sizes are fixed from the longest value in a first pass over the text, which only measures lengths.
+    Records are then parsed into typed columns and appended one block at a time, so memory does not grow with the file.
 
-    reader = vcf.Reader(filename=in_file)
+    """
+    if data_type == 'snv':
+        qual_key = 'QSS'
+
+    elif data_type == 'indel':
+        qual_key = 'QSI'
+
+    else:
+        raise Exception('Unknown data type {0}'.format(data_type))
 
     if table_name is None:
         table_name = 'strelka_{0}'.format(data_type)
 
-    for record in reader:
-        row = OrderedDict()
+    start = time.time()
+
+    min_itemsize = _get_strelka_vcf_itemsize(in_file, all_alts=all_alts, chunk_size=chunk_size)
+
+    out_store = pd.HDFStore(out_file, 'w', complevel=9, complib='blosc')
+
+    num_rows = 0
+
+    for df in _iter_strelka_vcf_blocks(in_file, qual_key, all_alts=all_alts, chunk_size=chunk_size):
+        df.index = range(num_rows, num_rows + len(df.index))
+
+        out_store.append(table_name, df, min_itemsize=min_itemsize, index=False)
 
-        row['chrom'] = str(record.CHROM)
+        num_rows += len(df.index)
+
+    if num_rows > 0:
+        out_store.create_table_index(table_name)
+
+    out_store.close()
 
-        row['coord'] = int(record.POS)
+    elapsed = time.time() - start
 
-        row['ref_base'] = str(record.REF)
+    logging.getLogger(__name__).info('converted {0} rows in {1:.2f}s ({2:.0f} rows/s)'.format(
+        num_rows, elapsed, num_rows / max(elapsed, 1e-6)))
 
-        row['alt_base'] = str(record.ALT[0])
 
-        if data_type == 'snv':
-            row['qual'] = float(record.INFO['QSS'])
+def _get_strelka_vcf_itemsize(in_file, all_alts=False, chunk_size=int(1e5)):
+    '''
+    Find the longest chrom, ref_base and alt_base values of a Strelka VCF, at least 8.
+    '''
+    min_itemsize = OrderedDict((col, 8) for col in ('chrom', 'ref_base', 'alt_base'))
 
-        elif data_type == 'indel':
-            row['qual'] = float(record.INFO['QSI'])
+    for batch in read_record_batches(in_file, batch_size=chunk_size, num_fields=5):
+        if all_alts:
+            alt_len = max(len(x) for fields in batch for x in fields[4].split(','))
 
         else:
-            raise Exception('Unknown data type {0}'.format(data_type))
+            alt_len = max(len(fields[4].split(',', 1)[0]) for fields in batch)
 
-        row = pd.DataFrame([pd.Series(row)])
+        min_itemsize['chrom'] = max(min_itemsize['chrom'], max(len(fields[0]) for fields in batch))
 
-        out_store.append(table_name, row)
+        min_itemsize['ref_base'] = max(min_itemsize['ref_base'], max(len(fields[3]) for fields in batch))
 
-    out_store.close()
+        min_itemsize['alt_base'] = max(min_itemsize['alt_base'], alt_len)
+
+    return min_itemsize
+
+
+def _iter_strelka_vcf_blocks(in_file, qual_key, all_alts=False, chunk_size=int(1e5)):
+    '''
+    Iterate over blocks of the chrom, coord, ref_base, alt_base and qual columns of a Strelka VCF as data frames.
+    '''
+    for batch in read_record_batches(in_file, batch_size=chunk_size, num_fields=8):
+        if all_alts:
+            batch = [fields[:4] + [x] + fields[5:] for fields in batch for x in fields[4].split(',')]
+
+        yield pd.DataFrame(
+            OrderedDict([
+                ('chrom', np.array([fields[0] for fields in batch], dtype=object)),
+                ('coord', np.array([fields[1] for fields in batch], dtype=np.int64)),
+                ('ref_base', np.array([fields[3] for fields in batch], dtype=object)),
+                ('alt_base', np.array([fields[4].split(',', 1)[0] for fields in batch], dtype=object)),
+                ('qual', values_to_array([get_info_value(fields[7], qual_key) for fields in batch])),
+            ])
+        )
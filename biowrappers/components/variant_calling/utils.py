@@ -5,7 +5,10 @@ Created on Oct 31, 2015
 '''
 from collections import OrderedDict
 
+import numpy as np
+import os
 import pysam
+import struct
 import vcf
 import pandas as pd
 
@@ -13,18 +16,36 @@ import pandas as pd
 default_chromosomes = [str(x) for x in range(1, 23)] + ['X', 'Y']
 
 
-def get_regions(chromosome_lengths, split_size):
+def get_regions(chromosome_lengths, split_size, read_loads=None):
+    """ Split chromosomes into regions.
+
+    :param chromosome_lengths: Dictionary of chromosome lengths.
+    :param split_size: Target region size. If None each chromosome is a region.
+    :param read_loads: Optional dictionary of read load per index window for each chromosome, see
+        `load_bam_index_read_loads`. Chromosomes with loads are split into as many regions as for fixed size splitting,
+        but with region boundaries placed so regions have roughly equal read load.
+
+    """
     if split_size is None:
         return dict(enumerate(chromosome_lengths.keys()))
 
+    if read_loads is None:
+        read_loads = {}
+
     regions = {}
     region_index = 0
 
     for chrom, length in chromosome_lengths.items():
-        lside_interval = range(1, length + 1, split_size)
-        rside_interval = range(split_size, length + split_size, split_size)
+        if chrom in read_loads:
+            intervals = split_by_read_load(length, split_size, read_loads[chrom])
+
+        else:
+            lside_interval = range(1, length + 1, split_size)
+            rside_interval = range(split_size, length + split_size, split_size)
 
-        for beg, end in zip(lside_interval, rside_interval):
+            intervals = zip(lside_interval, rside_interval)
+
+        for beg, end in intervals:
             end = min(end, length)
 
             regions[region_index] = '{}:{}-{}'.format(chrom, beg, end)
@@ -33,6 +54,47 @@ def get_regions(chromosome_lengths, split_size):
     return regions
 
 
+def split_by_read_load(length, split_size, window_loads, window_size=16384):
+    """ Split a chromosome into regions of roughly equal read load.
+
+    :param length: Chromosome length.
+    :param split_size: Target mean region size, which sets the number of regions.
+    :param window_loads: Read load of each consecutive `window_size` window of the chromosome.
+    :param window_size: Size of the windows, 16kb for the BAM index linear index.
+
+    Returns a list of (beg, end) 1-based inclusive intervals covering the chromosome, with boundaries on window
+    boundaries. Chromosomes without read load are split evenly.
+
+    """
+    num_windows = -(-length // window_size)
+
+    num_regions = min(max(-(-length // split_size), 1), num_windows)
+
+    weights = np.zeros(num_windows)
+
+    window_loads = np.asarray(window_loads, dtype=np.float64)[:num_windows]
+
+    weights[:len(window_loads)] = window_loads
+
+    if weights.sum() <= 0:
+        weights[:] = 1
+
+    cumulative = np.cumsum(weights)
+
+    targets = cumulative[-1] * np.arange(1, num_regions) / num_regions
+
+    # Regions end after the window in which the cumulative load reaches each target
+    ends = np.searchsorted(cumulative, targets) + 1
+
+    ends = np.unique(np.clip(ends, 1, num_windows - 1)) * window_size
+
+    begs = np.concatenate([[0], ends]) + 1
+
+    ends = np.concatenate([ends, [length]])
+
+    return list(zip(begs.tolist(), ends.tolist()))
+
+
 def get_vcf_regions(vcf_file, split_size, chromosomes=None):
     if split_size is None:
         return dict(enumerate(chromosomes))
@@ -40,9 +102,136 @@ def get_vcf_regions(vcf_file, split_size, chromosomes=None):
     return get_regions(chromosome_lengths, split_size)
 
 
-def get_bam_regions(bam_file, split_size, chromosomes=None):
+def get_bam_regions(bam_file, split_size, chromosomes=None, balance_read_load=False):
     chromosome_lengths = load_bam_chromosome_lengths(bam_file, chromosomes=chromosomes)
-    return get_regions(chromosome_lengths, split_size)
+
+    read_loads = None
+
+    if balance_read_load and split_size is not None:
+        read_loads = load_bam_index_read_loads(bam_file, chromosomes=chromosomes)
+
+    return get_regions(chromosome_lengths, split_size, read_loads=read_loads)
+
+
+def load_bam_index_read_loads(bam_file, chromosomes=None):
+    """ Estimate the read load of each 16kb window of the chromosomes of a BAM file from its index.
+
+    :param bam_file: Path of BAM file, indexed as `bam_file`.bai or with the .bam extension replaced by .bai.
+    :param chromosomes: Chromosomes to load, all chromosomes of the BAM file if None.
+
+    The load of a window is the size of the compressed BAM data between the linear index offsets of the window and the
+    next, which is proportional to the number of reads starting in the window. Returns a dictionary of load arrays
+    keyed by chromosome, empty if no .bai index is found, so callers fall back to fixed size regions. Other index
+    formats such as CSI are not parsed.
+
+    """
+    index_file = _find_bam_index(bam_file)
+
+    if index_file is None:
+        return {}
+
+    # References in index order
+    references = list(load_bam_chromosome_lengths(bam_file).keys())
+
+    if chromosomes is None:
+        chromosomes = references
+
+    else:
+        chromosomes = [str(x) for x in chromosomes]
+
+    with open(index_file, 'rb') as fh:
+        data = fh.read()
+
+    if data[:4] != b'BAI\1':
+        return {}
+
+    num_refs, = struct.unpack_from('<i', data, 4)
+
+    offset = 8
+
+    read_loads = {}
+
+    for ref_idx in range(num_refs):
+        num_bins, = struct.unpack_from('<i', data, offset)
+        offset += 4
+
+        ref_beg = None
+
+        ref_end = None
+
+        for _ in range(num_bins):
+            bin_id, num_chunks = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+
+            # The pseudo bin holds the virtual offsets of the first and last read of the reference
+            if bin_id == _bai_pseudo_bin:
+                ref_beg, ref_end = struct.unpack_from('<QQ', data, offset)
+
+            offset += 16 * num_chunks
+
+        num_intervals, = struct.unpack_from('<i', data, offset)
+        offset += 4
+
+        intervals = np.frombuffer(data, dtype='<u8', count=num_intervals, offset=offset)
+        offset += 8 * num_intervals
+
+        if references[ref_idx] not in chromosomes:
+            continue
+
+        if num_intervals == 0:
+            read_loads[references[ref_idx]] = np.zeros(0)
+
+            continue
+
+        if ref_beg is None:
+            ref_beg = intervals[intervals > 0][0] if (intervals > 0).any() else 0
+
+        if ref_end is None:
+            ref_end = intervals[-1]
+
+        # Offset of the block holding the first read of each window. Windows without reads may be left at 0, so offsets
+        # start from the first read of the reference rather than from the data of earlier references
+        block_offsets = np.maximum.accumulate(np.maximum((intervals >> 16).astype(np.int64), int(ref_beg) >> 16))
+
+        block_offsets = np.append(block_offsets, max(ref_end >> 16, block_offsets[-1]))
+
+        read_loads[references[ref_idx]] = np.diff(block_offsets).astype(np.float64)
+
+    return read_loads
+
+
+_bai_pseudo_bin = 37450
+
+
+def sum_read_loads(read_loads):
+    """ Sum the read loads of several BAM files, such as the normal and tumour of a paired caller.
+
+    :param read_loads: List of dictionaries of read load arrays, as from `load_bam_index_read_loads`.
+
+    Only chromosomes with loads for every BAM file are returned.
+
+    """
+    chromosomes = set.intersection(*[set(x.keys()) for x in read_loads])
+
+    summed = {}
+
+    for chrom in chromosomes:
+        num_windows = max([len(x[chrom]) for x in read_loads])
+
+        summed[chrom] = np.zeros(num_windows)
+
+        for x in read_loads:
+            summed[chrom][:len(x[chrom])] += x[chrom]
+
+    return summed
+
+
+def _find_bam_index(bam_file):
+    for index_file in (bam_file + '.bai', os.path.splitext(bam_file)[0] + '.bai'):
+        if os.path.exists(index_file):
+            return index_file
+
+    return None
 
 
 def calculate_vcf_chromosome_lengths(file_name, chromosomes=None):
@@ -115,6 +304,8 @@ def load_bam_chromosome_lengths(file_name, chromosomes=None):
 
         chromosome_lengths[str(chrom)] = int(length)
 
+    bam.close()
+
     return chromosome_lengths
 
 
@@ -23,6 +23,16 @@ def call_and_annotate_pipeline(
     somatic_breakpoint_file=None,
     patient_config=None,
 ):
+    """ Extract seqdata from each bam and call copy number with each configured caller.
+
+    If `config` sets `seqdata_cache_dir` the TITAN, cloneHD and THetA callers share a cache of decoded seqdata columns
+    in that directory, unless a caller config sets its own `seqdata_cache_dir`. Without it seqdata is read directly.
+    The cache takes about 2.4 times the disk space of the seqdata files. It is kept after the pipeline finishes so
+    reruns reuse it, entries for seqdata files that have been rewritten are removed when the cache is next written to,
+    and the directory can be deleted once the pipeline is done.
+    TITAN can also cache its sweep results, if its config sets `sweep_cache_dir`.
+
+    """
     sample_ids = bam_files.keys()
 
     tumour_ids = bam_files.keys()
@@ -43,6 +53,14 @@ def call_and_annotate_pipeline(
 
     seq_data_template = os.path.join(raw_data_dir, 'seqdata', 'sample_{sample_id}.h5')
 
+    # Optional, seqdata decoded by one caller is reused by the others
+    seqdata_cache_dir = config.get('seqdata_cache_dir')
+
+    if seqdata_cache_dir is not None:
+        for caller in ('titan', 'clonehd', 'theta'):
+            if caller in config:
+                config[caller]['config'].setdefault('seqdata_cache_dir', seqdata_cache_dir)
+
     if somatic_breakpoint_file is not None:
         somatic_breakpoint_file = pypeliner.managed.InputFile(somatic_breakpoint_file)
 
@@ -59,7 +59,7 @@ def call_and_annotate_pipeline(
                 '/snv/vcf/nuseq_multi_sample/all',
             ),
             kwargs={
-                'score_callback': vcf_score_callbacks['snv']['nuseq']
+                'score_info_key': vcf_score_info_keys['snv']['nuseq']
             }
         )
 
@@ -133,21 +133,25 @@ def call_and_annotate_pipeline(
                     )
                 ),
                 kwargs={
-                    'score_callback': vcf_score_callbacks[var_type][prog]
+                    'score_info_key': vcf_score_info_keys[var_type][prog]
                 }
             )
 
+    # Optional, num_processes merges chromosomes in parallel
+    merge_vcfs_kwargs = config.get('merge_vcfs', {}).get('kwargs', {})
+
     #===================================================================================================================
     # Indel annotation
     #===================================================================================================================
     workflow.transform(
         name='merge_indels',
         ctx=big_mem_ctx,
-        func='biowrappers.components.io.vcf.tasks.vcf_tasks.merge_vcfs',
+        func='biowrappers.components.io.vcf.tasks.merge_vcfs',
         args=(
             [x.as_input() for x in variant_files['indel']['vcf'].values()],
             pypeliner.managed.TempOutputFile('all.indel.vcf')
-        )
+        ),
+        kwargs=merge_vcfs_kwargs
     )
 
     workflow.transform(
@@ -184,7 +188,8 @@ def call_and_annotate_pipeline(
         args=(
             [x.as_input() for x in variant_files['snv']['vcf'].values()],
             pypeliner.managed.TempOutputFile('all.snv.vcf')
-        )
+        ),
+        kwargs=merge_vcfs_kwargs
     )
 
     workflow.transform(
@@ -441,24 +446,13 @@ def get_kwargs(config, table_name):
     return config
 
 
-def nuseq_callback(record):
-    return record.INFO['PS']
-
-
-def strelka_indel_callback(record):
-    return record.INFO['QSI']
-
-
-def strelka_snv_callback(record):
-    return record.INFO['QSS']
-
-vcf_score_callbacks = {
+vcf_score_info_keys = {
     'indel': {
-        'strelka': strelka_indel_callback,
+        'strelka': 'QSI',
     },
     'snv': {
         'mutect': None,
-        'nuseq': nuseq_callback,
-        'strelka': strelka_snv_callback,
+        'nuseq': 'PS',
+        'strelka': 'QSS',
     }
 }
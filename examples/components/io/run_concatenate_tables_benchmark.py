@@ -0,0 +1,101 @@
+'''
+Benchmark on-disk concatenation of many small HDF5 stores.
+
+Writes `num_inputs` stores, alternating fixed and table format, then concatenates them with `concatenate_tables` in a
+new process for each mode and reports wall clock time and peak RSS.
+'''
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import resource
+import shutil
+import tempfile
+import time
+
+import biowrappers.components.io.hdf5.tasks as hdf5_tasks
+
+
+def write_inputs(out_dir, num_inputs, rows_per_input, seed=0):
+    random = np.random.RandomState(seed)
+
+    in_files = {}
+
+    for idx in range(num_inputs):
+        df = pd.DataFrame({
+            'chrom': random.choice([str(x) for x in range(1, 23)], size=rows_per_input),
+            'coord': random.randint(0, int(2.5e8), size=rows_per_input),
+            'ref': random.choice(list('ACGT'), size=rows_per_input),
+            'alt': random.choice(list('ACGT'), size=rows_per_input),
+            'score': random.uniform(size=rows_per_input),
+        }, columns=['chrom', 'coord', 'ref', 'alt', 'score'])
+
+        in_files[idx] = os.path.join(out_dir, 'input_{0}.h5'.format(idx))
+
+        with pd.HDFStore(in_files[idx], 'w') as store:
+            if idx % 2 == 0:
+                store.put('/snv', df, format='table')
+
+            else:
+                store.put('/snv', df)
+
+    return in_files
+
+
+def run_concatenate(in_files, out_file, non_numeric_as_category):
+    # Peak resident set size in kilobytes on Linux, including the interpreter and imported modules
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    start = time.time()
+
+    hdf5_tasks.concatenate_tables(in_files, out_file, in_memory=False, non_numeric_as_category=non_numeric_as_category)
+
+    elapsed = time.time() - start
+
+    return elapsed, start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def main(args):
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+
+    try:
+        in_files = write_inputs(tmp_dir, args.num_inputs, args.rows_per_input)
+
+        for non_numeric_as_category in (True, False):
+            # A new process for each mode so peak memory is measured separately
+            pool = multiprocessing.Pool(1)
+
+            try:
+                elapsed, start_rss, peak_rss = pool.apply(
+                    run_concatenate,
+                    (in_files, os.path.join(tmp_dir, 'out.h5'), non_numeric_as_category)
+                )
+
+            finally:
+                pool.close()
+
+                pool.join()
+
+            print('{0} mode: {1} inputs, {2} rows, {3:.1f}s, peak RSS {4:.0f}MB (at start {5:.0f}MB)'.format(
+                'categorical' if non_numeric_as_category else 'string',
+                args.num_inputs,
+                args.num_inputs * args.rows_per_input,
+                elapsed,
+                peak_rss,
+                start_rss))
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_inputs', type=int, default=1000)
+    parser.add_argument('--rows_per_input', type=int, default=1500)
+    parser.add_argument('--tmp_dir', default=None)
+
+    args = parser.parse_args()
+
+    main(args)
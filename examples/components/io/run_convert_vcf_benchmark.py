@@ -0,0 +1,110 @@
+'''
+Benchmark conversion of a VCF file to an HDF5 table.
+
+Writes a VCF with `num_records` records, a fraction with several alt alleles, then converts it with
+`convert_vcf_to_hdf5` in a new process for each mode and reports wall clock time and peak RSS. The text mode parses the
+raw VCF text, the pyvcf mode takes the score from PyVCF records with a score callback.
+'''
+import multiprocessing
+import numpy as np
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import biowrappers.components.io.vcf.tasks as vcf_tasks
+
+
+def write_vcf(vcf_file, num_records, seed=0):
+    random = np.random.RandomState(seed)
+
+    chroms = [str(x) for x in range(1, 23)]
+
+    batch_size = 100000
+
+    with open(vcf_file, 'w') as fh:
+        fh.write('##fileformat=VCFv4.1\n')
+        fh.write('##INFO=<ID=PS,Number=1,Type=Float,Description="Probability somatic">\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+
+        coord = 0
+
+        for beg in range(0, num_records, batch_size):
+            size = min(batch_size, num_records - beg)
+
+            alts = random.choice(['A', 'C', 'G', 'T', 'A,C', 'G,T'], p=[0.24, 0.24, 0.24, 0.24, 0.02, 0.02], size=size)
+
+            for alt, qual, score in zip(alts, random.randint(1, 100, size=size), random.uniform(size=size)):
+                coord += 1
+
+                fh.write('{0}\t{1}\t.\tN\t{2}\t{3}\tPASS\tPS={4:.3f}\n'.format(
+                    chroms[coord * len(chroms) // (num_records + 1)], coord, alt, qual, score))
+
+
+def qual_score(record):
+    return record.QUAL
+
+
+def run_convert(vcf_file, out_file, mode):
+    # Peak resident set size in kilobytes on Linux, including the interpreter and imported modules
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    start = time.time()
+
+    if mode == 'text':
+        vcf_tasks.convert_vcf_to_hdf5(vcf_file, out_file, '/snv')
+
+    else:
+        vcf_tasks.convert_vcf_to_hdf5(vcf_file, out_file, '/snv', score_callback=qual_score)
+
+    elapsed = time.time() - start
+
+    return elapsed, start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def main(args):
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+
+    try:
+        vcf_file = os.path.join(tmp_dir, 'input.vcf')
+
+        write_vcf(vcf_file, args.num_records)
+
+        for mode in args.modes:
+            # A new process for each mode so peak memory is measured separately
+            pool = multiprocessing.Pool(1)
+
+            try:
+                elapsed, start_rss, peak_rss = pool.apply(
+                    run_convert,
+                    (vcf_file, os.path.join(tmp_dir, 'out.h5'), mode)
+                )
+
+            finally:
+                pool.close()
+
+                pool.join()
+
+            print('{0} mode: {1} records, {2:.1f}s, peak RSS {3:.0f}MB (at start {4:.0f}MB)'.format(
+                mode,
+                args.num_records,
+                elapsed,
+                peak_rss,
+                start_rss))
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_records', type=int, default=2000000)
+    parser.add_argument('--modes', nargs='+', default=['text', 'pyvcf'], choices=['text', 'pyvcf'])
+    parser.add_argument('--tmp_dir', default=None)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,82 @@
+'''
+Benchmark merging the positions of several VCF files.
+
+Writes `num_inputs` bgzip compressed and tabix indexed VCFs with overlapping positions, then merges them with
+`merge_vcfs` for each number of processes and reports wall clock time.
+'''
+import numpy as np
+import os
+import pysam
+import shutil
+import tempfile
+import time
+
+import biowrappers.components.io.vcf.tasks as vcf_tasks
+
+
+def write_inputs(out_dir, num_inputs, records_per_input, num_chroms=22, seed=0):
+    random = np.random.RandomState(seed)
+
+    chroms = [str(x) for x in range(1, num_chroms + 1)]
+
+    in_files = []
+
+    for idx in range(num_inputs):
+        vcf_file = os.path.join(out_dir, 'input_{0}.vcf'.format(idx))
+
+        # Positions are drawn from a shared range so inputs overlap
+        chrom_idx = np.sort(random.randint(0, num_chroms, size=records_per_input))
+
+        coords = random.randint(1, 10 * records_per_input // num_chroms, size=records_per_input)
+
+        order = np.lexsort((coords, chrom_idx))
+
+        with open(vcf_file, 'w') as fh:
+            fh.write('##fileformat=VCFv4.1\n')
+            fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+
+            for i in order:
+                fh.write('{0}\t{1}\t.\tA\t{2}\t.\t.\t.\n'.format(chroms[chrom_idx[i]], coords[i], 'CGT'[coords[i] % 3]))
+
+        pysam.tabix_compress(vcf_file, vcf_file + '.gz')
+
+        pysam.tabix_index(vcf_file + '.gz', preset='vcf')
+
+        in_files.append(vcf_file + '.gz')
+
+    return in_files
+
+
+def main(args):
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+
+    try:
+        in_files = write_inputs(tmp_dir, args.num_inputs, args.records_per_input)
+
+        for num_processes in args.num_processes:
+            start = time.time()
+
+            vcf_tasks.merge_vcfs(in_files, os.path.join(tmp_dir, 'merged.vcf'), num_processes=num_processes)
+
+            print('{0} processes: {1} inputs, {2} records, {3:.1f}s'.format(
+                num_processes,
+                args.num_inputs,
+                args.num_inputs * args.records_per_input,
+                time.time() - start))
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_inputs', type=int, default=8)
+    parser.add_argument('--records_per_input', type=int, default=500000)
+    parser.add_argument('--num_processes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--tmp_dir', default=None)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,115 @@
+'''
+Benchmark conversion of Strelka VCFs to HDF5 tables.
+
+Writes synthetic Strelka SNV and indel VCFs with `num_records` records, then converts each with `convert_vcf_to_hdf5`
+in a new process and reports wall clock time and peak RSS.
+'''
+import multiprocessing
+import numpy as np
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import biowrappers.components.variant_calling.strelka.tasks as strelka_tasks
+
+header = '''##fileformat=VCFv4.1
+##INFO=<ID=QSS,Number=1,Type=Integer,Description="Quality score for any somatic snv">
+##INFO=<ID=QSI,Number=1,Type=Integer,Description="Quality score for any somatic variant">
+##INFO=<ID=NT,Number=1,Type=String,Description="Genotype of the normal in all data tiers">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth for tier1">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	NORMAL	TUMOR
+'''
+
+
+def write_vcf(vcf_file, data_type, num_records, seed=0):
+    random = np.random.RandomState(seed)
+
+    qual_key = 'QSS' if data_type == 'snv' else 'QSI'
+
+    chroms = [str(x) for x in range(1, 23)]
+
+    batch_size = 100000
+
+    with open(vcf_file, 'w') as fh:
+        fh.write(header)
+
+        coord = 0
+
+        for beg in range(0, num_records, batch_size):
+            size = min(batch_size, num_records - beg)
+
+            if data_type == 'snv':
+                alts = random.choice(['C', 'G', 'T', 'C,G'], p=[0.33, 0.33, 0.33, 0.01], size=size)
+
+            else:
+                # Indel alleles of varied length, so string columns are sized from the longest
+                alts = ['A' + 'T' * x for x in random.geometric(0.3, size=size)]
+
+            for alt, qual, dp in zip(alts, random.randint(0, 100, size=size), random.randint(0, 100, size=size)):
+                coord += 1
+
+                fh.write('{0}\t{1}\t.\tA\t{2}\t.\tPASS\tNT=ref;{3}={4}\tDP\t{5}\t{5}\n'.format(
+                    chroms[coord * len(chroms) // (num_records + 1)], coord, alt, qual_key, qual, dp))
+
+
+def run_convert(vcf_file, out_file, data_type):
+    # Peak resident set size in kilobytes on Linux, including the interpreter and imported modules
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    start = time.time()
+
+    strelka_tasks.convert_vcf_to_hdf5(vcf_file, out_file, data_type=data_type)
+
+    elapsed = time.time() - start
+
+    return elapsed, start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def main(args):
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+
+    try:
+        for data_type in ('snv', 'indel'):
+            vcf_file = os.path.join(tmp_dir, '{0}.vcf'.format(data_type))
+
+            write_vcf(vcf_file, data_type, args.num_records)
+
+            # A new process for each file so peak memory is measured separately
+            pool = multiprocessing.Pool(1)
+
+            try:
+                elapsed, start_rss, peak_rss = pool.apply(
+                    run_convert,
+                    (vcf_file, os.path.join(tmp_dir, '{0}.h5'.format(data_type)), data_type)
+                )
+
+            finally:
+                pool.close()
+
+                pool.join()
+
+            print('{0}: {1} records, {2:.1f}s, peak RSS {3:.0f}MB (at start {4:.0f}MB)'.format(
+                data_type,
+                args.num_records,
+                elapsed,
+                peak_rss,
+                start_rss))
+
+            os.remove(vcf_file)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_records', type=int, default=2000000)
+    parser.add_argument('--tmp_dir', default=None)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,125 @@
+'''
+Benchmark filtering of Strelka SNV and indel calls.
+
+Writes `num_regions` synthetic Strelka SNV and indel VCFs of one chromosome, with indel window files and a normal
+coverage table, then filters them with `filter_snv_file_list` and `filter_indel_file_list` and reports wall clock time.
+'''
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+import biowrappers.components.variant_calling.strelka.tasks as strelka_tasks
+
+chrom_size = int(1e8)
+
+snv_header = '''##fileformat=VCFv4.1
+##INFO=<ID=QSS_NT,Number=1,Type=Integer,Description="Quality score reflecting the joint probability">
+##INFO=<ID=NT,Number=1,Type=String,Description="Genotype of the normal in all data tiers">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth for tier1">
+##FORMAT=<ID=FDP,Number=1,Type=Integer,Description="Number of basecalls filtered from original read depth">
+##FORMAT=<ID=SDP,Number=1,Type=Integer,Description="Number of reads with deletions spanning this site">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	NORMAL	TUMOR
+'''
+
+indel_header = '''##fileformat=VCFv4.1
+##INFO=<ID=QSI_NT,Number=1,Type=Integer,Description="Quality score reflecting the joint probability">
+##INFO=<ID=NT,Number=1,Type=String,Description="Genotype of the normal in all data tiers">
+##INFO=<ID=RC,Number=1,Type=Integer,Description="Number of times RU repeats in the reference allele">
+##INFO=<ID=IHP,Number=1,Type=Integer,Description="Largest reference interrupted homopolymer length">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth for tier1">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	NORMAL	TUMOR
+'''
+
+
+def write_inputs(out_dir, num_regions, records_per_region, seed=0):
+    random = np.random.RandomState(seed)
+
+    snv_files = {}
+
+    indel_files = {}
+
+    window_files = {}
+
+    region_size = chrom_size // num_regions
+
+    for region_idx in range(num_regions):
+        coords = np.sort(random.choice(region_size, size=records_per_region, replace=False)) + 1
+        coords += region_idx * region_size
+
+        dp = random.randint(0, 120, size=(records_per_region, 2))
+
+        nt = random.choice(['ref', 'het'], p=[0.9, 0.1], size=records_per_region)
+
+        qual = random.randint(0, 60, size=records_per_region)
+
+        snv_files[region_idx] = os.path.join(out_dir, 'snv_{0}.vcf'.format(region_idx))
+
+        with open(snv_files[region_idx], 'w') as fh:
+            fh.write(snv_header)
+
+            for coord, (normal_dp, tumour_dp), record_nt, record_qual in zip(coords, dp, nt, qual):
+                fh.write('1\t{0}\t.\tA\tC\t.\tPASS\tNT={1};QSS_NT={2}\tDP:FDP:SDP\t{3}:{4}:0\t{5}:{6}:1\n'.format(
+                    coord, record_nt, record_qual, normal_dp, normal_dp // 10, tumour_dp, tumour_dp // 5))
+
+        indel_files[region_idx] = os.path.join(out_dir, 'indel_{0}.vcf'.format(region_idx))
+
+        window_files[region_idx] = os.path.join(out_dir, 'window_{0}.txt'.format(region_idx))
+
+        with open(indel_files[region_idx], 'w') as fh, open(window_files[region_idx], 'w') as window_fh:
+            fh.write(indel_header)
+
+            for coord, (normal_dp, tumour_dp), record_nt, record_qual in zip(coords, dp, nt, qual):
+                fh.write('1\t{0}\t.\tA\tAT\t.\tPASS\tNT={1};QSI_NT={2};RC={3};IHP={4}\tDP\t{5}\t{6}\n'.format(
+                    coord, record_nt, record_qual, record_qual % 12, record_qual % 20, normal_dp, tumour_dp))
+
+                window_fh.write('1\t{0}\t{1}\t{2}\t0.0\t{3}\t{4}\t0.0\n'.format(
+                    coord, float(normal_dp), normal_dp / 8., float(tumour_dp), tumour_dp / 4.))
+
+    coverage_file = os.path.join(out_dir, 'coverage.tsv')
+
+    with open(coverage_file, 'w') as fh:
+        fh.write('chrom\tnormal_coverage\n1\t{0}\n'.format(30. * chrom_size))
+
+    return snv_files, indel_files, window_files, coverage_file
+
+
+def main(args):
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+
+    try:
+        snv_files, indel_files, window_files, coverage_file = write_inputs(
+            tmp_dir, args.num_regions, args.records_per_region)
+
+        num_records = args.num_regions * args.records_per_region
+
+        start = time.time()
+
+        strelka_tasks.filter_snv_file_list(
+            snv_files, coverage_file, os.path.join(tmp_dir, 'snv.vcf'), '1', chrom_size)
+
+        print('snv: {0} regions, {1} records, {2:.1f}s'.format(args.num_regions, num_records, time.time() - start))
+
+        start = time.time()
+
+        strelka_tasks.filter_indel_file_list(
+            indel_files, coverage_file, window_files, os.path.join(tmp_dir, 'indel.vcf'), '1', chrom_size)
+
+        print('indel: {0} regions, {1} records, {2:.1f}s'.format(args.num_regions, num_records, time.time() - start))
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_regions', type=int, default=8)
+    parser.add_argument('--records_per_region', type=int, default=30000)
+    parser.add_argument('--tmp_dir', default=None)
+
+    args = parser.parse_args()
+
+    main(args)
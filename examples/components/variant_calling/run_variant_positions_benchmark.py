@@ -0,0 +1,92 @@
+'''
+Benchmark variant position filtering of strand count matrices.
+
+Builds synthetic `num_positions` x 8 strand count matrices for `num_samples` tumour samples, filters them as
+`get_variant_position_counts` does and reports wall clock time. The row-wise pandas apply used before is timed on the
+first `num_apply_positions` positions of each sample, for comparison.
+'''
+import numpy as np
+import pandas as pd
+import time
+
+from biowrappers.components.variant_calling.snv_allele_counts.tasks import _get_variant_positions, nucleotides
+
+
+def get_variant_positions_apply(row, min_variant_depth):
+    counts = sorted([row[x.lower()] + row[x.upper()] for x in nucleotides], reverse=True)
+
+    return counts[1] > min_variant_depth
+
+
+def make_counts(num_positions, seed):
+    random = np.random.RandomState(seed)
+
+    # Mostly reference reads on both strands with occasional errors
+    counts = np.zeros((num_positions, 8), dtype=np.int64)
+
+    counts[:, 0] = random.poisson(15, size=num_positions)
+    counts[:, 4] = random.poisson(15, size=num_positions)
+
+    errors = random.randint(0, num_positions, size=num_positions // 100)
+
+    counts[errors, random.randint(1, 8, size=len(errors))] += random.randint(1, 5, size=len(errors))
+
+    return counts
+
+
+def main(args):
+    # Samples are generated one at a time, as get_variant_position_counts filters them, to bound memory
+    elapsed = 0.
+
+    variant_positions = np.zeros(args.num_positions, dtype=bool)
+
+    for seed in range(args.num_samples):
+        counts = make_counts(args.num_positions, seed)
+
+        start = time.time()
+
+        variant_positions = np.logical_or(variant_positions, _get_variant_positions(counts, args.min_variant_depth))
+
+        elapsed += time.time() - start
+
+    print('array ops: {0} samples, {1} positions, {2} variant positions, {3:.2f}s'.format(
+        args.num_samples, args.num_positions, variant_positions.sum(), elapsed))
+
+    if args.num_apply_positions > 0:
+        columns = list(nucleotides) + [x.lower() for x in nucleotides]
+
+        elapsed = 0.
+
+        for seed in range(args.num_samples):
+            counts = make_counts(args.num_apply_positions, seed)
+
+            start = time.time()
+
+            df = pd.DataFrame(counts, columns=columns)
+
+            apply_positions = df.apply(get_variant_positions_apply, axis=1, args=(args.min_variant_depth,)).values
+
+            elapsed += time.time() - start
+
+            assert np.array_equal(apply_positions, _get_variant_positions(counts, args.min_variant_depth))
+
+        print('row-wise apply: {0} samples, {1} positions, {2:.2f}s ({3:.1f}s extrapolated to {4} positions)'.format(
+            args.num_samples,
+            args.num_apply_positions,
+            elapsed,
+            elapsed * args.num_positions / args.num_apply_positions,
+            args.num_positions))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_positions', type=int, default=int(1e7))
+    parser.add_argument('--num_samples', type=int, default=10)
+    parser.add_argument('--min_variant_depth', type=int, default=0)
+    parser.add_argument('--num_apply_positions', type=int, default=100000)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,157 @@
+import numpy as np
+import os
+import pysam
+import struct
+
+from biowrappers.components.variant_calling.utils import get_bam_regions, load_bam_index_read_loads, split_by_read_load
+
+window_size = 16384
+
+
+def _write_bam(bam_file, reads_per_window, length=10 * window_size, seed=0, csi=False):
+    '''
+    Write and index a BAM with chromosomes '1' and '2' and the given number of random reads in each 16kb window.
+    The index is a .bai, or a .csi if `csi` is set.
+    '''
+    random = np.random.RandomState(seed)
+
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': '1', 'LN': length}, {'SN': '2', 'LN': length}]}
+
+    with pysam.AlignmentFile(bam_file, 'wb', header=header) as out_bam:
+        for ref_id in (0, 1):
+            for window, num_reads in sorted(reads_per_window[ref_id].items()):
+                for pos in np.sort(random.randint(0, window_size - 100, size=num_reads)) + window * window_size:
+                    read = pysam.AlignedSegment()
+                    read.query_name = 'read_{0}_{1}'.format(ref_id, pos)
+                    read.query_sequence = ''.join(random.choice(list('ACGT'), size=100))
+                    read.flag = 0
+                    read.reference_id = ref_id
+                    read.reference_start = int(pos)
+                    read.mapping_quality = 60
+                    read.cigartuples = [(0, 100)]
+                    read.query_qualities = pysam.qualitystring_to_array(''.join(random.choice(list('#+5?I'), size=100)))
+
+                    out_bam.write(read)
+
+    if csi:
+        pysam.index('-c', bam_file)
+
+    else:
+        pysam.index(bam_file)
+
+
+def _zero_leading_intervals(index_file, ref_idx):
+    '''
+    Set the linear index entries before the first read of a reference to 0, as some indexers leave them.
+    '''
+    with open(index_file, 'rb') as fh:
+        data = bytearray(fh.read())
+
+    offset = 8
+
+    for idx in range(ref_idx + 1):
+        num_bins, = struct.unpack_from('<i', data, offset)
+        offset += 4
+
+        for _ in range(num_bins):
+            num_chunks, = struct.unpack_from('<i', data, offset + 4)
+            offset += 8 + 16 * num_chunks
+
+        num_intervals, = struct.unpack_from('<i', data, offset)
+        offset += 4
+
+        if idx == ref_idx:
+            intervals = list(struct.unpack_from('<{0}Q'.format(num_intervals), data, offset))
+
+            first = intervals[0]
+
+            for interval_idx, interval in enumerate(intervals):
+                if interval != first:
+                    break
+
+                intervals[interval_idx] = 0
+
+            struct.pack_into('<{0}Q'.format(num_intervals), data, offset, *intervals)
+
+        offset += 8 * num_intervals
+
+    with open(index_file, 'wb') as fh:
+        fh.write(data)
+
+
+def test_load_bam_index_read_loads(tmpdir):
+    bam_file = str(tmpdir.join('test.bam'))
+
+    _write_bam(bam_file, [{0: 2000, 1: 2000}, {3: 2000, 5: 1000}])
+
+    read_loads = load_bam_index_read_loads(bam_file)
+
+    assert os.path.exists(bam_file + '.bai')
+    assert sorted(read_loads.keys()) == ['1', '2']
+
+    # Windows before the first read of a chromosome have no load, even with data from earlier chromosomes
+    loads = read_loads['2']
+
+    assert (loads[[0, 1, 2, 4]] == 0).all()
+    assert loads[3] > 0
+    assert loads[5] > 0
+    assert 1.5 < loads[3] / loads[5] < 2.5
+
+    assert read_loads['1'][0] > 0
+    assert 0.5 < read_loads['1'][0] / read_loads['1'][1] < 2
+
+    assert len(read_loads['2']) <= 10
+
+    read_loads = load_bam_index_read_loads(bam_file, chromosomes=['2'])
+
+    assert list(read_loads.keys()) == ['2']
+
+    _zero_leading_intervals(bam_file + '.bai', 1)
+
+    assert np.array_equal(load_bam_index_read_loads(bam_file, chromosomes=['2'])['2'], loads)
+
+
+def test_load_bam_index_read_loads_no_bai(tmpdir):
+    bam_file = str(tmpdir.join('test.bam'))
+
+    _write_bam(bam_file, [{0: 2000, 1: 2000}, {3: 2000, 5: 1000}], csi=True)
+
+    assert os.path.exists(bam_file + '.csi')
+    assert not os.path.exists(bam_file + '.bai')
+
+    assert load_bam_index_read_loads(bam_file) == {}
+
+    # Without a .bai index regions are split evenly
+    even_regions = get_bam_regions(bam_file, 5 * window_size)
+
+    assert get_bam_regions(bam_file, 5 * window_size, balance_read_load=True) == even_regions
+
+    assert even_regions[0] == '1:1-{0}'.format(5 * window_size)
+
+    # A CSI index saved with a .bai extension is not parsed either
+    os.rename(bam_file + '.csi', bam_file + '.bai')
+
+    assert load_bam_index_read_loads(bam_file) == {}
+
+
+def test_split_by_read_load():
+    length = 10 * window_size
+
+    loads = [0, 0, 0, 10, 0, 0, 0, 0, 10, 0]
+
+    assert split_by_read_load(length, 5 * window_size, loads) == [(1, 4 * window_size), (4 * window_size + 1, length)]
+
+
+def test_split_by_read_load_even():
+    length = 10 * window_size
+
+    assert split_by_read_load(length, 5 * window_size, np.zeros(10)) == [
+        (1, 5 * window_size), (5 * window_size + 1, length)]
+
+
+def test_split_by_read_load_short_loads():
+    length = 10 * window_size - 100
+
+    # Windows past the end of the loads have no load, so they are merged into the last region
+    assert split_by_read_load(length, window_size // 2, [1, 1]) == [
+        (1, window_size), (window_size + 1, 2 * window_size), (2 * window_size + 1, length)]
@@ -0,0 +1,60 @@
+import pandas as pd
+
+from biowrappers.components.copy_number_calling.common.tasks import calculate_breakpoint_copy_number
+
+
+cn_table = pd.DataFrame({
+    'chromosome': ['1', '1', '2', '2'],
+    'start': [1, 1001, 1, 1001],
+    'end': [1000, 2000, 1000, 2000],
+    'major_1': [2, 1, 1, 2],
+    'minor_1': [0, 1, 1, 1],
+    'major_2': [1, 1, 1, 1],
+    'minor_2': [1, 1, 1, 1],
+})
+
+breakpoints = pd.DataFrame({
+    'prediction_id': [10, 11, 12],
+    'chromosome_1': ['1', '1', '1'],
+    'strand_1': ['+', '-', '+'],
+    'position_1': [1000, 1001, 50000],
+    'chromosome_2': ['2', '2', '2'],
+    'strand_2': ['-', '+', '-'],
+    'position_2': [1001, 2000, 1001],
+})
+
+
+def _write_breakpoints(tmpdir, data):
+    breakpoints_filename = str(tmpdir.join('breakpoints.tsv'))
+
+    data.to_csv(breakpoints_filename, sep='\t', index=False)
+
+    return breakpoints_filename
+
+
+def test_allele_specific_copy_number(tmpdir):
+    brk_cn = calculate_breakpoint_copy_number(_write_breakpoints(tmpdir, breakpoints), cn_table)
+
+    # Major 2 to 1 with minor 0 to 1 has no total copy number change but an allele flow of 1
+    assert list(brk_cn.columns) == ['prediction_id', 'cn_1', 'cn_2']
+    assert brk_cn['prediction_id'].tolist() == [10, 11]
+    assert brk_cn['cn_1'].tolist() == [1, 1]
+    assert brk_cn['cn_2'].tolist() == [0, 0]
+
+
+def test_total_copy_number(tmpdir):
+    total_cn_table = cn_table[['chromosome', 'start', 'end']].copy()
+    total_cn_table['total_1'] = cn_table['major_1'] + cn_table['minor_1']
+
+    brk_cn = calculate_breakpoint_copy_number(_write_breakpoints(tmpdir, breakpoints), total_cn_table)
+
+    assert list(brk_cn.columns) == ['prediction_id', 'cn_1']
+    assert brk_cn['prediction_id'].tolist() == [10, 11]
+    assert brk_cn['cn_1'].tolist() == [0, 0]
+
+
+def test_no_breakpoints(tmpdir):
+    brk_cn = calculate_breakpoint_copy_number(_write_breakpoints(tmpdir, breakpoints.iloc[2:]), cn_table)
+
+    assert list(brk_cn.columns) == ['prediction_id', 'cn_1', 'cn_2']
+    assert len(brk_cn.index) == 0
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+import remixt.analysis.haplotype
+
+import biowrappers.components.copy_number_calling.clonehd.tasks as clonehd_tasks
+import biowrappers.components.copy_number_calling.common.seqdata as seqdata
+
+
+def _infer_snp_genotype(data):
+    '''
+    Call positions divisible by 3 heterozygous, in place of the genotype inference of remixt.
+    '''
+    data['AB'] = (data['position'] % 3 == 0).astype(int)
+
+
+def _get_tumour_baf_merge(normal_allele_count, tumour_allele_count, chrom):
+    '''
+    Tumour BAF lines as written before, by merging the tumour counts with the het positions.
+    '''
+    normal_allele_count = normal_allele_count.copy()
+
+    _infer_snp_genotype(normal_allele_count)
+
+    het_positions = normal_allele_count.loc[normal_allele_count['AB'] == 1, ['position']]
+
+    tumour_allele_count = tumour_allele_count.merge(het_positions)
+
+    tumour_allele_count['ref_count'] = tumour_allele_count['ref_count'].astype(int)
+    tumour_allele_count['alt_count'] = tumour_allele_count['alt_count'].astype(int)
+
+    tumour_allele_count['minor_count'] = np.minimum(
+        tumour_allele_count['ref_count'],
+        tumour_allele_count['alt_count'],
+    )
+
+    tumour_allele_count['total_count'] = (
+        tumour_allele_count['ref_count'] +
+        tumour_allele_count['alt_count']
+    )
+
+    tumour_allele_count['chromosome'] = chrom
+
+    return tumour_allele_count.to_csv(
+        sep='\t', index=False, header=False, columns=['chromosome', 'position', 'minor_count', 'total_count'])
+
+
+def _make_allele_count(positions, seed):
+    random = np.random.RandomState(seed)
+
+    return pd.DataFrame({
+        'position': np.asarray(positions, dtype=np.int64),
+        'ref_count': random.randint(0, 50, size=len(positions)),
+        'alt_count': random.randint(0, 50, size=len(positions)),
+    })
+
+
+@pytest.mark.parametrize('normal_positions,tumour_positions', [
+    (np.arange(1, 100), np.arange(1, 100, 2)),
+    (np.arange(1, 100), np.array([], dtype=np.int64)),
+    (np.array([], dtype=np.int64), np.arange(1, 100)),
+    # Duplicate tumour positions are each kept
+    (np.arange(1, 100), np.repeat(np.arange(1, 50), 2)),
+    (np.arange(1, 100), np.array([3, 3, 3, 4, 6, 6, 200, 201, 201])),
+    # Duplicate het positions repeat the tumour rows
+    (np.repeat(np.arange(1, 50), 2), np.arange(1, 100)),
+    (np.array([9, 9, 12]), np.array([9, 9, 12, 12])),
+    # Unsorted positions
+    (np.arange(100, 0, -1), np.array([30, 6, 9, 6, 3, 99])),
+])
+def test_get_chromosome_tumour_baf_matches_merge(monkeypatch, normal_positions, tumour_positions):
+    normal_allele_count = _make_allele_count(normal_positions, 0)
+
+    tumour_allele_count = _make_allele_count(tumour_positions, 1)
+
+    monkeypatch.setattr(remixt.analysis.haplotype, 'infer_snp_genotype', _infer_snp_genotype)
+
+    monkeypatch.setattr(seqdata, 'read_snp_counts', lambda filename, chrom, cache_dir=None: normal_allele_count.copy())
+
+    monkeypatch.setattr(
+        seqdata, 'read_snp_count_columns',
+        lambda filename, chrom, cache_dir=None: dict((col, tumour_allele_count[col].values)
+                                                     for col in tumour_allele_count.columns))
+
+    baf = clonehd_tasks._get_chromosome_tumour_baf(('normal.h5', 'tumour.h5', '1', None))
+
+    assert baf == _get_tumour_baf_merge(normal_allele_count, tumour_allele_count, '1')
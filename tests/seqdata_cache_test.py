@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+import biowrappers.components.copy_number_calling.common.seqdata as seqdata
+
+
+def _make_snp_counts(num_rows):
+    return pd.DataFrame({
+        'position': np.arange(num_rows, dtype=np.int64),
+        'ref_count': np.arange(num_rows, dtype=np.int64) % 7,
+        'alt_count': np.arange(num_rows, dtype=np.int64) % 5,
+    })
+
+
+def test_write_cached_table_empty(tmpdir):
+    table_dir = str(tmpdir.join('table'))
+
+    # Empty tables are created without a dtype, and are written as int64 columns
+    seqdata._write_cached_table(table_dir, pd.DataFrame({'position': [], 'ref_count': []}, dtype=object))
+
+    table = seqdata._load_cached_table(table_dir)
+
+    assert list(table.keys()) == ['position', 'ref_count']
+    assert all(x.dtype == np.int64 and len(x) == 0 for x in table.values())
+
+
+def test_read_cached_table_bounded(tmpdir, monkeypatch):
+    seqdata_filename = str(tmpdir.join('seqdata.h5'))
+
+    with open(seqdata_filename, 'w') as fh:
+        fh.write('seqdata')
+
+    cache_dir = str(tmpdir.join('cache'))
+
+    monkeypatch.setattr(seqdata, '_tables', seqdata.OrderedDict())
+
+    monkeypatch.setattr(seqdata, '_max_tables', 3)
+
+    for chromosome in ('1', '2', '3', '1', '4'):
+        table = seqdata._read_cached_table(
+            seqdata_filename, 'snp_counts', chromosome, lambda: _make_snp_counts(10), cache_dir=cache_dir)
+
+        assert np.array_equal(table['ref_count'], _make_snp_counts(10)['ref_count'].values)
+
+    # Least recently used tables are dropped first
+    assert [x[2] for x in seqdata._tables.keys()] == ['3', '1', '4']
@@ -0,0 +1,391 @@
+import itertools
+import logging
+import numpy as np
+import pysam
+import pytest
+
+from biowrappers.components.variant_calling.snv_allele_counts.tasks import (
+    ReadFilter, _get_strand_counts_array, _get_target_counts, _get_target_windows, _get_variant_positions)
+
+chrom_length = 2000
+
+
+def _random_cigar(random):
+    '''
+    Random CIGAR with optional soft clips and at least one aligned block, for a read starting with an aligned block.
+    '''
+    cigar = []
+
+    if random.uniform() < 0.3:
+        cigar.append((4, random.randint(1, 10)))
+
+    cigar.append((0, random.randint(5, 30)))
+
+    for _ in range(random.randint(0, 4)):
+        op = random.choice([1, 2, 3, 7, 8])
+
+        cigar.append((op, random.randint(1, 10)))
+
+        cigar.append((random.choice([0, 7, 8]), random.randint(5, 30)))
+
+    if random.uniform() < 0.3:
+        cigar.append((4, random.randint(1, 10)))
+
+    return cigar
+
+
+def _make_read(header, name, pos, cigar, seq, quals, flag=0, mapq=60):
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.query_sequence = seq
+    read.flag = flag
+    read.reference_id = 0
+    read.reference_start = pos
+    read.mapping_quality = mapq
+    read.cigartuples = cigar
+
+    if quals is not None:
+        read.query_qualities = pysam.qualitystring_to_array(quals)
+
+    return read
+
+
+def _write_bam(bam_file, num_reads=500, seed=0):
+    '''
+    Write and index a BAM of random reads with indels, soft clips, N bases, varied base and mapping qualities, flags
+    and strands, and some reads without qualities.
+    '''
+    random = np.random.RandomState(seed)
+
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': '1', 'LN': chrom_length}]})
+
+    reads = []
+
+    for idx in range(num_reads):
+        cigar = _random_cigar(random)
+
+        query_length = sum(length for op, length in cigar if op in (0, 1, 4, 7, 8))
+
+        seq = ''.join(random.choice(list('ACGTN'), p=[0.24, 0.24, 0.24, 0.24, 0.04], size=query_length))
+
+        if random.uniform() < 0.1:
+            quals = None
+
+        else:
+            quals = ''.join(chr(33 + x) for x in random.randint(0, 41, size=query_length))
+
+        flag = 0
+
+        for bit, prob in ((0x10, 0.5), (0x100, 0.05), (0x200, 0.05), (0x400, 0.1)):
+            if random.uniform() < prob:
+                flag |= bit
+
+        pos = random.randint(0, chrom_length - 300)
+
+        mapq = random.choice([0, 10, 20, 60])
+
+        reads.append(_make_read(header, 'read_{0}'.format(idx), pos, cigar, seq, quals, flag=flag, mapq=mapq))
+
+    unsorted_file = bam_file + '.unsorted.bam'
+
+    with pysam.AlignmentFile(unsorted_file, 'wb', header=header) as out_bam:
+        for read in reads:
+            out_bam.write(read)
+
+    pysam.sort('-o', bam_file, unsorted_file)
+
+    pysam.index(bam_file)
+
+
+@pytest.fixture(scope='module')
+def bam_file(tmpdir_factory):
+    bam_file = str(tmpdir_factory.mktemp('bam').join('test.bam'))
+
+    _write_bam(bam_file)
+
+    return bam_file
+
+
+def _count_coverage_strands(bam, chrom, beg, end, read_filter, min_bqual):
+    '''
+    Forward and reverse strand counts from `count_coverage`, as the strand counts were computed before.
+    '''
+    counts = []
+
+    for is_reverse in (False, True):
+        x = bam.count_coverage(
+            chrom,
+            beg - 1,
+            end - 1,
+            quality_threshold=min_bqual,
+            read_callback=lambda read: read_filter(read) and (read.is_reverse == is_reverse),
+        )
+
+        counts.append(np.array(x).T)
+
+    return np.concatenate(counts, axis=1)
+
+
+@pytest.mark.parametrize('min_bqual', [0, 1, 20, 30])
+@pytest.mark.parametrize('count_duplicates,min_mqual', [(False, 0), (True, 0), (False, 20)])
+@pytest.mark.parametrize('beg,end', [(1, chrom_length + 1), (501, 1001)])
+def test_strand_counts_match_count_coverage(bam_file, min_bqual, count_duplicates, min_mqual, beg, end):
+    read_filter = ReadFilter(count_duplicates=count_duplicates, min_mqual=min_mqual)
+
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        expected = _count_coverage_strands(bam, '1', beg, end, read_filter, min_bqual)
+
+        counts = _get_strand_counts_array(bam, '1', beg, end, read_filter, min_bqual=min_bqual, reads_per_chunk=50)
+
+    assert expected.sum() > 0
+    assert np.array_equal(counts, expected)
+
+
+def test_strand_counts_cigar_operations(tmpdir):
+    bam_file = str(tmpdir.join('cigar.bam'))
+
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': '1', 'LN': 100}]})
+
+    reads = [
+        # Soft clip, insertion and deletion
+        _make_read(
+            header, 'a', 10, [(4, 2), (0, 3), (1, 2), (0, 2), (2, 3), (0, 3), (4, 1)], 'TTACGGGTAACGA', 'I' * 13),
+        # N base and a base below the quality threshold, reverse strand
+        _make_read(header, 'b', 11, [(0, 5)], 'CNGTA', 'II!II', flag=0x10),
+        # No base qualities
+        _make_read(header, 'c', 12, [(7, 2), (3, 4), (8, 2)], 'GGCC', None),
+    ]
+
+    with pysam.AlignmentFile(bam_file, 'wb', header=header) as out_bam:
+        for read in reads:
+            out_bam.write(read)
+
+    pysam.index(bam_file)
+
+    read_filter = ReadFilter(min_mqual=0)
+
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        for min_bqual in (0, 10):
+            expected = _count_coverage_strands(bam, '1', 1, 31, read_filter, min_bqual)
+
+            counts = _get_strand_counts_array(bam, '1', 1, 31, read_filter, min_bqual=min_bqual)
+
+            assert np.array_equal(counts, expected)
+
+    # Read a: A, C, G at 10-12, inserted GG skipped, T, A at 13-14, deletion at 15-17, C, G, A at 18-20
+    assert counts[10, 0] == 1
+    assert counts[13, 3] == 1
+    assert counts[15:18, :4].sum() == 0
+    assert counts[18, 0] == 1
+
+    # Read b: C at 11 reverse, N at 12 skipped, G at 13 reverse skipped below quality 10
+    assert counts[11, 5] == 1
+    assert counts[12, 4:].sum() == 0
+    assert counts[13, 6] == 0
+
+
+def _get_variant_positions_row(row, min_variant_depth):
+    '''
+    Row-wise check of the second most common nucleotide, as pandas apply did before.
+    '''
+    return sorted(row, reverse=True)[1] > min_variant_depth
+
+
+def _get_variant_positions_strand_row(row, min_variant_depth):
+    return _get_variant_positions_row([row[idx] + row[idx + 4] for idx in range(4)], min_variant_depth)
+
+
+@pytest.mark.parametrize('min_variant_depth', [0, 1, 2, 5])
+def test_variant_positions_match_row_wise(min_variant_depth):
+    random = np.random.RandomState(0)
+
+    # Small counts so ties between alleles and counts equal to the threshold are common
+    counts = random.randint(0, 4, size=(2000, 4)) * random.randint(0, 3, size=(2000, 1))
+
+    strand_counts = random.randint(0, 4, size=(2000, 8))
+
+    expected = [_get_variant_positions_row(row, min_variant_depth) for row in counts]
+
+    expected_strand = [_get_variant_positions_strand_row(row, min_variant_depth) for row in strand_counts]
+
+    assert _get_variant_positions(counts, min_variant_depth).tolist() == expected
+    assert _get_variant_positions(strand_counts, min_variant_depth).tolist() == expected_strand
+
+
+def test_variant_positions_edge_cases():
+    counts = np.array([
+        [0, 0, 0, 0],
+        [10, 0, 0, 0],
+        [3, 3, 0, 0],
+        [5, 2, 2, 0],
+        [1, 1, 1, 1],
+        [0, 0, 7, 2],
+    ])
+
+    assert _get_variant_positions(counts).tolist() == [False, False, True, True, True, True]
+    assert _get_variant_positions(counts, 2).tolist() == [False, False, True, False, False, False]
+
+    # Strands are summed before the threshold, so 1 forward and 1 reverse read pass a threshold of 1
+    strand_counts = np.array([
+        [4, 1, 0, 0, 4, 1, 0, 0],
+        [4, 1, 0, 0, 4, 0, 0, 0],
+        [0, 0, 0, 0, 0, 0, 0, 0],
+    ])
+
+    assert _get_variant_positions(strand_counts, 1).tolist() == [True, False, False]
+    assert _get_variant_positions(strand_counts).tolist() == [True, True, False]
+
+
+def test_target_windows():
+    assert _get_target_windows([], 1000, 100) == []
+    assert _get_target_windows([5], 1000, 100) == [(5, 6)]
+
+    # Adjacent targets share a window, a gap larger than max_window_gap starts a new one
+    assert _get_target_windows([1, 2, 3, 10], 0, 100) == [(1, 2), (2, 3), (3, 4), (10, 11)]
+    assert _get_target_windows([1, 2, 3, 10], 1, 100) == [(1, 4), (10, 11)]
+    assert _get_target_windows([1, 2, 3, 10], 7, 100) == [(1, 11)]
+
+    # A target max_window_size past the start of a window starts a new one
+    assert _get_target_windows([1, 2, 3, 4, 5], 1000, 2) == [(1, 3), (3, 5), (5, 6)]
+    assert _get_target_windows([1, 3, 5], 1000, 3) == [(1, 4), (5, 6)]
+
+
+@pytest.mark.parametrize('max_window_gap,max_window_size', [(0, 1), (1, 2), (10, 50), (1000, int(1e6))])
+def test_target_counts_match_count_coverage(bam_file, max_window_gap, max_window_size):
+    random = np.random.RandomState(0)
+
+    # Runs of adjacent targets, isolated targets and the chromosome ends
+    coords = np.concatenate([
+        [1, chrom_length],
+        np.arange(100, 120),
+        np.arange(500, 503),
+        random.randint(1, chrom_length + 1, size=200),
+    ])
+
+    coords = np.unique(coords)
+
+    read_filter = ReadFilter(min_mqual=20)
+
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        counts = _get_target_counts(
+            bam, '1', coords, read_filter, min_bqual=20, max_window_gap=max_window_gap,
+            max_window_size=max_window_size)
+
+        expected = [
+            np.array(bam.count_coverage('1', x - 1, x, quality_threshold=20, read_callback=read_filter))[:, 0]
+            for x in coords]
+
+    assert counts.sum() > 0
+    assert np.array_equal(counts, np.array(expected))
+
+
+def test_target_counts_no_targets(bam_file):
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        counts = _get_target_counts(bam, '1', np.array([], dtype=int), ReadFilter())
+
+    assert counts.shape == (0, 4)
+
+
+def _check_read(read, count_duplicates=False, min_mqual=30, strand='both'):
+    '''
+    Read check used as the count_coverage callback before reads were filtered on a flag mask, returning the reason a
+    read is rejected or None.
+    '''
+    if read.mapping_quality < min_mqual:
+        return 'mapping_quality'
+
+    elif read.is_duplicate and (not count_duplicates):
+        return 'duplicate'
+
+    elif read.is_unmapped:
+        return 'unmapped'
+
+    elif read.is_qcfail:
+        return 'qcfail'
+
+    elif read.is_secondary:
+        return 'secondary'
+
+    elif (strand == 'reverse') and (not read.is_reverse):
+        return 'strand'
+
+    elif (strand == 'forward') and (read.is_reverse):
+        return 'strand'
+
+    return None
+
+
+def _flag_reads():
+    '''
+    Reads with every combination of the unmapped, reverse, secondary, qcfail and duplicate flags and several mapping
+    qualities.
+    '''
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': '1', 'LN': 100}]})
+
+    reads = []
+
+    for bits in itertools.product([0, 1], repeat=5):
+        flag = sum(bit * value for bit, value in zip(bits, (0x4, 0x10, 0x100, 0x200, 0x400)))
+
+        for mapq in (0, 19, 20, 60):
+            reads.append(_make_read(header, 'read', 10, [(0, 4)], 'ACGT', 'IIII', flag=flag, mapq=mapq))
+
+    return reads
+
+
+@pytest.mark.parametrize('strand', ['both', 'forward', 'reverse'])
+@pytest.mark.parametrize('min_mqual', [0, 20])
+@pytest.mark.parametrize('count_duplicates', [False, True])
+def test_read_filter_matches_check_read(count_duplicates, min_mqual, strand):
+    read_filter = ReadFilter(count_duplicates=count_duplicates, min_mqual=min_mqual, strand=strand)
+
+    tracked_filter = ReadFilter(count_duplicates=count_duplicates, min_mqual=min_mqual, strand=strand, track_stats=True)
+
+    reads = _flag_reads()
+
+    reasons = [_check_read(x, count_duplicates=count_duplicates, min_mqual=min_mqual, strand=strand) for x in reads]
+
+    assert [read_filter(x) for x in reads] == [x is None for x in reasons]
+    assert [tracked_filter(x) for x in reads] == [x is None for x in reasons]
+
+    stats = tracked_filter.stats
+
+    assert stats['examined'] == len(reads)
+
+    for reason in ReadFilter.reasons:
+        assert stats['rejected_' + reason] == reasons.count(reason)
+
+
+def test_read_filter_read_callback(bam_file):
+    assert ReadFilter(min_mqual=0).read_callback == 'all'
+
+    for read_filter in (
+            ReadFilter(count_duplicates=True, min_mqual=0),
+            ReadFilter(min_mqual=1),
+            ReadFilter(min_mqual=0, strand='forward'),
+            ReadFilter(min_mqual=0, track_stats=True)):
+        assert read_filter.read_callback is read_filter
+
+    # The pysam 'all' filter rejects the same reads as the flag mask
+    read_filter = ReadFilter(min_mqual=0)
+
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        counts = bam.count_coverage('1', 0, chrom_length, read_callback=read_filter.read_callback)
+
+        expected = bam.count_coverage('1', 0, chrom_length, read_callback=read_filter)
+
+    assert np.array_equal(np.array(counts), np.array(expected))
+
+
+def test_read_filter_log_stats(caplog):
+    read_filter = ReadFilter(min_mqual=20, track_stats=True)
+
+    for read in _flag_reads():
+        read_filter(read)
+
+    with caplog.at_level(logging.INFO):
+        read_filter.log_stats('1:1-100')
+
+    assert 'read filter stats for 1:1-100: examined=128' in caplog.text
+    assert 'rejected_mapping_quality=64' in caplog.text
+    assert 'rejected_strand=0' in caplog.text
@@ -0,0 +1,379 @@
+import numpy as np
+import pandas as pd
+import pytest
+import vcf
+
+from biowrappers.components.variant_calling.strelka.tasks import (
+    FILTER_ID_BASE, FILTER_ID_DEPTH, FILTER_ID_INDEL_HPOL, FILTER_ID_QSI, FILTER_ID_QSS, FILTER_ID_REPEAT,
+    FILTER_ID_SPANNING_DELETION, filter_indel_file_list, filter_snv_file_list)
+
+known_chrom_size = 1000
+
+# Mean normal coverage of 30, so the depth filter is at 90 with the default multiple of 3
+normal_coverage = 30 * known_chrom_size
+
+snv_header = '''##fileformat=VCFv4.1
+##source=strelka
+##INFO=<ID=QSS_NT,Number=1,Type=Integer,Description="Quality score reflecting the joint probability">
+##INFO=<ID=NT,Number=1,Type=String,Description="Genotype of the normal in all data tiers">
+##INFO=<ID=SOMATIC,Number=0,Type=Flag,Description="Somatic mutation">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth for tier1">
+##FORMAT=<ID=FDP,Number=1,Type=Integer,Description="Number of basecalls filtered from original read depth">
+##FORMAT=<ID=SDP,Number=1,Type=Integer,Description="Number of reads with deletions spanning this site">
+##FORMAT=<ID=AU,Number=2,Type=Integer,Description="Number of A alleles used in tiers 1,2">
+##FILTER=<ID=LowQ,Description="Filtered upstream">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	NORMAL	TUMOR
+'''
+
+indel_header = '''##fileformat=VCFv4.1
+##source=strelka
+##INFO=<ID=QSI_NT,Number=1,Type=Integer,Description="Quality score reflecting the joint probability">
+##INFO=<ID=NT,Number=1,Type=String,Description="Genotype of the normal in all data tiers">
+##INFO=<ID=RC,Number=1,Type=Integer,Description="Number of times RU repeats in the reference allele">
+##INFO=<ID=IHP,Number=1,Type=Integer,Description="Largest reference interrupted homopolymer length">
+##INFO=<ID=SOMATIC,Number=0,Type=Flag,Description="Somatic mutation">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read depth for tier1">
+##FORMAT=<ID=TAR,Number=2,Type=Integer,Description="Reads strongly supporting alternate allele for tiers 1,2">
+##FILTER=<ID=LowQ,Description="Filtered upstream">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	NORMAL	TUMOR
+'''
+
+
+def _random_filter(random):
+    return random.choice(['PASS', '.', 'LowQ'])
+
+
+def _random_nt(random):
+    return random.choice(['ref', 'ref', 'ref', 'het', 'hom'])
+
+
+def _write_snv_vcf(file_name, coords, random):
+    with open(file_name, 'w') as fh:
+        fh.write(snv_header)
+
+        for coord in coords:
+            alt = random.choice(['C', 'G', 'A,C'])
+
+            info = 'NT={0};QSS_NT={1};SOMATIC'.format(_random_nt(random), random.randint(0, 40))
+
+            samples = []
+
+            for _ in range(2):
+                dp = random.choice([0, random.randint(1, 120)])
+
+                samples.append('{0}:{1}:{2}:{3},{4}'.format(
+                    dp, random.randint(0, dp + 1), random.randint(0, 4 * dp + 2), dp, dp))
+
+            fh.write('\t'.join(['1', str(coord), '.', 'T', alt, '.', _random_filter(random), info, 'DP:FDP:SDP:AU'] +
+                               samples) + '\n')
+
+
+def _write_indel_vcf(file_name, window_file, coords, random):
+    with open(file_name, 'w') as fh, open(window_file, 'w') as window_fh:
+        fh.write(indel_header)
+
+        window_fh.write('# chrom\tpos\twindows\n')
+
+        for coord in coords:
+            alt = random.choice(['TA', 'TAA', 'TA,TAA'])
+
+            info = ['NT={0}'.format(_random_nt(random)), 'QSI_NT={0}'.format(random.randint(0, 60))]
+
+            # Repeat and homopolymer annotations are missing for some records
+            if random.uniform() < 0.8:
+                info.append('RC={0}'.format(random.randint(0, 12)))
+
+            if random.uniform() < 0.8:
+                info.append('IHP={0}'.format(random.randint(0, 20)))
+
+            info.append('SOMATIC')
+
+            samples = []
+
+            for _ in range(2):
+                dp = random.randint(0, 120)
+
+                samples.append('{0}:{1},{2}'.format(dp, dp // 2, dp // 3))
+
+            fh.write('\t'.join(['1', str(coord), '.', 'T', alt, '.', _random_filter(random), ';'.join(info), 'DP:TAR'] +
+                               samples) + '\n')
+
+            # The first row of a coordinate is used when it is duplicated
+            for _ in range(random.choice([1, 1, 2])):
+                window = [random.choice([0., random.uniform(0, 100)]) for _ in range(6)]
+
+                window_fh.write('\t'.join(['1', str(coord)] + ['{0:.2f}'.format(x) for x in window]) + '\n')
+
+        # Windows of positions without records are ignored
+        window_fh.write('1\t{0}\t1.0\t1.0\t1.0\t1.0\t1.0\t1.0\n'.format(known_chrom_size + 1))
+        window_fh.write('2\t1\t1.0\t1.0\t1.0\t1.0\t1.0\t1.0\n')
+
+
+def _write_coverage(file_name):
+    with open(file_name, 'w') as fh:
+        fh.write('chrom\tnormal_coverage\n1\t{0}\n'.format(float(normal_coverage)))
+
+
+def _filter_snv_pyvcf(in_files, out_file, max_normal_coverage, max_filtered_basecall_frac=0.4,
+                      max_spanning_deletion_frac=0.75, quality_lower_bound=15):
+    '''
+    SNV filtering through PyVCF records, as done before the filters worked on the VCF text.
+    '''
+    def fraction(numerator, denominator):
+        return numerator / denominator if denominator > 0 else 0
+
+    writer = None
+
+    with open(out_file, 'w') as out_fh:
+        for key in sorted(in_files):
+            reader = vcf.Reader(filename=in_files[key])
+
+            if writer is None:
+                for filter_id in (FILTER_ID_DEPTH, FILTER_ID_BASE, FILTER_ID_SPANNING_DELETION, FILTER_ID_QSS):
+                    reader.filters[filter_id] = vcf.parser._Filter(id=filter_id, desc='')
+
+                writer = vcf.Writer(out_fh, reader)
+
+            for record in reader:
+                normal = record.genotype('NORMAL').data
+
+                tumour = record.genotype('TUMOR').data
+
+                if normal.DP > max_normal_coverage:
+                    record.add_filter(FILTER_ID_DEPTH)
+
+                if max(fraction(normal.FDP, normal.DP), fraction(tumour.FDP, tumour.DP)) >= max_filtered_basecall_frac:
+                    record.add_filter(FILTER_ID_BASE)
+
+                if max(fraction(normal.SDP, normal.DP + normal.SDP),
+                       fraction(tumour.SDP, tumour.DP + tumour.SDP)) > max_spanning_deletion_frac:
+                    record.add_filter(FILTER_ID_SPANNING_DELETION)
+
+                if (record.INFO['NT'] != 'ref') or (record.INFO['QSS_NT'] < quality_lower_bound):
+                    record.add_filter(FILTER_ID_QSS)
+
+                writer.write_record(record)
+
+        writer.close()
+
+
+def _filter_indel_pyvcf(vcf_files, window_files, out_file, max_normal_coverage, max_int_hpol_length=14,
+                        max_ref_repeat=8, max_window_filtered_basecall_frac=0.3, quality_lower_bound=30):
+    '''
+    Indel filtering through PyVCF records and a window table lookup per record, as done before the filters worked on
+    the VCF text.
+    '''
+    window_cols = ['chrom', 'coord'] + ['{0}_window_{1}'.format(x, y) for x in ('normal', 'tumour')
+                                        for y in ('used', 'filtered', 'submap')]
+
+    writer = None
+
+    with open(out_file, 'w') as out_fh:
+        for key in sorted(vcf_files):
+            window = pd.read_csv(
+                window_files[key], comment='#', converters={'chrom': str}, header=None, names=window_cols, sep='\t')
+
+            reader = vcf.Reader(filename=vcf_files[key])
+
+            # The window FORMAT fields are not added to the header, so they are read back as strings
+            if writer is None:
+                filter_ids = (FILTER_ID_DEPTH, FILTER_ID_REPEAT, FILTER_ID_INDEL_HPOL, FILTER_ID_BASE, FILTER_ID_QSI)
+
+                for filter_id in filter_ids:
+                    reader.filters[filter_id] = vcf.parser._Filter(id=filter_id, desc='')
+
+                writer = vcf.Writer(out_fh, reader)
+
+            for record in reader:
+                window_row = window.loc[
+                    (window['chrom'] == str(record.CHROM)) & (window['coord'] == record.POS)].iloc[0]
+
+                record.add_format('DP50')
+                record.add_format('FDP50')
+                record.add_format('SUBDP50')
+
+                fractions = []
+
+                for sample, prefix in (('NORMAL', 'normal'), ('TUMOR', 'tumour')):
+                    call = record.genotype(sample)
+
+                    data = call.data._asdict()
+
+                    data['DP50'] = window_row[prefix + '_window_used'] + window_row[prefix + '_window_filtered']
+                    data['FDP50'] = window_row[prefix + '_window_filtered']
+                    data['SUBDP50'] = window_row[prefix + '_window_submap']
+
+                    call.data = vcf.model.make_calldata_tuple(data.keys())(**data)
+
+                    fractions.append(data['FDP50'] / data['DP50'] if data['DP50'] > 0 else 0)
+
+                if record.genotype('NORMAL').data.DP > max_normal_coverage:
+                    record.add_filter(FILTER_ID_DEPTH)
+
+                if ('RC' in record.INFO) and (record.INFO['RC'] > max_ref_repeat):
+                    record.add_filter(FILTER_ID_REPEAT)
+
+                if ('IHP' in record.INFO) and (record.INFO['IHP'] > max_int_hpol_length):
+                    record.add_filter(FILTER_ID_INDEL_HPOL)
+
+                if max(fractions) >= max_window_filtered_basecall_frac:
+                    record.add_filter(FILTER_ID_BASE)
+
+                if (record.INFO['NT'] != 'ref') or (record.INFO['QSI_NT'] < quality_lower_bound):
+                    record.add_filter(FILTER_ID_QSI)
+
+                writer.write_record(record)
+
+        writer.close()
+
+
+def _read_records(file_name):
+    reader = vcf.Reader(filename=file_name)
+
+    records = []
+
+    for record in reader:
+        records.append((
+            record.CHROM,
+            record.POS,
+            record.REF,
+            [str(x) for x in record.ALT],
+            record.FILTER,
+            record.INFO,
+            [x.data._asdict() for x in record.samples],
+        ))
+
+    return reader, records
+
+
+def _as_float(value):
+    '''
+    Float of a FORMAT value read without a header definition, which may be parsed as a string or a list of strings.
+    '''
+    if isinstance(value, list):
+        value, = value
+
+    return float(value)
+
+
+def _assert_same_records(file_name, expected_file_name):
+    reader, records = _read_records(file_name)
+
+    expected_reader, expected_records = _read_records(expected_file_name)
+
+    assert list(reader.filters.keys()) == list(expected_reader.filters.keys())
+
+    assert len(records) == len(expected_records)
+
+    for record, expected_record in zip(records, expected_records):
+        assert record[:6] == expected_record[:6]
+
+        for data, expected_data in zip(record[6], expected_record[6]):
+            assert list(data.keys()) == list(expected_data.keys())
+
+            for key in data:
+                if isinstance(data[key], float):
+                    assert data[key] == pytest.approx(_as_float(expected_data[key]))
+
+                else:
+                    assert data[key] == expected_data[key]
+
+
+def test_filter_snv_file_list(tmpdir):
+    random = np.random.RandomState(0)
+
+    in_files = {}
+
+    for idx, coords in enumerate([range(1, 400, 2), range(400, 900, 3)]):
+        in_files[idx] = str(tmpdir.join('snv_{0}.vcf'.format(idx)))
+
+        _write_snv_vcf(in_files[idx], coords, random)
+
+    coverage_file = str(tmpdir.join('coverage.tsv'))
+
+    _write_coverage(coverage_file)
+
+    out_file = str(tmpdir.join('filtered.vcf'))
+
+    expected_file = str(tmpdir.join('expected.vcf'))
+
+    filter_snv_file_list(in_files, coverage_file, out_file, '1', known_chrom_size)
+
+    _filter_snv_pyvcf(in_files, expected_file, 90.)
+
+    _assert_same_records(out_file, expected_file)
+
+    # Every filter, and both passing and already filtered records, are in the test data
+    _, records = _read_records(out_file)
+
+    filters = set(x for record in records for x in (record[4] or []))
+
+    assert filters == set(['LowQ', FILTER_ID_DEPTH, FILTER_ID_BASE, FILTER_ID_SPANNING_DELETION, FILTER_ID_QSS])
+    assert any(record[4] == [] for record in records)
+    assert any(len(record[3]) > 1 for record in records)
+
+
+def test_filter_indel_file_list(tmpdir):
+    random = np.random.RandomState(0)
+
+    vcf_files = {}
+
+    window_files = {}
+
+    for idx, coords in enumerate([range(1, 400, 2), range(400, 900, 3)]):
+        vcf_files[idx] = str(tmpdir.join('indel_{0}.vcf'.format(idx)))
+
+        window_files[idx] = str(tmpdir.join('window_{0}.txt'.format(idx)))
+
+        _write_indel_vcf(vcf_files[idx], window_files[idx], coords, random)
+
+    coverage_file = str(tmpdir.join('coverage.tsv'))
+
+    _write_coverage(coverage_file)
+
+    out_file = str(tmpdir.join('filtered.vcf'))
+
+    expected_file = str(tmpdir.join('expected.vcf'))
+
+    filter_indel_file_list(vcf_files, coverage_file, window_files, out_file, '1', known_chrom_size)
+
+    _filter_indel_pyvcf(vcf_files, window_files, expected_file, 90.)
+
+    _assert_same_records(out_file, expected_file)
+
+    reader, records = _read_records(out_file)
+
+    assert [reader.formats[x].type for x in ('DP50', 'FDP50', 'SUBDP50')] == ['Float'] * 3
+
+    filters = set(x for record in records for x in (record[4] or []))
+
+    assert filters == set(
+        ['LowQ', FILTER_ID_DEPTH, FILTER_ID_REPEAT, FILTER_ID_INDEL_HPOL, FILTER_ID_BASE, FILTER_ID_QSI])
+    assert any(record[4] == [] for record in records)
+    assert any(len(record[3]) > 1 for record in records)
+
+
+@pytest.mark.parametrize('dropped_prefix,missing', [('1\t51\t', '1:51'), ('1\t', '1:1')])
+def test_filter_indel_file_list_missing_window(tmpdir, dropped_prefix, missing):
+    random = np.random.RandomState(0)
+
+    vcf_file = str(tmpdir.join('indel.vcf'))
+
+    window_file = str(tmpdir.join('window.txt'))
+
+    _write_indel_vcf(vcf_file, window_file, range(1, 100, 2), random)
+
+    # Drop the window of one record, or of the whole chromosome
+    with open(window_file) as fh:
+        lines = [x for x in fh if not x.startswith(dropped_prefix)]
+
+    with open(window_file, 'w') as fh:
+        fh.writelines(lines)
+
+    coverage_file = str(tmpdir.join('coverage.tsv'))
+
+    _write_coverage(coverage_file)
+
+    with pytest.raises(ValueError, match='No window data for {0} in .*window.txt'.format(missing)):
+        filter_indel_file_list(
+            {0: vcf_file}, coverage_file, {0: window_file}, str(tmpdir.join('filtered.vcf')), '1', known_chrom_size)